@@ -6,11 +6,16 @@ import time
 import multiprocessing
 from datetime import datetime
 
-from . import twitterhandler, stream, anagramfinder, hit_server, hitmanager
+from . import (twitterhandler, stream, anagramfinder, shardedfinder, hit_server, hitmanager,
+               common, overload, storage)
 from .anagramstats import StatTracker
 
 
-def run(server_only=False, **kwargs):
+def run(server_only=False, batch_size=common.ANAGRAM_BATCH_SIZE, shards=1,
+        overload_policies=common.ANAGRAM_OVERLOAD_POLICIES,
+        warm_bytes=common.ANAGRAM_WARM_BYTES, max_age=None,
+        max_keys=common.ANAGRAM_RETENTION_MAX_KEYS, max_bytes=None,
+        enrichment_workers=common.ANAGRAM_ENRICHMENT_WORKERS, **kwargs):
     try:
         import setproctitle
         setproctitle.setproctitle('anagramatron')
@@ -27,29 +32,37 @@ def run(server_only=False, **kwargs):
         hitserver.start()
 
         hit_manager = hitmanager.HitDBManager(dbpath)
+        hit_manager.start_enrichment(enrichment_workers)
 
         def handle_hit(p1, p2):
             hit_manager.new_hit(p1, p2)
 
-        anagram_finder = anagramfinder.AnagramFinder(storage='mdbm', hit_callback=handle_hit)
+        retention = storage.RetentionPolicy(max_age, max_keys, max_bytes)
+        if shards > 1:
+            # limits are split between shards by the sharded finder
+            anagram_finder = shardedfinder.ShardedAnagramFinder(
+                shards, storage='mdbm', hit_callback=handle_hit, warm_bytes=warm_bytes,
+                retention=retention)
+        else:
+            anagram_finder = anagramfinder.AnagramFinder(
+                storage='mdbm', hit_callback=handle_hit, warm_bytes=warm_bytes,
+                retention=retention)
+        controller = overload.OverloadController(overload_policies, finder=anagram_finder)
         stats = StatTracker()
         while 1:
             try:
                 print('starting stream handler', file=sys.stderr)
                 stream_handler = stream.StreamHandler(**kwargs)
                 stream_handler.start()
-                for processed_tweet in stream_handler:
-                    anagram_finder.handle_input(processed_tweet)
+                for batch in stream_handler.batches(batch_size):
+                    batch = controller.admit(batch, stream_handler.backlog)
+                    anagram_finder.handle_many(batch)
                     stats.print_stats()
 
-            except anagramfinder.NeedsMaintenance:
-                print('performing maintenance', file=sys.stderr)
-                stream_handler.close()
-                anagram_finder.perform_maintenance()
-
             except KeyboardInterrupt:
                 stream_handler.close()
                 anagram_finder.close()
+                hit_manager.close()
                 return 0
             except Exception as err:
                 stream_handler.close()
@@ -73,7 +86,39 @@ def main():
         action="store_true")
     parser.add_argument('--host', help="hostname for stream connection")
     parser.add_argument('--port', help="port for stream connection", type=int, default=8069)
+    parser.add_argument('--batch-size', help="number of tweets handled per batch",
+                        type=int, default=common.ANAGRAM_BATCH_SIZE)
+    parser.add_argument('--filter-workers', help="number of processes filtering the stream",
+                        type=int, default=common.ANAGRAM_FILTER_WORKERS)
+    parser.add_argument('--overload-policy', dest='overload_policies', action='append',
+                        choices=sorted(overload.OVERLOAD_POLICIES),
+                        help="how to shed load when we can't keep up with the stream. "
+                        "may be given more than once (default: %s)" % ', '.join(
+                            common.ANAGRAM_OVERLOAD_POLICIES))
+    parser.add_argument('--shards', help="number of matching processes. tweets are "
+                        "partitioned between them by anagram key, and each keeps its "
+                        "own datastore, so changing this starts with empty datastores",
+                        type=int, default=1)
+    parser.add_argument('--warm-bytes', help="bytes of recent datastore entries to read "
+                        "into memory at startup, split between shards (0 to skip)",
+                        type=int, default=common.ANAGRAM_WARM_BYTES)
+    parser.add_argument('--max-age', help="archive datastore chunks not written to in "
+                        "this many days", type=float)
+    parser.add_argument('--max-keys', help="archive the oldest datastore chunks past "
+                        "this many keys, split between shards (default: %(default)s; "
+                        "0 to keep every chunk)", type=int,
+                        default=common.ANAGRAM_RETENTION_MAX_KEYS)
+    parser.add_argument('--max-bytes', help="archive the oldest datastore chunks past "
+                        "this many bytes on disk, split between shards", type=int)
+    parser.add_argument('--enrichment-workers', help="threads fetching the tweets in new "
+                        "hits from twitter", type=int, default=common.ANAGRAM_ENRICHMENT_WORKERS)
     args = parser.parse_args()
+    if not args.overload_policies:
+        args.overload_policies = common.ANAGRAM_OVERLOAD_POLICIES
+    if not args.max_keys:
+        args.max_keys = None
+    if args.max_age is not None:
+        args.max_age *= 24 * 60 * 60
 
     return run(**vars(args))
 
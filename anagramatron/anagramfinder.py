@@ -2,24 +2,67 @@
 
 from __future__ import print_function
 import os
+import sys
+import time
 # import logging
-import multiprocessing
+import threading
+from itertools import islice
+from operator import itemgetter
 
-from . import multidbm, anagramfunctions, common, simpledatastore
+from . import multidbm, sqlitestore, anagramfunctions, common, simpledatastore, duplicates
+from .storage import decode_value
 from .anagramstats import StatTracker
 
 
 DATA_PATH_COMPONENT = 'anagrammdbm'
+SQLITE_PATH_COMPONENT = 'anagramsqlite'
 CACHE_PATH_COMPONENT = 'cachedump'
+HASH_KEY = 'anagram_hash'
 
+_NOT_FETCHED = object()
+# the writer releases the datastore lock between slices of this many writes
+_WRITE_SLICE_SIZE = 500
+# seconds between checks of the datastore against the retention policy
+_RETENTION_INTERVAL = 60
 
-class NeedsMaintenance(Exception):
 
+STORAGE_BACKENDS = {
+    'mdbm': multidbm.MultiDBM,
+    'sqlite': sqlitestore.SQLiteStore,
+}
+STORAGE_PATH_COMPONENTS = {
+    'mdbm': DATA_PATH_COMPONENT,
+    'sqlite': SQLITE_PATH_COMPONENT,
+}
+
+
+def text_from_input(inp, key=None):
     """
-    hacky exception raised when AnagramFinder is no longer able to keep up.
-    use this to signal that we should shutdown and perform maintenance.
+    returns the text of an input: a string, or a dict with the text under
+    key, or under the legacy 'tweet_text' key.
     """
-    pass
+    LEGACY_KEY = 'tweet_text'
+    if isinstance(inp, str):
+        return inp
+    else:
+        text = inp.get(key) or inp.get(LEGACY_KEY)
+        if not text:
+            raise TypeError('expected string or dict, got %s (%s)' % (type(inp), inp))
+        return text
+
+
+def _candidates(value):
+    """returns the list of candidates in a stored value."""
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def _bucket_value(candidates):
+    """returns the value to store for a list of candidates."""
+    if len(candidates) == 1:
+        return candidates[0]
+    return list(candidates)
 
 
 class AnagramFinder(object):
@@ -32,17 +75,50 @@ class AnagramFinder(object):
 
     :languages: a list of language identifiers. In future, multiple languages
     might be supported. NOT IMPLEMENTED.
-    :storage: type of backing store. currently accepts None or 'mdbm'.
+    :storage: type of backing store. accepts None, or a name in STORAGE_BACKENDS.
+    :path: the location of the backing store. defaults to a path in the data directory.
+    :cachepath: where the cache is saved between runs. defaults to a path in the
+    data directory.
     :hit_callback: a function to be called when an anagram is found.
     :test_func: a function called when an anagram is found.
     Should implement some heuristic and return True if the passed anagram is 'interesting'.
+    :verify_keys: if True, precomputed anagram keys on input are checked against
+    the input text, and recomputed if they don't match.
+    :cache_size: the number of entries kept in memory before trimming to storage.
+    :cache_bytes: the estimated cache size in bytes before trimming to storage.
+    None for no limit.
+    :background_writes: if True, entries trimmed from the cache are written to
+    storage by a background thread. entries waiting to be written are still
+    visible to lookups.
+    :bucket_size: the number of candidates kept for each anagram key. a new
+    tweet is tested against all of them, and each one that passes is a hit.
+    with a bucket_size of 1, a tweet that fails replaces the stored candidate.
+    :duplicate_keys: the number of keys for which the fingerprints of recent
+    candidates are remembered. tweets with the same words as one of them are
+    dropped without being compared. 0 to compare every tweet.
+    :warm_bytes: if not 0, a background thread reads the newest entries in the
+    datastore into memory at startup, until about this many bytes are used.
+    lookups check them before going to the datastore.
+    :retention: a storage.RetentionPolicy. once a minute, as entries are
+    written, the oldest datastore entries outside it are archived.
+    None keeps everything; anagramatron.run defaults to a limit of
+    common.ANAGRAM_RETENTION_MAX_KEYS keys.
     """
 
     def __init__(self, languages=['en'],
                  storage=None,
                  path=None,
+                 cachepath=None,
                  hit_callback=print,
-                 test_func=anagramfunctions.test_anagram):
+                 test_func=anagramfunctions.test_anagram,
+                 verify_keys=False,
+                 cache_size=common.ANAGRAM_CACHE_SIZE,
+                 cache_bytes=common.ANAGRAM_CACHE_BYTES,
+                 background_writes=True,
+                 bucket_size=common.ANAGRAM_BUCKET_SIZE,
+                 duplicate_keys=common.ANAGRAM_DUPLICATE_KEYS,
+                 warm_bytes=common.ANAGRAM_WARM_BYTES,
+                 retention=None):
         """
         language selection is not currently implemented
         """
@@ -52,83 +128,245 @@ class AnagramFinder(object):
         self.languages = languages
         self._should_trim_cache = False
         self._write_process = None
-        self._lock = multiprocessing.Lock()
-        self._is_writing = multiprocessing.Event()
+        self._lock = threading.Lock()
+        self._write_condition = threading.Condition(self._lock)
+        self._is_writing = threading.Event()
+        self._pending = dict()
+        self._should_stop_writing = False
+        self._write_error = None
+        self._warm_process = None
+        self._compact_process = None
+        self._warm = dict()
+        # keys written to the datastore since warming began. None once it's done.
+        self._warm_dirty = set()
+        self._should_stop_warming = False
         self.store_path = path or os.path.join(
             common.ANAGRAM_DATA_DIR,
-            '%s_%s.db' % (DATA_PATH_COMPONENT, '_'.join(languages)))
-        self.cachepath = os.path.join(
+            '%s_%s.db' % (STORAGE_PATH_COMPONENTS.get(storage, DATA_PATH_COMPONENT),
+                          '_'.join(languages)))
+        self.cachepath = cachepath or os.path.join(
             common.ANAGRAM_DATA_DIR,
             '%s_%s.cache' % (CACHE_PATH_COMPONENT, '_'.join(languages)))
 
         self.hit_callback = hit_callback
         self.test_func = test_func
+        self.verify_keys = verify_keys
+        self.cache_size = cache_size
+        self.cache_bytes = cache_bytes
+        self.warm_bytes = warm_bytes
+        self.retention = retention
+        self._last_retention_check = 0
+        self.bucket_size = max(1, bucket_size)
+        self.cache_only = False
+        self.duplicates = None
+        if duplicate_keys:
+            self.duplicates = duplicates.DuplicateFilter(duplicate_keys)
         self.cache, self.datastore = self.setup_storage(storage)
         self.stats = StatTracker()
+        if self.datastore is not None and background_writes:
+            self._write_process = threading.Thread(target=self._write_pending)
+            self._write_process.daemon = True
+            self._write_process.start()
+        if self.datastore is not None and warm_bytes:
+            self._warm_process = threading.Thread(target=self._warm_up)
+            self._warm_process.daemon = True
+            self._warm_process.start()
+        else:
+            self._warm_dirty = None
 
     def setup_storage(self, storage_name):
-        cache = simpledatastore.AnagramSimpleStore(self.cachepath if storage_name else None)
+        cache = simpledatastore.AnagramSimpleStore(
+            self.cachepath if storage_name else None,
+            max_items=self.cache_size,
+            max_bytes=self.cache_bytes)
         storage = None
-        if storage_name == 'mdbm':
-            storage = multidbm.MultiDBM(self.store_path)
+        if storage_name in STORAGE_BACKENDS:
+            storage = STORAGE_BACKENDS[storage_name](self.store_path)
         elif storage_name:
-            raise Exception('no storage model named %s' % storage)
+            raise Exception('no storage model named %s' % storage_name)
         return cache, storage
 
-    def handle_input(self, inp, text_key="text"):
+    def handle_input(self, inp, text_key="text", key=None):
         """
         takes either a string or a dict, and compares it against
         all previous input. if an anagram is found, runs self.test_func
         and then self.hit_callback if test passes.
+
+        if a precomputed anagram key is passed, or the input dict has an
+        'anagram_hash' (as returned by filter_tweet), it is used instead
+        of hashing the text again.
         """
         text = self._text_from_input(inp, text_key)
-        key = anagramfunctions.improved_hash(text)
-        if key in self.cache:
-
-            self.stats['cache_hits'] += 1
-            match = self.cache[key]
-            match_text = self._text_from_input(match, text_key)
-            if self.test_func(text, match_text):
-                del self.cache[key]
-                self.hit_callback(inp, match)
-            else:
-                # anagram, but fails tests (too similar)
-                self.cache[key] = inp
-        else:
+        key = self._key_for_input(inp, text, key)
+        for _, one, two in self._handle_group(key, [(0, inp, text)], text_key):
+            self.hit_callback(one, two)
+        self._check_cache_size()
+
+    def handle_many(self, inputs, text_key="text"):
+        """
+        handles an iterable of inputs, as with handle_input.
+        inputs may be strings, dicts, or (input, key) tuples.
+
+        inputs are grouped by anagram key, so anagrams within the batch
+        are paired in memory and the datastore is probed at most once per
+        distinct key. hit_callback is called in input order.
+        """
+        groups = dict()
+        for index, inp in enumerate(inputs):
+            key = None
+            if isinstance(inp, tuple):
+                inp, key = inp
+            text = self._text_from_input(inp, text_key)
+            key = self._key_for_input(inp, text, key)
+            groups.setdefault(key, []).append((index, inp, text))
+
+        hits = []
+        for key, group in groups.items():
+            hits.extend(self._handle_group(key, group, text_key))
+        for _, one, two in sorted(hits, key=itemgetter(0)):
+            self.hit_callback(one, two)
+        self._check_cache_size()
+
+    def _key_for_input(self, inp, text, key=None):
+        """
+        returns the anagram key for inp, trusting a precomputed key if present.
+        """
+        if key is None and isinstance(inp, dict):
+            key = inp.get(HASH_KEY)
+        if key is None:
+            return anagramfunctions.improved_hash(text)
+        if self.verify_keys:
+            computed = anagramfunctions.improved_hash(text)
+            if computed != key:
+                self.stats['bad_keys'] += 1
+                return computed
+        return key
+
+    def _handle_group(self, key, group, text_key):
+        """
+        compares a list of (index, input, text) tuples sharing an anagram key
+        against previous input, in order.
+        returns a list of (index, input, match) tuples for passing anagrams.
+        """
+        hits = []
+        stored = _NOT_FETCHED
+        for index, inp, text in group:
+            fingerprint = None
+            if self.duplicates is not None:
+                fingerprint = anagramfunctions.text_fingerprint(text)
+                if self.duplicates.is_duplicate(key, fingerprint):
+                    # a repeat of a recent candidate can't pair with it
+                    self.stats['duplicates_dropped'] += 1
+                    continue
+
+            if key in self.cache:
+                self.stats['cache_hits'] += 1
+                candidates = _candidates(self.cache[key])
+                matches = self._test_candidates(text, candidates, text_key)
+                if matches:
+                    hits.extend((index, inp, match) for match in matches)
+                    remaining = [c for c in candidates
+                                 if not any(c is match for match in matches)]
+                    if remaining:
+                        self.cache[key] = _bucket_value(remaining)
+                    else:
+                        del self.cache[key]
+                    if fingerprint is not None:
+                        for match in matches:
+                            self.duplicates.discard(key, anagramfunctions.text_fingerprint(
+                                self._text_from_input(match, text_key)))
+                else:
+                    # anagram, but fails tests (too similar)
+                    self.cache[key] = self._add_candidate(candidates, inp, text, text_key)
+                    self._remember(key, fingerprint)
+                continue
+
             # not in cache. in datastore?
-            if self.datastore and key in self.datastore:
-                self._process_hit(inp, key, text_key)
-            else:
+            if stored is _NOT_FETCHED:
+                if self.cache_only:
+                    self.stats['probes_skipped'] += 1
+                    stored = None
+                else:
+                    stored = self._fetch_stored(key)
+            if stored is None:
                 # not in datastore. add to cache
                 self.cache[key] = inp
-                self.stats['cache_size'] = len(self.cache)
-                if self.datastore and len(self.cache) > common.ANAGRAM_CACHE_SIZE:
-                    self._trim_cache()
+                self._remember(key, fingerprint)
+                continue
+
+            self.stats['possible_hits'] += 1
+            matches = self._test_candidates(text, stored, text_key)
+            if matches:
+                hits.extend((index, inp, match) for match in matches)
+            else:
+                # the stored candidates move to the cache along with this one
+                self.cache[key] = self._add_candidate(stored, inp, text, text_key)
+                self._remember(key, fingerprint)
+        return hits
+
+    def _remember(self, key, fingerprint):
+        if fingerprint is not None:
+            self.duplicates.add(key, fingerprint)
 
-    def _process_hit(self, inp, key, text_key):
+    def set_cache_only(self, cache_only):
+        """
+        if cache_only is True, the datastore isn't searched for matches.
+        used to shed load while we can't keep up.
+        """
+        self.cache_only = cache_only
+
+    def _test_candidates(self, text, candidates, text_key):
+        """returns the candidates that pass test_func against text, newest first."""
+        return [c for c in reversed(candidates)
+                if self.test_func(text, self._text_from_input(c, text_key))]
+
+    def _add_candidate(self, candidates, inp, text, text_key):
+        """
+        returns the value to store for a key after adding inp to its candidates.
+        a candidate with the same letters in the same order as inp is replaced,
+        and the oldest candidates are dropped past bucket_size.
+        """
+        if self.bucket_size == 1:
+            return inp
+        chars = anagramfunctions.normalized_text(text).chars
+        kept = [c for c in candidates if chars != anagramfunctions.normalized_text(
+            self._text_from_input(c, text_key)).chars]
+        kept.append(inp)
+        return _bucket_value(kept[-self.bucket_size:])
+
+    def _fetch_stored(self, key):
+        """
+        returns the list of candidates for key in the datastore,
+        or None if there are none or they can't be decoded.
+        """
+        if self.datastore is None:
+            return None
         try:
-            hit = self.datastore[key]
-            hit_text = self._text_from_input(hit, text_key)
-            text = self._text_from_input(inp, text_key)
+            with self._lock:
+                hit = self._pending.get(key)
+                if hit is None:
+                    hit = self._warm.get(key)
+                    if hit is not None:
+                        self.stats['warm_hits'] += 1
+                        hit = decode_value(hit, key)
+                if hit is None:
+                    hit = self.datastore.get(key)
         except (UnicodeDecodeError, ValueError):
             print('error decoding hit for key %s' % key)
-            self.cache[key] = inp
-            return
-        self.stats['possible_hits'] += 1
-        if self.test_func(text, hit_text):
-            self.hit_callback(inp, hit)
-        else:
-            self.cache[key] = inp
+            return None
+        if hit is None:
+            return None
+        return _candidates(hit)
+
+    def _check_cache_size(self):
+        self.stats['cache_size'] = len(self.cache)
+        if self.duplicates is not None:
+            self.stats['duplicates_by_key'] = self.duplicates.counts
+        if self.datastore is not None and self.cache.over_capacity():
+            self._trim_cache()
 
     def _text_from_input(self, inp, key=None):
-        LEGACY_KEY = 'tweet_text'
-        if isinstance(inp, str):
-            return inp
-        else:
-            text = inp.get(key) or inp.get(LEGACY_KEY)
-            if not text:
-                raise TypeError('expected string or dict, got %s (%s)' % (type(inp), inp))
-            return text
+        return text_from_input(inp, key)
 
     def _trim_cache(self, to_trim=None):
         """
@@ -137,18 +375,156 @@ class AnagramFinder(object):
         self._should_trim_cache = False
 
         if not to_trim:
-            to_trim = min(10000, (common.ANAGRAM_CACHE_SIZE / 10))
+            to_trim = max(1, min(10000, (self.cache_size or common.ANAGRAM_CACHE_SIZE) // 10))
+
+        start = time.time()
+        to_store = self.cache.pop_least_used(to_trim)
+        while self.cache.over_capacity() and len(self.cache):
+            to_store.extend(self.cache.pop_least_used(to_trim))
+        self._store(to_store)
+
+        self.stats['cache_trims'] += 1
+        self.stats['cache_evictions'] += len(to_store)
+        self.stats['cache_bytes'] = self.cache.byte_size
+        self.stats['last_trim_seconds'] = time.time() - start
+
+    def _store(self, items):
+        """
+        writes a list of (key, value) pairs to the datastore, or queues them
+        for the writer thread if we have one.
+        """
+        if not self._write_process:
+            with self._lock:
+                self._forget_warm(items)
+                self.datastore.put_many(items)
+            self._check_retention()
+            return
+
+        with self._write_condition:
+            self._raise_write_error()
+            self._forget_warm(items)
+            self._pending.update(items)
+            self._is_writing.set()
+            self._write_condition.notify_all()
+            # if the writer is falling behind, wait for it to catch up
+            while len(self._pending) > (self.cache_size or common.ANAGRAM_CACHE_SIZE) // 2:
+                self._write_condition.wait()
+                self._raise_write_error()
+        self.stats['pending_writes'] = len(self._pending)
+
+    def _forget_warm(self, items):
+        """
+        drops warm entries for keys about to be written, and remembers the
+        keys if warming is still going on, so older values aren't read in.
+        called with the datastore lock held.
+        """
+        if self._warm_dirty is not None:
+            self._warm_dirty.update(key for key, _ in items)
+        if self._warm:
+            for key, _ in items:
+                self._warm.pop(key, None)
+
+    def _warm_up(self):
+        """
+        runs on the warm-up thread, reading the newest entries in the datastore
+        into self._warm until warm_bytes is used. values are kept encoded.
+        the datastore lock is released between slices of entries.
+        """
+        start = time.time()
+        used = 0
+        try:
+            items = self.datastore.recent_items()
+            while not self._should_stop_warming and used < self.warm_bytes:
+                with self._lock:
+                    batch = list(islice(items, _WRITE_SLICE_SIZE))
+                    for key, value in batch:
+                        if key in self._warm or key in self._warm_dirty:
+                            continue
+                        used += sys.getsizeof(key) + sys.getsizeof(value)
+                        if used > self.warm_bytes:
+                            break
+                        self._warm[key] = value
+                if not batch:
+                    break
+                time.sleep(0)
+        except Exception as err:
+            print('error warming cache: %s' % err)
+        with self._lock:
+            self._warm_dirty = None
+        self.stats['warm_keys'] = len(self._warm)
+        self.stats['warm_seconds'] = time.time() - start
+        print('read %i recent entries in %.1fs' % (len(self._warm), time.time() - start))
 
-        to_store = self.cache.least_used(to_trim)
-        # write those caches to disk, delete from cache, add to hashes
-        for x in to_store:
-            self.datastore[x] = self.cache[x]
-            del self.cache[x]
+    def _write_pending(self):
+        """
+        runs on the writer thread, moving pending entries into the datastore.
+        entries stay in self._pending until they have been written.
+        """
+        while True:
+            with self._write_condition:
+                while not self._pending and not self._should_stop_writing:
+                    self._write_condition.wait()
+                if not self._pending:
+                    return
+                try:
+                    items = list(islice(self._pending.items(), _WRITE_SLICE_SIZE))
+                    self.datastore.put_many(items)
+                except Exception as err:
+                    print('error writing to datastore: %s' % err)
+                    self._write_error = err
+                    self._write_condition.notify_all()
+                    return
+                for key, value in items:
+                    if self._pending.get(key) is value:
+                        del self._pending[key]
+                if not self._pending:
+                    self._is_writing.clear()
+                self._write_condition.notify_all()
+            try:
+                self._check_retention()
+            except (IOError, OSError):
+                return
+            # let other threads at the datastore between slices
+            time.sleep(0)
+
+    def _check_retention(self):
+        """
+        archives the oldest datastore entries outside self.retention, if we
+        haven't checked in the last _RETENTION_INTERVAL seconds.
+        called without the datastore lock, which is only held while chunks
+        are taken out of the store, not while their files are moved.
+        an error archiving is kept as the write error, and raised.
+        """
+        if not self.retention or time.time() - self._last_retention_check < _RETENTION_INTERVAL:
+            return
+        start = self._last_retention_check = time.time()
+        try:
+            archived = self.datastore.enforce_retention(self.retention, lock=self._lock)
+        except (IOError, OSError) as err:
+            print('error archiving old entries: %s' % err)
+            with self._write_condition:
+                self._write_error = err
+                self._write_condition.notify_all()
+            raise
+        if archived:
+            print('archived %s' % ', '.join(archived))
+            self.stats['chunks_archived'] += len(archived)
+            self.stats['last_archive_seconds'] = time.time() - start
+        with self._lock:
+            self.stats['datastore_keys'] = len(self.datastore)
 
-        buffer_size = self.stats['buffer']
-        if buffer_size > common.ANAGRAM_STREAM_BUFFER_SIZE:
-            print('raised needs maintenance')
-            raise NeedsMaintenance
+    def _raise_write_error(self):
+        if self._write_error is not None:
+            raise self._write_error
+
+    def flush(self):
+        """blocks until all entries trimmed from the cache are in the datastore."""
+        if not self._write_process:
+            return
+        with self._write_condition:
+            while self._pending and self._write_process.is_alive():
+                self._write_condition.wait(1)
+            self._raise_write_error()
 
     def perform_maintenance(self):
         """
@@ -156,18 +532,62 @@ class AnagramFinder(object):
         moves current database elsewhere and starts again with new db
         """
         print("perform maintenance called")
+        self.flush()
         # save our current cache to be restored after we run _setup (hacky)
-        moveddb = self.datastore.archive()
+        with self._lock:
+            moveddb = self.datastore.archive()
         print('moved mdbm chunk: %s' % moveddb)
         print('mdbm contains %s chunks' % self.datastore.section_count())
 
+    def compact(self, count=None):
+        """
+        merges the oldest count datastore chunks (all sealed chunks by default)
+        into one, on a background thread. input is handled as usual meanwhile.
+        only mdbm datastores are compacted.
+        """
+        if not isinstance(self.datastore, multidbm.MultiDBM):
+            print('compaction needs an mdbm datastore')
+            return
+        if self._compact_process and self._compact_process.is_alive():
+            print('compaction already running')
+            return
+        self._compact_process = threading.Thread(target=self._compact, args=(count,))
+        self._compact_process.daemon = True
+        self._compact_process.start()
+
+    def _compact(self, count):
+        try:
+            result = multidbm.compact_with_report(self.datastore, count, self._lock)
+        except Exception as err:
+            print('error compacting datastore: %s' % err)
+            return
+        if result is None:
+            print('nothing to compact')
+            return
+        print(multidbm.format_compaction(result))
+        self.stats['last_compaction'] = result
+
     def close(self):
+        if self._compact_process and self._compact_process.is_alive():
+            print('waiting for compaction to finish')
+            self._compact_process.join()
+
+        if self._warm_process and self._warm_process.is_alive():
+            self._should_stop_warming = True
+            self._warm_process.join()
+
         if self._write_process and self._write_process.is_alive():
-            print('write process active. waiting.')
+            if self._pending:
+                print('writing %i pending entries. waiting.' % len(self._pending))
+            with self._write_condition:
+                self._should_stop_writing = True
+                self._write_condition.notify_all()
             self._write_process.join()
+        if self._write_process:
+            self._raise_write_error()
 
         self.cache.save()
-        if self.datastore:
+        if self.datastore is not None:
             self.datastore.close()
 
 
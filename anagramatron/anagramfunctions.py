@@ -1,7 +1,11 @@
 import re
+import string
 import unicodedata
 import json
 
+from functools import lru_cache
+from operator import eq
+
 from .common import (ANAGRAM_LOW_CHAR_CUTOFF, ANAGRAM_LOW_UNIQUE_CHAR_CUTOFF,
     ANAGRAM_ALPHA_RATIO_CUTOFF, ENGLISH_LETTER_FREQUENCIES)
 
@@ -15,6 +19,21 @@ ENGLISH_LETTER_LIST = sorted(ENGLISH_LETTER_FREQUENCIES.keys(),
 freqsort = ENGLISH_LETTER_FREQUENCIES
 # just to keep line_lengths sane
 
+# lookup tables used by improved_hash: lowercase ascii letters, drop everything
+# else, then read letter counts off in frequency order.
+_LOWERCASE_TABLE = bytes.maketrans(string.ascii_uppercase.encode('ascii'),
+                                   string.ascii_lowercase.encode('ascii'))
+_NON_LETTER_BYTES = bytes(b for b in range(256)
+                          if chr(b) not in string.ascii_letters)
+_LETTER_ORDINALS = [ord(l) for l in ENGLISH_LETTER_LIST]
+_HASH_CHAR_TABLE = bytes(64 + min(c, 48) for c in range(256))
+# used by stripped_string(spaces=True): dashes and underbars become spaces.
+_SPACED_LOWERCASE_TABLE = bytes.maketrans(
+    string.ascii_uppercase.encode('ascii') + b'_-',
+    string.ascii_lowercase.encode('ascii') + b'  ')
+_NON_LETTER_OR_SPACE_BYTES = bytes(b for b in range(256)
+                                   if chr(b) not in string.ascii_letters + ' ')
+
 
 def simple_hash(text, debug=False):
     text = stripped_string(text)
@@ -28,9 +47,42 @@ def simple_hash(text, debug=False):
 def improved_hash(text, debug=False):
     """
     only very *minorly* improved. sorts based on letter frequencies.
+
+    the key is one char per letter, in frequency order, where the char is
+    chr(64 + count). trailing absent letters are dropped, and the key is
+    padded with '@' to an even length.
+    """
+    return _key_from_letters(_ascii_letters(text))
+
+
+def _ascii_letters(text):
+    """returns the ascii letters in text, lowercased, as bytes."""
+    return text.encode('ascii', 'ignore').translate(_LOWERCASE_TABLE, _NON_LETTER_BYTES)
+
+
+def _key_from_letters(letters):
+    """returns the improved_hash of text, given _ascii_letters(text)."""
+    counts = list(map(letters.count, _LETTER_ORDINALS))
+    try:
+        counts = bytes(counts)
+    except ValueError:
+        # counts are capped at 48 as a hacky sanity check on our values.
+        counts = bytes(c if c < 48 else 48 for c in counts)
+    trimmed = counts.rstrip(b'\x00')
+    if not trimmed:
+        return chr(64) * len(counts)
+    if len(trimmed) % 2:
+        trimmed += b'\x00'
+    return trimmed.translate(_HASH_CHAR_TABLE).decode('ascii')
+
+
+def _regex_improved_hash(text, debug=False):
+    """
+    the original regex based implementation of improved_hash.
+    kept as a reference for tests and benchmarks.
     """
     CHR_COUNT_START = 64  # we convert to chars; char 65 is A
-    t_text = stripped_string(text)
+    t_text = _regex_stripped_string(text)
     t_hash = ''.join(sorted(t_text, key=lambda t: freqsort[t]))
     letset = set(t_hash)
     break_letter = t_hash[-1:]
@@ -74,10 +126,9 @@ def correct_encodings(text):
     """
     twitter auto converts &, <, > to &amp; &lt; &gt;
     """
-    text = re.sub(r'&amp;', '&', text)
-    text = re.sub(r'&lt;', '<', text)
-    text = re.sub(r'&gt;', '>', text)
-    return text
+    if '&' not in text:
+        return text
+    return text.replace('&amp;', '&').replace('&lt;', '<').replace('&gt;', '>')
 
 
 def _strip_accents(s):
@@ -152,10 +203,174 @@ def filter_tweet(tweet):
             }
 
 
+# precompiled for filter_tweets
+_DIGIT_RE = re.compile(r'[0-9]')
+_TRICKY_CHARS_RE = re.compile(r'[\u0080-\u024F]')
+# bytes that don't count as letters in _low_letter_ratio
+_NON_RATIO_BYTES = bytes(b for b in range(256)
+                         if chr(b) not in string.ascii_letters + ' .,!?"\'')
+# the checks may run in any order, so one missing entities can't raise
+_NO_ENTITIES = {}
+
+
+def _not_english(tweet):
+    return tweet.get('lang') != 'en'
+
+
+def _has_mentions(tweet):
+    return bool((tweet.get('entities') or _NO_ENTITIES).get('user_mentions'))
+
+
+def _is_retweet(tweet):
+    return bool(tweet.get('retweeted_status'))
+
+
+def _has_links(tweet):
+    return bool((tweet.get('entities') or _NO_ENTITIES).get('urls'))
+
+
+def _has_digits(tweet):
+    return _DIGIT_RE.search(tweet['text']) is not None
+
+
+class TweetFilter(object):
+
+    """
+    filters batches of raw stream tweets, with the same results as filter_tweet.
+
+    the cheap checks that don't need the text normalized are tried in order
+    of how many tweets each has rejected recently, so most rejected tweets
+    are rejected by the first check. the text is normalized once, and reused
+    for the anagram key if nothing else changes it.
+
+    :reorder_interval: the number of tweets between reorderings of the checks.
+    """
+
+    def __init__(self, reorder_interval=1000):
+        self.reorder_interval = reorder_interval
+        self.checks = [_not_english, _has_mentions, _is_retweet, _has_links, _has_digits]
+        self.rejections = dict((check, 0) for check in self.checks)
+        self._until_reorder = reorder_interval
+
+    def filter_tweets(self, tweets):
+        """
+        returns a list of filter_tweet's results for the tweets that pass,
+        in order.
+        """
+        passed = []
+        checks = self.checks
+        rejections = self.rejections
+        for tweet in tweets:
+            for check in checks:
+                if check(tweet):
+                    rejections[check] += 1
+                    break
+            else:
+                result = self._filter_text(tweet)
+                if result:
+                    passed.append(result)
+
+        self._until_reorder -= len(tweets)
+        if self._until_reorder <= 0:
+            self._reorder()
+        return passed
+
+    def _reorder(self):
+        self.checks.sort(key=self.rejections.__getitem__, reverse=True)
+        # decay old counts, so the order follows changes in the stream
+        for check in self.rejections:
+            self.rejections[check] //= 2
+        self._until_reorder = self.reorder_interval
+
+    def _filter_text(self, tweet):
+        text = tweet['text']
+        letters = _ascii_letters(text)
+        if len(letters) <= ANAGRAM_LOW_CHAR_CUTOFF:
+            return False
+        if len(set(letters)) <= ANAGRAM_LOW_UNIQUE_CHAR_CUTOFF:
+            return False
+
+        tweet_text = correct_encodings(text)
+        if not tweet_text.isascii() and _TRICKY_CHARS_RE.search(tweet_text):
+            tweet_text = _strip_accents(tweet_text)
+        ratio_chars = len(tweet_text.encode('ascii', 'ignore').translate(None, _NON_RATIO_BYTES))
+        if (float(ratio_chars) / len(tweet_text)) < ANAGRAM_ALPHA_RATIO_CUTOFF:
+            return False
+
+        if tweet_text is text:
+            key = _key_from_letters(letters)
+        else:
+            key = improved_hash(tweet_text)
+        return {'anagram_hash': key,
+                'tweet_id': int(tweet['id_str']),
+                'text': tweet_text
+                }
+
+
+_tweet_filter = TweetFilter()
+
+
+def filter_tweets(tweets):
+    """
+    filters a list of raw tweets, as filter_tweet.
+    returns the processed tweets that pass, with their anagram keys.
+    """
+    return _tweet_filter.filter_tweets(tweets)
+
+
+class NormalizedText(object):
+
+    """
+    a tweet text normalized once for comparison by test_anagram.
+
+    :chars: lowercase letters only, as stripped_string(text).
+    :spaced: lowercase letters and spaces, as stripped_string(text, spaces=True).
+    :words: the words of spaced, in order.
+    :word_set: the distinct words.
+    :words_by_length: words, longest first (stable for equal lengths).
+    """
+
+    __slots__ = ('text', 'chars', 'spaced', 'words', 'word_set', 'words_by_length')
+
+    def __init__(self, text):
+        self.text = text
+        self.chars = stripped_string(text)
+        self.spaced = stripped_string(text, spaces=True)
+        self.words = self.spaced.split()
+        self.word_set = frozenset(self.words)
+        self.words_by_length = sorted(self.words, key=len, reverse=True)
+
+
+@lru_cache(maxsize=4096)
+def normalized_text(text):
+    """
+    returns a NormalizedText for text. results are cached, since candidates
+    for popular keys are compared against the same stored text many times.
+    """
+    return NormalizedText(text)
+
+
+def text_fingerprint(text):
+    """
+    returns a hash of text's words, normalized and sorted. texts that differ
+    only in case, punctuation or word order have the same fingerprint.
+    """
+    return hash(' '.join(sorted(_normalized(text).words)))
+
+
+def _normalized(text):
+    if isinstance(text, NormalizedText):
+        return text
+    return normalized_text(text)
+
+
 def test_anagram(one, two):
     """
-    most basic test, finds if tweets are just identical
+    most basic test, finds if tweets are just identical.
+    one and two may be strings or NormalizedText.
     """
+    one = _normalized(one)
+    two = _normalized(two)
     if not _char_diff_test(one, two):
         return False
     if not _word_diff_test(one, two):
@@ -171,18 +386,14 @@ def _char_diff_test(one, two, cutoff=0.3):
     """
     basic test, looks for similarity on a char by char basis
     """
-    stripped_one = stripped_string(one)
-    stripped_two = stripped_string(two)
+    stripped_one = _normalized(one).chars
+    stripped_two = _normalized(two).chars
 
     total_chars = len(stripped_two)
-    same_chars = 0
-
     if not total_chars or len(stripped_one) != len(stripped_two):
         return False
 
-    for i in range(total_chars):
-        if stripped_one[i] == stripped_two[i]:
-            same_chars += 1
+    same_chars = sum(map(eq, stripped_one, stripped_two))
     if (float(same_chars) / total_chars) < cutoff:
         return True
     return False
@@ -192,19 +403,13 @@ def _word_diff_test(one, two, cutoff=0.3):
     """
     looks for tweets containing the same words in different orders
     """
-    words_one = stripped_string(one, spaces=True).split()
-    words_two = stripped_string(two, spaces=True).split()
+    words_one = _normalized(one).words
+    words_two = _normalized(two)
 
-    word_count = len(words_one)
-    same_words = 0
-
-    if len(words_two) < len(words_one):
-            word_count = len(words_two)
-        # compare words to each other:
-    for word in words_one:
-        if word in words_two:
-            same_words += 1
-        # if more then $CUTOFF words are the same, fail test
+    word_count = min(len(words_one), len(words_two.words))
+    # compare words to each other:
+    same_words = sum(1 for word in words_one if word in words_two.word_set)
+    # if more then $CUTOFF words are the same, fail test
     if (float(same_words) / word_count) < cutoff:
         return True
     else:
@@ -216,25 +421,24 @@ def _combined_words_test(one, two, cutoff=0.5):
     looks for tweets where the same words have been #CombinedWithoutSpaces
 
     """
-    words_one = stripped_string(one, spaces=True).split()
-    words_two = stripped_string(two, spaces=True).split()
+    words_one = _normalized(one).words
+    words_two = _normalized(two).words
 
     if len(words_one) == len(words_two):
         return True
-    # print(words_one, words_two)
     more_words = words_one if len(words_one) > len(words_two) else words_two
     fewer_words = words_one if words_two == more_words else words_two
     # rejoin fewer words into a string:
     fewer_words = ' '.join(fewer_words)
 
+    # words are only ever [a-z], so a substring search is all we need
     for word in more_words:
-        if re.search(word, fewer_words):
-            fewer_words = re.sub(word, '', fewer_words, count=1)
+        if word in fewer_words:
+            fewer_words = fewer_words.replace(word, '', 1)
 
     # this leaves us, hopefully, with a smoking hulk of non-string.
     more_string = ''.join(more_words)
-    fewer_words = re.sub(' ', '', fewer_words)
-    more_string = re.sub(' ', '', more_string)
+    fewer_words = fewer_words.replace(' ', '')
     if (len(fewer_words)/float(len(more_string))) > cutoff:
         return True
     else:
@@ -246,22 +450,115 @@ def one_test_to_rule_them(one, two, cutoff=0.8, stop=False):
     searches s2 for words from s1, removing them where found.
     repeats in the opposite order on pass.
     """
-    s1 = sorted(stripped_string(one, spaces=True).split(),
+    one = _normalized(one)
+    two = _normalized(two)
+    s2 = two.spaced
+    for word in one.words_by_length:
+        if len(word) > 2 and word in s2:
+            s2 = s2.replace(word, '', 1)
+    s1_length = len(one.chars)
+    s2_length = len(s2) - s2.count(' ')
+
+    if float(s2_length)/s1_length < cutoff:
+        return False
+    else:
+        if stop:
+            return True
+        return one_test_to_rule_them(two, one, stop=True)
+
+
+def _regex_test_anagram(one, two):
+    """
+    the original regex based implementation of test_anagram.
+    kept as a reference for tests and benchmarks.
+    """
+    if not _regex_char_diff_test(one, two):
+        return False
+    if not _regex_word_diff_test(one, two):
+        return False
+    if not _regex_combined_words_test(one, two):
+        return False
+    if not _regex_one_test_to_rule_them(one, two):
+        return False
+    return True
+
+
+def _regex_char_diff_test(one, two, cutoff=0.3):
+    stripped_one = _regex_stripped_string(one)
+    stripped_two = _regex_stripped_string(two)
+
+    total_chars = len(stripped_two)
+    same_chars = 0
+
+    if not total_chars or len(stripped_one) != len(stripped_two):
+        return False
+
+    for i in range(total_chars):
+        if stripped_one[i] == stripped_two[i]:
+            same_chars += 1
+    if (float(same_chars) / total_chars) < cutoff:
+        return True
+    return False
+
+
+def _regex_word_diff_test(one, two, cutoff=0.3):
+    words_one = _regex_stripped_string(one, spaces=True).split()
+    words_two = _regex_stripped_string(two, spaces=True).split()
+
+    word_count = len(words_one)
+    same_words = 0
+
+    if len(words_two) < len(words_one):
+        word_count = len(words_two)
+    for word in words_one:
+        if word in words_two:
+            same_words += 1
+    if (float(same_words) / word_count) < cutoff:
+        return True
+    else:
+        return False
+
+
+def _regex_combined_words_test(one, two, cutoff=0.5):
+    words_one = _regex_stripped_string(one, spaces=True).split()
+    words_two = _regex_stripped_string(two, spaces=True).split()
+
+    if len(words_one) == len(words_two):
+        return True
+    more_words = words_one if len(words_one) > len(words_two) else words_two
+    fewer_words = words_one if words_two == more_words else words_two
+    fewer_words = ' '.join(fewer_words)
+
+    for word in more_words:
+        if re.search(word, fewer_words):
+            fewer_words = re.sub(word, '', fewer_words, count=1)
+
+    more_string = ''.join(more_words)
+    fewer_words = re.sub(' ', '', fewer_words)
+    more_string = re.sub(' ', '', more_string)
+    if (len(fewer_words)/float(len(more_string))) > cutoff:
+        return True
+    else:
+        return False
+
+
+def _regex_one_test_to_rule_them(one, two, cutoff=0.8, stop=False):
+    s1 = sorted(_regex_stripped_string(one, spaces=True).split(),
                 key=len,
                 reverse=True)
-    s2 = stripped_string(two, spaces=True)
+    s2 = _regex_stripped_string(two, spaces=True)
     for word in s1:
         if len(word) > 2 and re.search(word, s2):
             s2 = re.sub(word, '', s2, count=1)
     s1 = ''.join(s1)
-    s2 = stripped_string(s2, spaces=False)
+    s2 = _regex_stripped_string(s2, spaces=False)
 
     if float(len(s2))/len(s1) < cutoff:
         return False
     else:
         if stop:
             return True
-        return one_test_to_rule_them(two, one, stop=True)
+        return _regex_one_test_to_rule_them(two, one, stop=True)
 
 
 def grade_anagram(hit):
@@ -294,8 +591,18 @@ def format_seconds(seconds):
 
 def stripped_string(text, spaces=False):
     """
-    returns lower case string with all non alpha chars removed
+    returns lower case string with all non alpha chars removed.
+    if spaces is True, spaces are kept, and dashes and underbars become spaces.
     """
+    text = text.encode('ascii', 'ignore')
+    if spaces:
+        return text.translate(_SPACED_LOWERCASE_TABLE).translate(
+            None, _NON_LETTER_OR_SPACE_BYTES).decode('ascii')
+    return text.translate(_LOWERCASE_TABLE, _NON_LETTER_BYTES).decode('ascii')
+
+
+def _regex_stripped_string(text, spaces=False):
+    """the original regex based stripped_string, used by the reference tests."""
     if spaces:
         text = re.sub(r'[_-]', ' ', text)  # replace dashes and underbars
         return re.sub(r'[^a-zA-Z ]', '', text).lower()
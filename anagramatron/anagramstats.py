@@ -34,10 +34,13 @@ class StatTracker(object):
             ((self['possible_hits'] + self['fetch_pool_size'] + self['cache_hits']) or 1)
             ) * 100
         status = "seen %s, used (%0.1f%%), hits %s, cache hits (%0.1f%%), \
-agrams %d, cachesize %s, buffer %d, runtime %s" % (
+agrams %d, cachesize %s, dups %s, buffer %d%s, runtime %s" % (
             format_number(self['tweets_seen']), seen_perc,
             format_number(self['possible_hits'] + self['fetch_pool_size']),
-            cache_hit_perc, self['hits'], format_number(self['cache_size']), self['buffer'],
+            cache_hit_perc, self['hits'], format_number(self['cache_size']),
+            format_number(self['duplicates_dropped']), self['buffer'],
+            ' (shedding, %s shed)' % format_number(self['tweets_shed'])
+            if self['overloaded'] else '',
             anagramfunctions.format_seconds(runtime)
             )
         return status
@@ -46,12 +49,35 @@ agrams %d, cachesize %s, buffer %d, runtime %s" % (
         sys.stdout.write('%s\r' % str(self))
         sys.stdout.flush()
 
+    def most_duplicated(self, count=10):
+        """returns up to count (anagram key, duplicates dropped) pairs, most first."""
+        counts = self['duplicates_by_key'] or dict()
+        return sorted(counts.items(), key=lambda item: item[1], reverse=True)[:count]
+
     def stats_dict(self):
         return {
             'tweets_seen': self['tweets_seen'],
             'passed_filter': self['passed_filter'],
             'possible_hits': self['possible_hits'],
             'hits': self['hits'],
+            'cache_trims': self['cache_trims'],
+            'cache_evictions': self['cache_evictions'],
+            'cache_bytes': self['cache_bytes'],
+            'duplicates_dropped': self['duplicates_dropped'],
+            'filter_workers': self['filter_workers'] or [],
+            'overloaded': self['overloaded'],
+            'overload_episodes': self['overload_episodes'],
+            'overload_seconds': self['overload_seconds'],
+            'tweets_shed': self['tweets_shed'],
+            'probes_skipped': self['probes_skipped'],
+            'chunks_archived': self['chunks_archived'],
+            'datastore_keys': self['datastore_keys'],
+            'store_lookups': self['store_lookups'],
+            'store_hits': self['store_hits'],
+            'chunk_probes': self['chunk_probes'],
+            'chunk_hit_rates': self['chunk_hit_rates'] or dict(),
+            'last_compaction': self['last_compaction'] or None,
+            'most_duplicated': self.most_duplicated(),
             'start_time': self.start_time
         }
 
@@ -0,0 +1,83 @@
+from __future__ import print_function
+import hashlib
+import math
+import os
+import struct
+
+_MAGIC = b'ABF1'
+_HEADER = struct.Struct('<4sQB')
+
+
+def key_digest(key):
+    """returns a 64 bit integer digest of a str or bytes key."""
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+class BloomFilter(object):
+    """
+    a fixed size bloom filter over str or bytes keys.
+    a negative answer is definite; a positive one is wrong roughly
+    error_rate of the time, once capacity keys have been added.
+
+    lookups take either a key or a digest from key_digest(), so one digest
+    can be shared between several filters.
+    """
+
+    def __init__(self, capacity, error_rate=0.01, bit_count=None, hash_count=None, bits=None):
+        if bit_count is None:
+            bit_count = int(-capacity * math.log(error_rate) / (math.log(2) ** 2)) or 8
+        if hash_count is None:
+            hash_count = max(1, int(round(bit_count / float(capacity or 1) * math.log(2))))
+        self.bit_count = bit_count
+        self.hash_count = hash_count
+        self._bits = bits if bits is not None else bytearray((bit_count + 7) // 8)
+
+    def __contains__(self, key):
+        return self.might_contain(key_digest(key))
+
+    def _positions(self, digest):
+        # double hashing; the high half is forced odd so positions differ.
+        low, high = digest & 0xffffffff, (digest >> 32) | 1
+        bit_count = self.bit_count
+        return [(low + i * high) % bit_count for i in range(self.hash_count)]
+
+    def add(self, key=None, digest=None):
+        if digest is None:
+            digest = key_digest(key)
+        bits = self._bits
+        for pos in self._positions(digest):
+            bits[pos >> 3] |= 1 << (pos & 7)
+
+    def might_contain(self, digest):
+        bits = self._bits
+        for pos in self._positions(digest):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def to_bytes(self):
+        return _HEADER.pack(_MAGIC, self.bit_count, self.hash_count) + bytes(self._bits)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, bit_count, hash_count = _HEADER.unpack_from(data)
+        if magic != _MAGIC:
+            raise ValueError('not a bloom filter')
+        bits = bytearray(data[_HEADER.size:])
+        if len(bits) != (bit_count + 7) // 8:
+            raise ValueError('truncated bloom filter')
+        return cls(0, bit_count=bit_count, hash_count=hash_count, bits=bits)
+
+    def save(self, path):
+        """writes the filter to path, via a temporary file."""
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'wb') as f:
+            f.write(self.to_bytes())
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read())
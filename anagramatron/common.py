@@ -22,13 +22,25 @@ ANAGRAM_BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pa
 ANAGRAM_SEC_DIR = os.path.join(ANAGRAM_BASE_DIR, 'sec')
 
 ANAGRAM_CACHE_SIZE = 200000
-ANAGRAM_STREAM_BUFFER_SIZE = 20000
+ANAGRAM_CACHE_BYTES = None  # estimated bytes; None for no limit
+ANAGRAM_WARM_BYTES = 0  # recent datastore entries read into memory at startup; 0 to skip
+ANAGRAM_STREAM_BUFFER_SIZE = 20000  # backlog above which we shed load
+ANAGRAM_OVERLOAD_POLICIES = ('cache_only', 'sample')
+ANAGRAM_BATCH_SIZE = 500
+ANAGRAM_FILTER_WORKERS = 1  # stream filter processes
+ANAGRAM_BUCKET_SIZE = 1  # candidates kept per anagram key
+ANAGRAM_DUPLICATE_KEYS = 50000  # keys whose recent candidates are fingerprinted
+ANAGRAM_COMPRESS_RECORDS = False  # deflate tweet text in the datastore
+ANAGRAM_KEY_INDEX = True  # keep a 64 bit digest of every datastore key in memory
+# datastore keys kept before the oldest chunks are archived, split between shards
+ANAGRAM_RETENTION_MAX_KEYS = 20000000
 
 ANAGRAM_LOW_CHAR_CUTOFF = 16
 ANAGRAM_LOW_UNIQUE_CHAR_CUTOFF = 11
 ANAGRAM_ALPHA_RATIO_CUTOFF = 0.85
 
 ANAGRAM_POST_INTERVAL = 150  # minutes
+ANAGRAM_ENRICHMENT_WORKERS = 2  # threads fetching the tweets in new hits
 
 # STORAGE_DIRECTORY_PATH = 'data/'
 
@@ -0,0 +1,65 @@
+# coding: utf-8
+from __future__ import print_function
+from collections import OrderedDict
+
+
+class DuplicateFilter(object):
+
+    """
+    remembers the fingerprints of recent candidates for each anagram key,
+    so that repeats of them can be dropped before they are compared.
+
+    a fingerprint is a hash of the normalized, word-sorted text (see
+    anagramfunctions.text_fingerprint), so repeats with different case,
+    punctuation or word order are caught too.
+
+    :max_keys: the number of keys remembered. the least recently used key
+    is forgotten first.
+    :per_key: the number of fingerprints remembered for each key.
+
+    counts holds the number of duplicates dropped for each remembered key.
+    """
+
+    def __init__(self, max_keys=50000, per_key=4):
+        self.max_keys = max_keys
+        self.per_key = per_key
+        self.counts = dict()
+        self._fingerprints = OrderedDict()
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+    def is_duplicate(self, key, fingerprint):
+        """returns True, and counts it, if fingerprint is remembered for key."""
+        fingerprints = self._fingerprints.get(key)
+        if fingerprints is None or fingerprint not in fingerprints:
+            return False
+        self._fingerprints.move_to_end(key)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        return True
+
+    def add(self, key, fingerprint):
+        """remembers fingerprint for key."""
+        fingerprints = self._fingerprints.get(key)
+        if fingerprints is None:
+            fingerprints = self._fingerprints[key] = []
+            if len(self._fingerprints) > self.max_keys:
+                old_key, _ = self._fingerprints.popitem(last=False)
+                self.counts.pop(old_key, None)
+        else:
+            self._fingerprints.move_to_end(key)
+            if fingerprint in fingerprints:
+                fingerprints.remove(fingerprint)
+        fingerprints.append(fingerprint)
+        if len(fingerprints) > self.per_key:
+            del fingerprints[0]
+
+    def discard(self, key, fingerprint):
+        """forgets fingerprint for key, if it is remembered."""
+        fingerprints = self._fingerprints.get(key)
+        if fingerprints is not None and fingerprint in fingerprints:
+            fingerprints.remove(fingerprint)
+
+    def most_duplicated(self, count=10):
+        """returns up to count (key, duplicates) pairs, most duplicates first."""
+        return sorted(self.counts.items(), key=lambda item: item[1], reverse=True)[:count]
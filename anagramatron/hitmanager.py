@@ -3,14 +3,15 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import sqlite3 as lite
+import logging
 import os
+import threading
 import time
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from .anagramstats import StatTracker
 
-from twitter.api import TwitterError
-
-from . import anagramfunctions, twitterhandler, common
+from . import anagramfunctions, common
 
 HIT_STATUS_REVIEW = 'review'
 HIT_STATUS_SEEN = 'seen'
@@ -19,6 +20,22 @@ HIT_STATUS_POSTED = 'posted'
 HIT_STATUS_APPROVED = 'approved'
 HIT_STATUS_FAILED = 'failed'
 
+ENRICHMENT_PENDING = 'enrichment_pending'
+ENRICHMENT_DONE = 'enriched'
+ENRICHMENT_FAILED = 'enrichment_failed'  # gave up; the hit is kept without fetched tweets
+ENRICHMENT_MISSING = 'missing'  # a tweet was deleted, and the hit removed
+
+# also applied to existing databases, which predate it
+ENRICHMENT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS enrichment (
+    hit_id integer primary key,
+    state text not null,
+    attempts integer not null default 0,
+    next_attempt real not null);
+
+CREATE INDEX IF NOT EXISTS enrichment_due ON enrichment (state, next_attempt);
+"""
+
 
 class HitDBManager(object):
 
@@ -32,20 +49,47 @@ class HitDBManager(object):
         super(HitDBManager, self).__init__()
         self.dbpath = os.path.join(common.ANAGRAM_DATA_DIR, dbpath)
         self.hitsdb = self._setup()
-        self.twitter_handler = twitterhandler.TwitterHandler()
         self.hits_counter = 0
         self._testing = _testing
+        self._twitter_handler = None
+        self.enricher = None
         self.stats = StatTracker()
 
     def _setup(self):
         if os.path.exists(self.dbpath):
-            return lite.connect(self.dbpath)
+            db = lite.connect(self.dbpath)
         else:
             with open(self.SQL_SCHEMA, 'r') as f:
                 db = lite.connect(self.dbpath)
                 db.cursor().executescript(f.read())
-                db.commit()
-                return db
+        db.cursor().executescript(ENRICHMENT_SCHEMA)
+        db.commit()
+        return db
+
+    @property
+    def twitter_handler(self):
+        if self._twitter_handler is None:
+            from . import twitterhandler
+            self._twitter_handler = twitterhandler.TwitterHandler()
+        return self._twitter_handler
+
+    def start_enrichment(self, workers=common.ANAGRAM_ENRICHMENT_WORKERS, fetch=None, **kwargs):
+        """
+        starts fetching the tweets in new hits in the background.
+        fetch defaults to TwitterHandler.fetch_tweet; see HitEnricher.
+        """
+        if fetch is None:
+            fetch = self.twitter_handler.fetch_tweet
+        self.enricher = HitEnricher(self.dbpath, fetch, workers=workers, stats=self.stats,
+                                    **kwargs)
+        self.enricher.start()
+        return self.enricher
+
+    def close(self):
+        if self.enricher:
+            self.enricher.stop()
+            self.enricher = None
+        self.hitsdb.close()
 
     # public API
     def new_hit(self, first, second):
@@ -61,13 +105,12 @@ class HitDBManager(object):
         if self._hit_collides_with_previous_hit(hit):
             return
         self.stats['hits'] += 1
-        try:
-            if not self._testing:
-                hit = self._fetch_hit_tweets(hit)
-            self.hits_counter += 1
-            self._add_hit(hit)
-        except TwitterError:
-            print('tweet missing, will pass')
+        self.hits_counter += 1
+        # tweets are fetched later, by the enricher, so finding hits
+        # never waits on twitter.
+        self._add_hit(hit)
+        if self.enricher:
+            self.enricher.wake()
 
     def all_hits(self, with_status=None, max_id=MAX_HIT_ID, result_count=None):
         query = "SELECT * FROM hits WHERE hit_id < :hit_id"
@@ -120,6 +163,8 @@ class HitDBManager(object):
         cursor = self.hitsdb.cursor()
         cursor.execute("DELETE FROM hits WHERE hit_id=:id",
                        {"id": str(hit_id)})
+        cursor.execute("DELETE FROM enrichment WHERE hit_id=:id",
+                       {"id": str(hit_id)})
         self.hitsdb.commit()
 
     def seen_hits(self, hit_ids):
@@ -201,6 +246,8 @@ class HitDBManager(object):
                         repr(hit['tweet_one']),
                         repr(hit['tweet_two'])
                         ))
+        cursor.execute("INSERT OR REPLACE INTO enrichment VALUES (?,?,0,?)",
+                       (str(hit['id']), ENRICHMENT_PENDING, time.time()))
         self.hitsdb.commit()
 
     def _hit_collides_with_previous_hit(self, hit):
@@ -225,23 +272,6 @@ class HitDBManager(object):
                 'tweet_two': eval(item[5])
                 }
 
-    # twitter stuff:
-
-    def _fetch_hit_tweets(self, hit):
-        """
-        attempts to fetch tweets in hit.
-        if successful builds up more detailed hit object.
-        returns the input hit unchaged on failure
-        """
-
-        t1 = self.twitter_handler.fetch_tweet(hit['tweet_one']['tweet_id'])
-        t2 = self.twitter_handler.fetch_tweet(hit['tweet_two']['tweet_id'])
-        if t1 and t2:
-            hit['tweet_one']['fetched'] = self._cleaned_tweet(t1)
-            hit['tweet_two']['fetched'] = self._cleaned_tweet(t2)
-
-        return hit
-
     def dump_json(self, filename='hit_export.json'):
         """exports all hits as json"""
         import json
@@ -253,19 +283,154 @@ class HitDBManager(object):
         hits = self.all_hits()
         json.dump(hits, open(filename, 'wb'))
 
-    def _cleaned_tweet(self, tweet):
+
+class HitEnricher(object):
+    """
+    fetches the tweets in new hits from twitter, away from the thread
+    finding them, and adds what it gets to the stored hits.
+
+    each hit waiting on its tweets has a row in the enrichment table.
+    a thread takes batches of rows that are due, fetches their tweets with
+    a pool of worker threads, and writes the results in one transaction.
+    failed fetches are retried, waiting backoff * 2 ** attempts seconds,
+    up to max_attempts times. hits with a deleted tweet are removed.
+
+    :fetch: a function taking a tweet id and returning the tweet as a dict.
+    it should return something falsy or raise for a failure worth retrying,
+    and raise an error with a 404 code (as twitter and urllib errors do)
+    if the tweet is gone.
+    """
+
+    def __init__(self, dbpath, fetch, workers=common.ANAGRAM_ENRICHMENT_WORKERS,
+                 batch_size=20, max_attempts=6, backoff=30, poll_interval=10, stats=None):
+        super(HitEnricher, self).__init__()
+        self.dbpath = dbpath
+        self.fetch = fetch
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.stats = stats if stats is not None else StatTracker()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wake(self):
+        """checks for due hits now, instead of at the next poll."""
+        self._wake.set()
+
+    def stop(self):
+        self._stopping = True
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        # sqlite connections belong to the thread that made them
+        db = lite.connect(self.dbpath)
+        pool = ThreadPoolExecutor(self.workers)
+        try:
+            while not self._stopping:
+                self._wake.clear()
+                try:
+                    if self.enrich_due(db, pool):
+                        continue
+                except lite.Error as err:
+                    logging.error('error enriching hits: %s' % err)
+                self._wake.wait(self.poll_interval)
+        finally:
+            pool.shutdown()
+            db.close()
+
+    def enrich_due(self, db, pool):
+        """fetches tweets for one batch of due hits. returns the number of hits tried."""
+        cursor = db.cursor()
+        cursor.execute("SELECT e.hit_id, e.attempts, h.tweet_one, h.tweet_two "
+                       "FROM enrichment e JOIN hits h ON h.hit_id = e.hit_id "
+                       "WHERE e.state = ? AND e.next_attempt <= ? "
+                       "ORDER BY e.next_attempt LIMIT ?",
+                       (ENRICHMENT_PENDING, time.time(), self.batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            return 0
+
+        now = time.time()
+        fetched, states, removed = [], [], []
+        for (hit_id, attempts, _, _), tweets in zip(rows, pool.map(self._fetch_hit, rows)):
+            if tweets == ENRICHMENT_MISSING:
+                removed.append((hit_id,))
+                states.append((ENRICHMENT_MISSING, now, hit_id))
+                self.stats['hits_missing'] += 1
+            elif tweets:
+                fetched.append((repr(tweets[0]), repr(tweets[1]), hit_id))
+                states.append((ENRICHMENT_DONE, now, hit_id))
+                self.stats['hits_enriched'] += 1
+            elif attempts + 1 >= self.max_attempts:
+                states.append((ENRICHMENT_FAILED, now, hit_id))
+            else:
+                states.append((ENRICHMENT_PENDING, now + self.backoff * 2 ** attempts, hit_id))
+                self.stats['enrichment_retries'] += 1
+
+        with db:
+            db.executemany("UPDATE hits SET tweet_one = ?, tweet_two = ? WHERE hit_id = ?",
+                           fetched)
+            db.executemany("DELETE FROM hits WHERE hit_id = ?", removed)
+            db.executemany("UPDATE enrichment SET state = ?, attempts = attempts + 1, "
+                           "next_attempt = ? WHERE hit_id = ?", states)
+        return len(rows)
+
+    def _fetch_hit(self, row):
         """
-        returns a dict of desirable twitter info
+        returns the hit's two tweets with fetched info added, ENRICHMENT_MISSING
+        if either is gone, or None if fetching should be retried.
         """
-        twict = dict()
-        twict['text'] = anagramfunctions.correct_encodings(tweet.get('text'))
-        twict['user'] = {
-            'name': tweet.get('user').get('name'),
-            'screen_name': tweet.get('user').get('screen_name'),
-            'profile_image_url': tweet.get('user').get('profile_image_url')
-        }
-        twict['created_at'] = tweet.get('created_at')
-        return twict
+        _, _, tweet_one, tweet_two = row
+        tweets = [eval(tweet_one), eval(tweet_two)]
+        fetched = []
+        for tweet in tweets:
+            try:
+                result = self.fetch(tweet['tweet_id'])
+            except Exception as err:
+                if _is_missing(err):
+                    return ENRICHMENT_MISSING
+                logging.debug('error fetching tweet %s: %s' % (tweet['tweet_id'], err))
+                return None
+            if not result:
+                return None
+            fetched.append(result)
+
+        for tweet, result in zip(tweets, fetched):
+            tweet['fetched'] = _cleaned_tweet(result)
+        return tweets
+
+
+def _is_missing(err):
+    """True if err is a 404, from urllib or from the twitter module (which wraps it)."""
+    if getattr(err, 'code', None) == 404:
+        return True
+    return getattr(getattr(err, 'e', None), 'code', None) == 404
+
+
+def _cleaned_tweet(tweet):
+    """
+    returns a dict of desirable twitter info
+    """
+    twict = dict()
+    twict['text'] = anagramfunctions.correct_encodings(tweet.get('text'))
+    twict['user'] = {
+        'name': tweet.get('user').get('name'),
+        'screen_name': tweet.get('user').get('screen_name'),
+        'profile_image_url': tweet.get('user').get('profile_image_url')
+    }
+    twict['created_at'] = tweet.get('created_at')
+    return twict
 
 
 def main():
@@ -0,0 +1,124 @@
+from __future__ import print_function
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+
+_MAGIC = b'AKI1'
+_HEADER = struct.Struct('<4sQ')
+# changes are kept in sets until there are this many, then merged
+_MERGE_SIZE = 1 << 16
+
+
+class KeyIndex(object):
+    """
+    the set of key digests (from bloomfilter.key_digest) in one datastore chunk.
+
+    digests are kept in a sorted array of 64 bit ints, 8 bytes a key.
+    new digests go in a small set, and removed ones in another, which are
+    merged into the array in one pass once they hold _MERGE_SIZE between them,
+    so adding and removing are cheap while a chunk is filling.
+    digests are 64 bits, so a positive answer is wrong about once in 2**64 / keys.
+    """
+
+    def __init__(self, digests=None):
+        self._sorted = array('Q', sorted(digests) if digests is not None else ())
+        self._recent = set()
+        # digests still in _sorted that have been removed
+        self._removed = set()
+
+    def __len__(self):
+        return len(self._sorted) + len(self._recent) - len(self._removed)
+
+    def __contains__(self, digest):
+        if digest in self._recent:
+            return True
+        if digest in self._removed:
+            return False
+        return self._in_sorted(digest)
+
+    def _in_sorted(self, digest):
+        digests = self._sorted
+        i = bisect_left(digests, digest)
+        return i != len(digests) and digests[i] == digest
+
+    def add(self, digest):
+        if digest in self._removed:
+            self._removed.remove(digest)
+            return
+        if digest in self._recent or self._in_sorted(digest):
+            return
+        self._recent.add(digest)
+        self._check_merge()
+
+    def discard(self, digest):
+        if digest in self._recent:
+            self._recent.remove(digest)
+        elif digest not in self._removed and self._in_sorted(digest):
+            self._removed.add(digest)
+            self._check_merge()
+
+    def _check_merge(self):
+        if len(self._recent) + len(self._removed) >= _MERGE_SIZE:
+            self._merge()
+
+    def _merge(self):
+        """
+        applies the added and removed digests to the sorted array in one pass.
+        runs of the old array between changes are copied as slices.
+        """
+        if not self._recent and not self._removed:
+            return
+        old = self._sorted
+        # (position in old, 0 to insert digest there or 1 to drop old[position], digest);
+        # inserts sort before a drop at the same position, which is the larger digest.
+        changes = [(bisect_left(old, d), 0, d) for d in self._recent]
+        changes.extend((bisect_left(old, d), 1, d) for d in self._removed)
+        changes.sort()
+        merged = array('Q')
+        start = 0
+        for position, drop, digest in changes:
+            merged.extend(old[start:position])
+            if drop:
+                start = position + 1
+            else:
+                merged.append(digest)
+                start = position
+        merged.extend(old[start:])
+        self._sorted = merged
+        self._recent = set()
+        self._removed = set()
+
+    def to_bytes(self):
+        self._merge()
+        digests = self._sorted
+        if sys.byteorder != 'little':
+            digests = array('Q', digests)
+            digests.byteswap()
+        return _HEADER.pack(_MAGIC, len(digests)) + digests.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, count = _HEADER.unpack_from(data)
+        if magic != _MAGIC:
+            raise ValueError('not a key index')
+        index = cls()
+        if len(data) - _HEADER.size != count * index._sorted.itemsize:
+            raise ValueError('truncated key index')
+        index._sorted.frombytes(data[_HEADER.size:])
+        if sys.byteorder != 'little':
+            index._sorted.byteswap()
+        return index
+
+    def save(self, path):
+        """writes the index to path, via a temporary file."""
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'wb') as f:
+            f.write(self.to_bytes())
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read())
@@ -5,79 +5,326 @@ import os
 import time
 import re
 import logging
-import sys
-from stat import ST_CTIME
+import dbm
+import threading
+from array import array
+from collections import OrderedDict
+from itertools import islice
+from stat import ST_CTIME, ST_MTIME
 
-from . import anagramfunctions
+from . import common
+from .bloomfilter import BloomFilter, key_digest
+from .keyindex import KeyIndex
+from .anagramstats import StatTracker
+from .storage import StorageBackend, encode_value, decode_value, lookup_latency
 
 _METADATA_FILE = 'meta.p'
+_FILTERS_DIR = 'filters'
+_FILTER_ERROR_RATE = 0.01
 _PATHKEY = 'X43q2smxlkFJ28h$@3xGN'  # gurrenteed unlikely!!
+# lookups between updates of the chunk probe order
+_REORDER_INTERVAL = 10000
+# the number of keys whose chunk is remembered after a lookup finds them
+_LOCATION_CACHE_SIZE = 10000
+# compaction releases its lock between slices of this many keys
+_COMPACT_SLICE_SIZE = 1000
+_COMPACT_TEMP_FILE = 'compacting.tmp'
+_UNCHANGED = object()
 
 
-class MultiDBM(object):
+class MultiDBM(StorageBackend):
     """
     MultiDBM acts as a wrapper around multiple DBM files
     as data retrieval becomes too slow older files are archived.
+
+    each chunk has a bloom filter of its keys, saved in the filters directory,
+    so that lookups can skip chunks that certainly don't hold a key.
+    chunks without a filter are always probed.
+
+    :key_index: if True, the digests of every key are also kept in memory,
+    in a KeyIndex per chunk, so a lookup reads at most the one chunk that
+    holds the key. indexes are saved beside the filters; a chunk whose
+    index is missing is probed by its filter until --build-filters is run.
+
+    the metadata file keeps the number of keys in each chunk, and when it
+    was created and sealed (stopped taking new keys). enforce_retention
+    archives the oldest chunks that fall outside a RetentionPolicy.
+
+    chunks are probed in order of how many recent lookups they answered,
+    newest first when that's even. the chunk a key was found in is
+    remembered for a while, so deleting it goes straight there.
+
+    compact merges sealed chunks into one, keeping the newest copy of
+    each key, while the store stays in use.
     """
 
-    def __init__(self, path, chunk_size=2000000):
+    def __init__(self, path, chunk_size=2000000, compress=common.ANAGRAM_COMPRESS_RECORDS,
+                 key_index=common.ANAGRAM_KEY_INDEX):
         self._data = []
+        self._names = []
+        self._filters = []
+        self._indexes = []
+        self._key_index = key_index
+        # lookups answered by each chunk since the probe order was last updated
+        self._hits = []
+        self._probe_order = None
+        self._lookups = 0
+        self._locations = OrderedDict()
+        # names of the chunks being compacted. they aren't written while it
+        # runs; changes to their keys are kept here (None for a deleted key),
+        # and applied to the merged chunk.
+        self._compacting = None
+        self._compact_changes = dict()
+        self.stats = StatTracker()
         self._metadata = dict()
         self._path = path
         self._section_size = chunk_size
+        self._compress = compress
         self._setup()
 
     def __contains__(self, item):
-        for db in self._data:
-            if item in db:
+        for position in self._positions_for_key(item):
+            if self._read(position, item) is not None:
+                self._remember_location(item, position)
                 return True
         return False
 
     def __getitem__(self, key):
-        for db in self._data:
-            if key in db:
-                val = db[key].decode('utf-8')
-                # this is kinda gross
-                try:
-                    val = anagramfunctions.decode_tweet(val)
-                except:
-                    pass
-                return val
-        raise KeyError
+        val = self.get(key)
+        if val is None:
+            raise KeyError(key)
+        return val
+
+    def get(self, key, default=None):
+        """
+        returns the value for key, or default if it isn't found.
+        unlike `key in self` followed by `self[key]`, probes each chunk once.
+        """
+        return self.get_with_location(key, default)[0]
+
+    def get_with_location(self, key, default=None):
+        """
+        returns (value, position) for key, where position is the index of
+        the chunk holding it, oldest first. returns (default, None) if key
+        isn't found. each chunk that might hold key is probed once.
+        """
+        self._lookups += 1
+        if self._lookups % _REORDER_INTERVAL == 0:
+            self._update_probe_order()
+        self.stats['store_lookups'] += 1
+        for position in self._positions_for_key(key):
+            self.stats['chunk_probes'] += 1
+            val = self._read(position, key)
+            if val is not None:
+                self._hits[position] += 1
+                self.stats['store_hits'] += 1
+                self._remember_location(key, position)
+                return decode_value(val, key), position
+        return default, None
+
+    def _remember_location(self, key, position):
+        self._locations[key] = self._names[position]
+        self._locations.move_to_end(key)
+        if len(self._locations) > _LOCATION_CACHE_SIZE:
+            self._locations.popitem(last=False)
+
+    def _update_probe_order(self):
+        """
+        orders chunk positions by the lookups they answered since the last
+        update, most first, with ties going to the newer chunk.
+        """
+        order = sorted(range(len(self._data)), key=lambda i: (self._hits[i], i), reverse=True)
+        lookups = (self._lookups % _REORDER_INTERVAL) or _REORDER_INTERVAL
+        self.stats['chunk_hit_rates'] = dict(
+            (self._names[i], self._hits[i] / float(lookups)) for i in order)
+        self._hits = [0] * len(self._data)
+        self._probe_order = order
 
     def __setitem__(self, key, value):
-        i = 0
         if self._metadata['cursize'] == self._section_size:
             self._add_db()
-        last_db = len(self._data) - 1
-        for db in self._data:
-            if key in db or i == last_db:
-                if i == last_db and key not in db:
-                    self._metadata['totsize'] += 1
-                    self._metadata['cursize'] += 1
-                # logging.debug('adding key to file # %i' % i)
-                if isinstance(value, dict):
-                    value = anagramfunctions.encode_tweet(value)
-                db[key] = value
+        value = encode_value(value, key, self._compress)
+        digest = key_digest(key)
+        last_db = self._data[-1]
+        last = len(self._data) - 1
+        for position in self._positions_for_key(key, digest):
+            if position != last and self._read(position, key) is not None:
+                if self._is_compacting(position):
+                    self._compact_changes[key] = value
+                else:
+                    self._data[position][key] = value
                 return
-            i += 1
+        if key not in last_db:
+            self._metadata['totsize'] += 1
+            self._metadata['cursize'] += 1
+            self._chunk_info(-1)['keys'] += 1
+            if self._filters[-1] is not None:
+                self._filters[-1].add(digest=digest)
+            if self._indexes[-1] is not None:
+                self._indexes[-1].add(digest)
+        # logging.debug('adding key to file # %i' % i)
+        last_db[key] = value
 
     def __delitem__(self, key):
-        for db in self._data:
-            if key in db:
-                del db[key]
-                self._metadata['totsize'] -= 1
+        digest = key_digest(key)
+        name = self._locations.pop(key, None)
+        if name in self._names:
+            position = self._names.index(name)
+            if self._read(position, key) is not None:
+                self._delete(key, digest, position)
+                return
+        for position in self._positions_for_key(key, digest):
+            if self._read(position, key) is not None:
+                self._delete(key, digest, position)
                 return
         raise KeyError
 
+    def _delete(self, key, digest, position):
+        if self._is_compacting(position):
+            self._compact_changes[key] = None
+        else:
+            del self._data[position][key]
+        self._metadata['totsize'] -= 1
+        self._chunk_info(position)['keys'] -= 1
+        index = self._indexes[position]
+        if index is not None:
+            index.discard(digest)
+
     def __len__(self):
+        return sum(self._chunk_info(i)['keys'] for i in range(len(self._data)))
+
+    def _chunk_info(self, index):
+        """returns the metadata dict for the chunk at index."""
+        return self._metadata['chunks'][self._names[index]]
+
+    def chunk_stats(self):
         """
-        length calculations are estimates since we assume
-        all non-current chunks are at capacity.
-        In reality some keys will likely get deleted.
+        returns a dict for each chunk, oldest first, with its name, key count,
+        size in bytes, and the times it was created and sealed.
         """
-        return (self._section_size * len(self._data)-1 +
-                self._metadata['cursize'])
+        stats = []
+        for i, name in enumerate(self._names):
+            info = dict(self._chunk_info(i), name=name)
+            try:
+                info['bytes'] = os.path.getsize(os.path.join(self._path, name))
+            except OSError:
+                info['bytes'] = 0
+            stats.append(info)
+        return stats
+
+    def enforce_retention(self, policy, lock=None):
+        """
+        archives the oldest chunks until the store is within policy.
+        the current chunk is never archived. returns the archived paths.
+
+        lock is held only while the chunks are taken out of the store;
+        they are closed and moved to the archive after it is released.
+        if a chunk can't be moved, OSError is raised. the chunks not yet
+        moved stay in the store's directory and metadata, and are loaded
+        again when the store is next opened.
+        """
+        lock = lock or threading.Lock()
+        with lock:
+            if not policy or self._compacting is not None:
+                return []
+            detached = [self._detach_old()
+                        for _ in range(policy.expired_count(self.chunk_stats()))]
+        archived = []
+        for i, (db, filename, _) in enumerate(detached):
+            try:
+                archived.append(self._archive_chunk(db, filename))
+            except OSError:
+                for db, _, _ in detached[i + 1:]:
+                    db.close()
+                with lock:
+                    for _, filename, info in detached[i:]:
+                        self._metadata['chunks'][filename] = info
+                raise
+        return archived
+
+    def items(self):
+        """iterates over all (key, value) pairs, oldest chunk first."""
+        for key, value in self._chunk_items(range(len(self._data))):
+            yield key, decode_value(value, key)
+
+    def recent_items(self):
+        """iterates over (key, encoded value) pairs, newest chunk first."""
+        return self._chunk_items(reversed(range(len(self._data))))
+
+    def _chunk_items(self, positions):
+        for position in positions:
+            db = self._data[position]
+            for k in _iter_keys(db):
+                key = k.decode('utf-8')
+                if key != _PATHKEY:
+                    value = self._read(position, key)
+                    if value is not None:
+                        yield key, value
+
+    def _is_compacting(self, position):
+        return self._compacting is not None and self._names[position] in self._compacting
+
+    def _read(self, position, key):
+        """
+        returns the encoded value for key in the chunk at position, or None,
+        with any change made to it since a compaction of the chunk began.
+        """
+        if self._compact_changes and self._is_compacting(position):
+            changed = self._compact_changes.get(key, _UNCHANGED)
+            if changed is not _UNCHANGED:
+                return changed
+        return self._data[position].get(key)
+
+    def _chunks_for_key(self, key, digest=None):
+        """yields the chunks that might contain key, in probe order"""
+        for position in self._positions_for_key(key, digest):
+            yield self._data[position]
+
+    def _positions_for_key(self, key, digest=None):
+        """yields the positions of the chunks that might contain key, in probe order"""
+        if digest is None:
+            digest = key_digest(key)
+        if self._probe_order is None:
+            self._update_probe_order()
+        for position in self._probe_order:
+            index = self._indexes[position]
+            if index is not None:
+                if digest in index:
+                    yield position
+            else:
+                bloom = self._filters[position]
+                if bloom is None or bloom.might_contain(digest):
+                    yield position
+
+    def _filter_path(self, name):
+        return os.path.join(self._path, _FILTERS_DIR, '%s.bloom' % name)
+
+    def _load_filter(self, name):
+        try:
+            return BloomFilter.load(self._filter_path(name))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _save_filter(self, index):
+        bloom = self._filters[index]
+        if bloom is not None:
+            bloom.save(self._filter_path(self._names[index]))
+
+    def _index_path(self, name):
+        return os.path.join(self._path, _FILTERS_DIR, '%s.keys' % name)
+
+    def _load_index(self, name):
+        if not self._key_index:
+            return None
+        try:
+            return KeyIndex.load(self._index_path(name))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _save_index(self, index):
+        key_index = self._indexes[index]
+        if key_index is not None:
+            key_index.save(self._index_path(self._names[index]))
 
     def _setup(self):
         if os.path.exists(self._path):
@@ -89,41 +336,143 @@ class MultiDBM(object):
                 print("IO error loading metadata?")
                 self._setup_metadata()
 
-            dbses = _load_paths(self._path)
+            self._metadata.setdefault('chunks', dict())
+            # order chunks by the creation times we recorded, where we have them
+            created = dict((name, info['created'])
+                           for name, info in self._metadata['chunks'].items())
+            dbses = sorted(_load_paths(self._path), key=lambda path: created.get(
+                os.path.basename(path), os.stat(path)[ST_CTIME]))
             for db in dbses:
                 try:
                     self._data.append(gdbm.open(db, 'c'))
                 except Exception as err:
                     print('error appending dbfile: %s' % db, err)
+                    continue
+                name = os.path.basename(db)
+                self._names.append(name)
+                self._filters.append(self._load_filter(name))
+                self._indexes.append(self._load_index(name))
+                self._hits.append(0)
+                if name not in self._metadata['chunks']:
+                    stat = os.stat(db)
+                    self._metadata['chunks'][name] = {
+                        'keys': self._count_keys(-1), 'created': stat[ST_CTIME],
+                        'sealed': stat[ST_MTIME]}
+            # drop metadata for chunks that are gone
+            for name in set(self._metadata['chunks']) - set(self._names):
+                del self._metadata['chunks'][name]
+            if self._data:
+                if self._key_index and self._indexes[-1] is None:
+                    # we walk the current chunk to count it anyway, and it
+                    # takes new keys, so it's worth indexing now.
+                    self._indexes[-1] = KeyIndex(key_digest(k) for k in _iter_keys(self._data[-1]))
+                # the current chunk may have changed since its metadata was saved
+                self._chunk_info(-1)['keys'] = self._count_keys(-1)
+                self._chunk_info(-1)['sealed'] = None
+                self._metadata['cursize'] = self._chunk_info(-1)['keys']
+                self._metadata['totsize'] = len(self)
 
+            missing = len([f for f in self._filters if f is None])
             print('loaded %i dbm files' % len(self._data))
+            if missing:
+                print('%i dbm files have no bloom filter; rebuild with '
+                      'python -m anagramatron.multidbm --build-filters' % missing)
+            if self._key_index:
+                missing = len([i for i in self._indexes if i is None])
+                if missing:
+                    print('%i dbm files have no key index, and are read for every '
+                          'lookup; rebuild with python -m anagramatron.multidbm '
+                          '--build-filters' % missing)
+            if self._data and self._filters[-1] is not None:
+                # the current chunk's filter changes with every new key;
+                # it's written back on close, so remove it in case we crash.
+                os.remove(self._filter_path(self._names[-1]))
+            if self._data and os.path.exists(self._index_path(self._names[-1])):
+                # as for the filter
+                os.remove(self._index_path(self._names[-1]))
         else:
             print('path not found, creating')
             os.makedirs(self._path)
             os.makedirs('%s/archive' % self._path)
             self._setup_metadata()
 
+        filters_dir = os.path.join(self._path, _FILTERS_DIR)
+        if not os.path.exists(filters_dir):
+            os.makedirs(filters_dir)
+
         if not len(self._data):
             self._add_db()
 
     def _setup_metadata(self):
-        # this is basically vestigal at this point?
         self._metadata['totsize'] = 0
         self._metadata['cursize'] = 0
+        self._metadata['chunks'] = dict()
+
+    def _count_keys(self, index):
+        """counts the keys in the chunk at index, from its key index if it has one."""
+        if self._indexes[index] is not None:
+            # less the path key
+            return len(self._indexes[index]) - 1
+        return len([k for k in _iter_keys(self._data[index]) if k != _PATHKEY.encode('utf-8')])
 
     def _add_db(self):
-        filename = 'mdbm%s.db' % time.strftime("%b%d%H%M%Y")
+        stamp = time.strftime("%b%d%H%M%Y")
+        filename = 'mdbm%s.db' % stamp
         # filename = 'mdbm%s.db' % str(time.time())
+        suffix = 0
+        while os.path.exists(os.path.join(self._path, filename)):
+            # more than one chunk in a minute; don't reopen the last one.
+            suffix += 1
+            filename = 'mdbm%s_%03d.db' % (stamp, suffix)
         path = self._path + '/%s' % filename
         db = gdbm.open(path, 'c')
         db[_PATHKEY] = filename
+        now = time.time()
+        if self._data:
+            # the previous chunk won't get new keys, so its filter is final
+            self._save_filter(-1)
+            self._save_index(-1)
+            self._chunk_info(-1)['sealed'] = now
+        bloom = BloomFilter(self._section_size, _FILTER_ERROR_RATE)
+        bloom.add(_PATHKEY)
+        key_index = None
+        if self._key_index:
+            key_index = KeyIndex([key_digest(_PATHKEY)])
         self._data.append(db)
+        self._names.append(filename)
+        self._filters.append(bloom)
+        self._indexes.append(key_index)
+        self._hits.append(0)
+        self._probe_order = None
+        self._metadata['chunks'][filename] = {'keys': 0, 'created': now, 'sealed': None}
         self._metadata['cursize'] = 0
         logging.debug('mdbm added new dbm file: %s' % filename)
 
     def _remove_old(self):
+        db, filename, info = self._detach_old()
+        try:
+            return self._archive_chunk(db, filename)
+        except OSError:
+            self._metadata['chunks'][filename] = info
+            raise
+
+    def _detach_old(self):
+        """takes the oldest chunk out of the store. returns (db, filename, metadata)."""
         db = self._data.pop(0)
-        filename = db[_PATHKEY]
+        filename = self._names.pop(0)
+        self._filters.pop(0)
+        self._indexes.pop(0)
+        self._hits.pop(0)
+        self._probe_order = None
+        info = self._metadata['chunks'].pop(filename)
+        self._metadata['totsize'] -= info['keys']
+        return db, filename, info
+
+    def _archive_chunk(self, db, filename):
+        """
+        closes a detached chunk and moves it to the archive. returns its new path.
+        raises OSError if it can't be moved, leaving it and its filter in place.
+        """
         db.close()
         target = '%s/%s' % (self._path, filename)
         destination = '%s/archive/%s' % (self._path, filename)
@@ -131,7 +480,11 @@ class MultiDBM(object):
             os.rename(target, destination)
         except OSError as err:
             print("error moving file %s to %s: %s" % (target, destination, err))
-            sys.exit(1)
+            raise
+        if os.path.exists(self._filter_path(filename)):
+            os.remove(self._filter_path(filename))
+        if os.path.exists(self._index_path(filename)):
+            os.remove(self._index_path(filename))
         logging.debug('mdbm moved old dbm file to %s' % destination)
         return destination
 
@@ -139,22 +492,171 @@ class MultiDBM(object):
         return len(self._data)
 
     def archive(self):
+        if self._compacting is not None:
+            print('not archiving while chunks are being compacted')
+            return None
         return self._remove_old()
 
-    def close(self):
+    def compact(self, count=None, lock=None):
+        """
+        merges the oldest count sealed chunks (all of them by default) into
+        one, keeping the newest copy of each key. the merged chunk is written
+        to a temporary file, and renamed over the newest chunk it replaces.
+
+        the store can be used while this runs, as long as every use holds
+        lock: it is released between slices of keys. the chunks being merged
+        aren't written meanwhile; changes to their keys are kept aside, seen
+        by lookups, and applied to the merged chunk before the swap.
+        returns a dict describing the compaction, or None if there were fewer
+        than two chunks to merge.
+        """
+        lock = lock or threading.Lock()
+        with lock:
+            sealed = len(self._data) - 1
+            count = min(sealed, count or sealed)
+            if count < 2 or self._compacting is not None:
+                return None
+            names = self._names[:count]
+            sources = self._data[:count]
+            before = self.chunk_stats()[:count]
+            self._compacting = set(names)
+            self._compact_changes = dict()
+        start = time.time()
+        temp_path = os.path.join(self._path, _COMPACT_TEMP_FILE)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        merged = gdbm.open(temp_path, 'nf')
+        digests = array('Q')
+        pathkey = _PATHKEY.encode('utf-8')
+        closed_sources = False
+        try:
+            # newest first, so the first copy of a key we see is the one we keep
+            for db in reversed(sources):
+                keys = _iter_keys(db)
+                while True:
+                    with lock:
+                        batch = list(islice(keys, _COMPACT_SLICE_SIZE))
+                        for k in batch:
+                            if k != pathkey and k not in merged:
+                                merged[k] = db[k]
+                                digests.append(key_digest(k))
+                    if not batch:
+                        break
+                    time.sleep(0)
+
+            # the filter and index are built outside the lock; keys deleted
+            # since are left in them, which costs only a wasted probe.
+            bloom = BloomFilter(max(len(digests) + 1, self._section_size), _FILTER_ERROR_RATE)
+            for digest in digests:
+                bloom.add(digest=digest)
+            bloom.add(_PATHKEY)
+            key_index = None
+            if self._key_index:
+                key_index = KeyIndex(digests)
+                key_index.add(key_digest(_PATHKEY))
+
+            with lock:
+                key_count = len(digests)
+                for key, value in self._compact_changes.items():
+                    if value is not None:
+                        merged[key] = value
+                    elif key in merged:
+                        del merged[key]
+                        key_count -= 1
+                        if key_index is not None:
+                            key_index.discard(key_digest(key))
+                name = names[-1]
+                merged[_PATHKEY] = name
+                merged.sync()
+                merged.close()
+                closed_sources = True
+                for db in sources:
+                    db.close()
+                # the new filter and index describe a superset of the keys in
+                # the chunk they replace, so they're safe to write first:
+                # a crash before the rename costs wasted probes, not lost keys.
+                self._filters[count - 1] = bloom
+                self._indexes[count - 1] = key_index
+                self._save_filter(count - 1)
+                self._save_index(count - 1)
+                os.replace(temp_path, os.path.join(self._path, name))
+                for old in names[:-1]:
+                    for path in (self._filter_path(old), self._index_path(old),
+                                 os.path.join(self._path, old)):
+                        if os.path.exists(path):
+                            os.remove(path)
+                    del self._metadata['chunks'][old]
+
+                self._data[:count] = [gdbm.open(os.path.join(self._path, name), 'c')]
+                self._names[:count] = [name]
+                self._filters[:count] = [bloom]
+                self._indexes[:count] = [key_index]
+                self._hits[:count] = [sum(self._hits[:count])]
+                self._probe_order = None
+                self._metadata['chunks'][name] = {
+                    'keys': key_count,
+                    'created': min(info['created'] for info in before),
+                    'sealed': max(info['sealed'] for info in before)}
+                self._metadata['totsize'] = len(self)
+                self._save_metadata()
+                self._compact_changes = dict()
+        finally:
+            with lock:
+                if self._compact_changes and not closed_sources:
+                    # we didn't get as far as the swap
+                    self._apply_compact_changes(count)
+                self._compacting = None
+                self._compact_changes = dict()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        after = self.chunk_stats()[0]
+        result = {
+            'chunks': count,
+            'keys_before': sum(info['keys'] for info in before),
+            'keys_after': after['keys'],
+            'bytes_before': sum(info['bytes'] for info in before),
+            'bytes_after': after['bytes'],
+            'seconds': time.time() - start,
+        }
+        result['bytes_reclaimed'] = result['bytes_before'] - result['bytes_after']
+        self.stats['compactions'] += 1
+        self.stats['bytes_reclaimed'] += result['bytes_reclaimed']
+        return result
+
+    def _apply_compact_changes(self, count):
+        """writes changes kept aside during a failed compaction to the oldest count chunks."""
+        for key, value in self._compact_changes.items():
+            holding = [p for p in range(count) if key in self._data[p]]
+            if value is None:
+                for position in holding:
+                    del self._data[position][key]
+            elif holding:
+                self._data[holding[-1]][key] = value
+
+    def _save_metadata(self):
+        """writes the metadata file, via a temporary file."""
         path = '%s/%s' % (self._path, _METADATA_FILE)
-        print('dumping path:', path)
-        pickle.dump(self._metadata, open(path, 'wb'))
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self._metadata, f)
+        os.replace(tmp_path, path)
+
+    def close(self):
+        print('dumping path:', '%s/%s' % (self._path, _METADATA_FILE))
+        self._save_metadata()
+        if self._data:
+            self._save_filter(-1)
+            self._save_index(-1)
         for db in self._data:
             db.close()
 
     def perform_maintenance(self):
-        import whichdb
         try:
             print("performing maintenance on %d database chunks" % len(self._data))
-            for db in self._data:
-                path = db[_PATHKEY]
-                db_type = whichdb.whichdb(path)
+            for name, db in zip(self._names, self._data):
+                path = os.path.join(self._path, name)
+                db_type = dbm.whichdb(path)
                 print("checking %s, type: %s" % (path, db_type))
                 try:
                     db.reorganize()
@@ -165,25 +667,70 @@ class MultiDBM(object):
             self.close()
 
 
-def check_integrity_for_chunk(db_chunk):
-    # path = db_chunk[_PATHKEY]
-    # print("checking keys in db: %s\n" % path)
+def compact_with_report(store, count=None, lock=None, samples=1000):
+    """
+    compacts store as MultiDBM.compact, and adds to the result the mean
+    lookup latency before and after, of keys sampled from the chunks being
+    merged and of as many keys that aren't in the store.
+    """
+    lock = lock or threading.Lock()
+    pathkey = _PATHKEY.encode('utf-8')
+    with lock:
+        chunks = store._data[:min(len(store._data) - 1, count or len(store._data))]
+        per_chunk = max(1, samples // max(1, len(chunks)))
+        keys = [k.decode('utf-8') for db in chunks
+                for k in islice(_iter_keys(db), per_chunk) if k != pathkey]
+        keys.extend(['%s@absent' % key for key in keys])
+        latency_before = lookup_latency(store, keys)
+    result = store.compact(count, lock)
+    if result is None:
+        return None
+    with lock:
+        result['latency_before'] = latency_before
+        result['latency_after'] = lookup_latency(store, keys)
+    return result
+
+
+def format_compaction(result):
+    return ('merged %d chunks: %d keys to %d, %d bytes to %d (%d reclaimed) in %.1fs. '
+            'lookup latency %.1fus before, %.1fus after' % (
+                result['chunks'], result['keys_before'], result['keys_after'],
+                result['bytes_before'], result['bytes_after'], result['bytes_reclaimed'],
+                result['seconds'], result['latency_before'] * 1e6,
+                result['latency_after'] * 1e6))
+
+
+def _iter_keys(db_chunk):
     k = db_chunk.firstkey()
-    nextkey = k
-    seen = set()
     while k is not None:
-        if k in seen:
-            print('found duplicate key, aborting')
-            return
-        seen.add(k)
-        nextkey = db_chunk.nextkey(k)
-        if nextkey == k:
-            print("next key == current key!")
-            break
-        k = nextkey
-        sys.stdout.write('checked: %i\t\t\r' % len(seen))
-        sys.stdout.flush()
-    print("\nno next key found. total keys: %i" % len(seen))
+        yield k
+        k = db_chunk.nextkey(k)
+
+
+def build_filters(dbpath, chunk_size=2000000):
+    """
+    (re)builds the bloom filter and key index for each chunk in dbpath.
+    the datastore should not be open elsewhere while this runs.
+    """
+    filters_dir = os.path.join(dbpath, _FILTERS_DIR)
+    if not os.path.exists(filters_dir):
+        os.makedirs(filters_dir)
+    db_files = _load_paths(dbpath)
+    print("building filters for %i mdbm chunks" % len(db_files))
+    for path in db_files:
+        dbchunk = gdbm.open(path, 'r')
+        try:
+            digests = array('Q', (key_digest(k) for k in _iter_keys(dbchunk)))
+            count = len(digests)
+            # compacted chunks hold more than chunk_size keys
+            bloom = BloomFilter(max(count, chunk_size), _FILTER_ERROR_RATE)
+            for digest in digests:
+                bloom.add(digest=digest)
+            bloom.save(os.path.join(filters_dir, '%s.bloom' % os.path.basename(path)))
+            KeyIndex(digests).save(os.path.join(filters_dir, '%s.keys' % os.path.basename(path)))
+            print("%s: %i keys" % (path, count))
+        finally:
+            dbchunk.close()
 
 
 def _load_paths(mdbm_path):
@@ -195,36 +742,231 @@ def _load_paths(mdbm_path):
     return [path for stat, path in sorted(ls)]
 
 
-def verify_database(dbpath):
-    db_files = _load_paths(dbpath)
-    print("verifying %i mdbm chunks" % len(db_files))
-    for db in db_files:
-        dbchunk = gdbm.open(db, 'w')
-        # print("reorganizing %s" % db)
-        # try:
-        #     dbchunk.reorganize()
-        # except Exception as err:
-        #     print("couldn't reorganize: error %s" % err)
-        print("checking %s" % db)
-        try:
-            # check_integrity_for_chunk(dbchunk)
-            k = dbchunk.firstkey()
-            print("first key: %s" % k)
-            check_integrity_for_chunk(dbchunk)
-        except Exception as err:
-            print("integrity check failed: error %s" % err)
-        finally:
-            dbchunk.close()
+def verify_chunk(path, max_keys=None, salvage_path=None):
+    """
+    checks one chunk, and returns a dict describing it: key count, duplicate
+    keys, values that can't be decoded, and any error that stopped the walk.
+
+    key digests are kept in an array, 8 bytes a key, and checked for
+    duplicates by sorting it once the walk is done. the walk stops after
+    max_keys keys, in case the chunk's key chain loops; a loop shows up as
+    duplicate keys. a walk that stops without finding any is reported as
+    truncated, but not as damage.
+
+    if salvage_path is given and the chunk has problems, every record that
+    can be read and decoded is copied to a new chunk there.
+    """
+    start = time.time()
+    name = os.path.basename(path)
+    report = {'name': name, 'keys': 0, 'duplicate_keys': 0, 'decode_errors': 0,
+              'bad_keys': [], 'error': None, 'truncated': False, 'salvaged': None}
+    digests = array('Q')
+    pathkey = _PATHKEY.encode('utf-8')
+    has_pathkey = False
+    try:
+        db = gdbm.open(path, 'r')
+    except Exception as err:
+        # nothing can be salvaged from a chunk we can't open
+        report['error'] = repr(err)
+        report['ok'] = False
+        report['seconds'] = time.time() - start
+        return report
+    try:
+        for k in _iter_keys(db):
+            if max_keys is not None and len(digests) >= max_keys:
+                report['truncated'] = True
+                break
+            digests.append(key_digest(k))
+            if k == pathkey:
+                has_pathkey = True
+                continue
+            if not _decodes(db, k):
+                report['decode_errors'] += 1
+                if len(report['bad_keys']) < 10:
+                    report['bad_keys'].append(k.decode('utf-8', 'replace'))
+    except Exception as err:
+        report['error'] = repr(err)
+
+    digests = array('Q', sorted(digests))
+    report['duplicate_keys'] = sum(1 for i in range(1, len(digests))
+                                   if digests[i] == digests[i - 1])
+    report['keys'] = len(digests) - report['duplicate_keys'] - has_pathkey
+    damaged = report['error'] or report['duplicate_keys'] or report['decode_errors']
+    if damaged and salvage_path:
+        report['salvaged'] = _salvage_chunk(db, salvage_path, max_keys)
+        report['salvage_path'] = salvage_path
+    db.close()
+    report['ok'] = not damaged
+    report['seconds'] = time.time() - start
+    return report
+
+
+def _decodes(db, k):
+    try:
+        decode_value(db[k], k.decode('utf-8'))
+        return True
+    except (KeyError, ValueError, UnicodeDecodeError):
+        return False
+
+
+def _salvage_chunk(db, salvage_path, max_keys=None):
+    """
+    copies every record in db that can be read and decoded into a new chunk
+    at salvage_path. returns the number of records copied.
+    """
+    pathkey = _PATHKEY.encode('utf-8')
+    out = gdbm.open(salvage_path, 'nf')
+    copied = 0
+    seen = 0
+    try:
+        for k in _iter_keys(db):
+            seen += 1
+            if max_keys is not None and seen > max_keys:
+                break
+            if k == pathkey or k in out or not _decodes(db, k):
+                continue
+            out[k] = db[k]
+            copied += 1
+    except Exception as err:
+        print('stopped salvaging %s: %s' % (salvage_path, err))
+    out[_PATHKEY] = os.path.basename(salvage_path)
+    out.sync()
+    out.close()
+    return copied
+
+
+def _verify_chunk_args(args):
+    return verify_chunk(*args)
+
+
+def verify_database(dbpath, workers=None, repair=False, report_path=None,
+                    chunk_size=2000000):
+    """
+    checks every chunk in dbpath with verify_chunk, in a pool of workers
+    processes (one per cpu by default), and writes a JSON report to
+    report_path (verify_report.json in dbpath by default).
+    each walk is limited to twice the chunk's key count in the metadata,
+    or twice chunk_size if that's more or the chunk isn't recorded.
+
+    with repair, each damaged chunk is replaced by a salvaged copy of it,
+    and the original is moved to the archive directory. the datastore
+    should not be open elsewhere while this runs.
+    returns the report.
+    """
+    import json
+    import multiprocessing
+
+    start = time.time()
+    paths = _load_paths(dbpath)
+    salvage_dir = os.path.join(dbpath, 'salvage')
+    if repair and not os.path.exists(salvage_dir):
+        os.makedirs(salvage_dir)
+    print("verifying %i mdbm chunks" % len(paths))
+    recorded = _load_metadata(dbpath).get('chunks', dict())
+    jobs = []
+    for path in paths:
+        name = os.path.basename(path)
+        keys = recorded.get(name, dict()).get('keys', 0)
+        jobs.append((path, 2 * max(keys + 1, chunk_size),
+                     os.path.join(salvage_dir, name) if repair else None))
+    pool = multiprocessing.Pool(workers)
+    try:
+        chunks = []
+        for report in pool.imap_unordered(_verify_chunk_args, jobs):
+            print('%s: %s%s, %d keys, %d duplicates, %d decode errors in %.1fs' % (
+                report['name'], 'ok' if report['ok'] else 'damaged',
+                ' (walk stopped early)' if report['truncated'] else '', report['keys'],
+                report['duplicate_keys'], report['decode_errors'], report['seconds']))
+            chunks.append(report)
+    finally:
+        pool.close()
+        pool.join()
+    order = dict((os.path.basename(path), i) for i, path in enumerate(paths))
+    chunks.sort(key=lambda report: order[report['name']])
+
+    if repair:
+        for report in chunks:
+            if report['salvaged'] is not None:
+                _replace_with_salvage(dbpath, report)
+
+    result = {
+        'path': os.path.abspath(dbpath),
+        'started': start,
+        'seconds': time.time() - start,
+        'workers': workers or multiprocessing.cpu_count(),
+        'chunks': chunks,
+        'keys': sum(report['keys'] for report in chunks),
+        'damaged': [report['name'] for report in chunks if not report['ok']],
+    }
+    report_path = report_path or os.path.join(dbpath, 'verify_report.json')
+    with open(report_path, 'w') as f:
+        json.dump(result, f, indent=2)
+    print('verified %d keys in %d chunks in %.1fs, %d damaged. report written to %s' % (
+        result['keys'], len(chunks), result['seconds'], len(result['damaged']), report_path))
+    return result
+
+
+def _load_metadata(dbpath):
+    """returns the metadata saved in dbpath, or an empty dict if there is none."""
+    try:
+        with open(os.path.join(dbpath, _METADATA_FILE), 'rb') as f:
+            return pickle.load(f)
+    except (IOError, OSError, pickle.UnpicklingError, EOFError):
+        return dict()
+
+
+def _replace_with_salvage(dbpath, report):
+    """moves a damaged chunk to the archive, and its salvaged copy into its place."""
+    name = report['name']
+    archive_dir = os.path.join(dbpath, 'archive')
+    if not os.path.exists(archive_dir):
+        os.makedirs(archive_dir)
+    os.rename(os.path.join(dbpath, name), os.path.join(archive_dir, '%s.damaged' % name))
+    os.rename(report['salvage_path'], os.path.join(dbpath, name))
+    # the filter and index are rebuilt from the salvaged keys
+    for suffix in ('bloom', 'keys'):
+        path = os.path.join(dbpath, _FILTERS_DIR, '%s.%s' % (name, suffix))
+        if os.path.exists(path):
+            os.remove(path)
+    meta_path = os.path.join(dbpath, _METADATA_FILE)
+    if os.path.exists(meta_path):
+        metadata = _load_metadata(dbpath)
+        info = metadata.get('chunks', dict()).get(name)
+        if info is not None:
+            info['keys'] = report['salvaged']
+            with open('%s.tmp' % meta_path, 'wb') as f:
+                pickle.dump(metadata, f)
+            os.replace('%s.tmp' % meta_path, meta_path)
+    print('replaced %s with %d salvaged records' % (name, report['salvaged']))
+
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('-r', '--repair', help='repair/verify datastore', action="store_true")
+    parser.add_argument('-v', '--verify', help='verify datastore', action="store_true")
+    parser.add_argument('-r', '--repair', help='verify datastore, and replace damaged chunks '
+                        'with what can be salvaged from them', action="store_true")
+    parser.add_argument('-w', '--workers', help='processes verifying chunks (default: one per cpu)',
+                        type=int)
+    parser.add_argument('--report', help='where to write the JSON verification report')
+    parser.add_argument('-b', '--build-filters', help='rebuild chunk bloom filters and key indexes',
+                        action="store_true")
+    parser.add_argument('-c', '--compact', help='merge the oldest COMPACT sealed chunks '
+                        'into one (0 for all of them)', type=int)
     parser.add_argument('db', type=str, help="source database file")
     args = parser.parse_args()
 
     if not args.db:
         print('please specify the mdbm directory')
 
-    if args.repair:
-        verify_database(args.db)
+    if args.verify or args.repair:
+        verify_database(args.db, args.workers, args.repair, args.report)
+    if args.build_filters:
+        build_filters(args.db)
+    if args.compact is not None:
+        store = MultiDBM(args.db)
+        try:
+            result = compact_with_report(store, args.compact or None)
+            print(format_compaction(result) if result else 'nothing to compact')
+        finally:
+            store.close()
@@ -0,0 +1,165 @@
+# coding: utf-8
+from __future__ import print_function
+import time
+import zlib
+
+from . import common
+from .anagramstats import StatTracker
+
+HASH_KEY = 'anagram_hash'
+
+
+class OverloadPolicy(object):
+
+    """
+    a way of shedding load while the finder can't keep up with the stream.
+
+    start and stop are called as the controller enters and leaves overload.
+    shed is called with each batch while overloaded, and returns the tweets
+    that should still be handled.
+    """
+
+    def start(self, controller):
+        pass
+
+    def stop(self, controller):
+        pass
+
+    def shed(self, batch, backlog, controller):
+        return batch
+
+
+class SamplePolicy(OverloadPolicy):
+
+    """
+    keeps a share of tweets that falls as the backlog grows, down to min_keep.
+    tweets are sampled by anagram key, so both halves of an anagram are
+    either kept or dropped together.
+    """
+
+    def __init__(self, min_keep=0.1):
+        self.min_keep = min_keep
+
+    def shed(self, batch, backlog, controller):
+        keep = max(self.min_keep, min(1.0, controller.low_water / float(len(backlog) or 1)))
+        cutoff = int(keep * 1000)
+        return [t for t in batch if zlib.crc32(t[HASH_KEY].encode('utf-8')) % 1000 < cutoff]
+
+
+class CacheOnlyPolicy(OverloadPolicy):
+
+    """skips the datastore lookup, so tweets are only compared with the cache."""
+
+    def start(self, controller):
+        if controller.finder is not None:
+            controller.finder.set_cache_only(True)
+
+    def stop(self, controller):
+        if controller.finder is not None:
+            controller.finder.set_cache_only(False)
+
+
+class PrioritizePolicy(OverloadPolicy):
+
+    """
+    keeps the share of each batch with the most distinct letters, since
+    anagrams of those are the most interesting.
+    """
+
+    def __init__(self, keep=0.5):
+        self.keep = keep
+
+    def shed(self, batch, backlog, controller):
+        count = int(len(batch) * self.keep + 0.5)
+        # each letter present is one char in the key that isn't '@'
+        ranked = sorted(range(len(batch)), reverse=True,
+                        key=lambda i: _distinct_letters(batch[i][HASH_KEY]))
+        return [batch[i] for i in sorted(ranked[:count])]
+
+
+class DropOldestPolicy(OverloadPolicy):
+
+    """drops the oldest buffered tweets, until the backlog is at low_water."""
+
+    def shed(self, batch, backlog, controller):
+        dropped = 0
+        while len(backlog) > controller.low_water:
+            backlog.popleft()
+            dropped += 1
+        controller.stats['tweets_shed'] += dropped
+        return batch
+
+
+OVERLOAD_POLICIES = {
+    'sample': SamplePolicy,
+    'cache_only': CacheOnlyPolicy,
+    'prioritize': PrioritizePolicy,
+    'drop_oldest': DropOldestPolicy,
+}
+
+
+def _distinct_letters(key):
+    return len(key) - key.count('@')
+
+
+class OverloadController(object):
+
+    """
+    decides when the finder is overloaded, from the length of the stream
+    handler's backlog, and applies policies to shed load until it recovers.
+
+    overload starts when the backlog is longer than high_water, and ends when
+    it is shorter than low_water, so that we don't flip in and out of it.
+
+    :policies: names in OVERLOAD_POLICIES, or OverloadPolicy instances.
+    :finder: the AnagramFinder or ShardedAnagramFinder, used by cache_only.
+    """
+
+    def __init__(self, policies=common.ANAGRAM_OVERLOAD_POLICIES,
+                 high_water=common.ANAGRAM_STREAM_BUFFER_SIZE,
+                 low_water=None,
+                 finder=None):
+        self.policies = []
+        for policy in policies:
+            if isinstance(policy, OverloadPolicy):
+                self.policies.append(policy)
+            elif policy in OVERLOAD_POLICIES:
+                self.policies.append(OVERLOAD_POLICIES[policy]())
+            else:
+                raise ValueError('no overload policy named %s' % policy)
+        self.high_water = high_water
+        self.low_water = low_water if low_water is not None else high_water // 2
+        self.finder = finder
+        self.overloaded = False
+        self._overload_start = None
+        self.stats = StatTracker()
+
+    def admit(self, batch, backlog):
+        """
+        returns the tweets in batch that should be handled.
+        backlog is the deque of tweets still waiting; policies may drop from it.
+        """
+        self._update(len(backlog))
+        if not self.overloaded:
+            return batch
+        count = len(batch)
+        for policy in self.policies:
+            batch = policy.shed(batch, backlog, self)
+        self.stats['tweets_shed'] += count - len(batch)
+        return batch
+
+    def _update(self, depth):
+        if not self.overloaded and depth > self.high_water:
+            print('overloaded with backlog %d, shedding load' % depth)
+            self.overloaded = True
+            self._overload_start = time.time()
+            self.stats['overload_episodes'] += 1
+            for policy in self.policies:
+                policy.start(self)
+        elif self.overloaded and depth < self.low_water:
+            print('recovered with backlog %d' % depth)
+            self.overloaded = False
+            self.stats['overload_seconds'] += time.time() - self._overload_start
+            for policy in self.policies:
+                policy.stop(self)
+        self.stats['overloaded'] = int(self.overloaded)
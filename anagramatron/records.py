@@ -0,0 +1,180 @@
+"""
+compact binary encoding for stored tweets.
+
+a record is a header byte, an optional tweet_id, and a
+length prefixed utf-8 text, which may be deflated:
+
+    header | [uint64 tweet_id] | varint length | text
+
+the header is RECORD_VERSION with FLAG_* bits set. the anagram hash isn't
+stored, since it is always the key the record is stored under.
+a bucket of several candidates for one key is a header with FLAG_BUCKET,
+a varint count, and that many length prefixed records:
+
+    header | varint count | (varint length | record) ...
+
+tweet ids are fixed width little endian: snowflake ids need 60+ bits,
+so a varint would be longer, and slower to decode.
+values written before records existed were JSON or plain utf-8 text, and
+are still decoded.
+"""
+import json
+import struct
+import zlib
+
+RECORD_VERSION = 0x10
+FLAG_TWEET_ID = 0x01
+FLAG_DEFLATE = 0x02
+FLAG_BUCKET = 0x04
+_FLAG_MASK = FLAG_TWEET_ID | FLAG_DEFLATE | FLAG_BUCKET
+
+TEXT_KEY = 'text'
+ID_KEY = 'tweet_id'
+HASH_KEY = 'anagram_hash'
+_RECORD_KEYS = frozenset((TEXT_KEY, ID_KEY, HASH_KEY))
+_TWEET_ID = struct.Struct('<Q')
+
+# a preset dictionary for deflate, so short texts still compress.
+# changing this breaks decoding of existing deflated records.
+_ZDICT = (b"the and you that for this with have just not but what all are "
+          b"like when your love when its out get dont about know can was "
+          b"lol they she good day one time people want how really going "
+          b"ing tion ould ight ever every think make today never")
+
+
+def is_record(data):
+    return bool(data) and data[0] & ~_FLAG_MASK == RECORD_VERSION
+
+
+def encode_record(value, key=None, compress=False):
+    """
+    encodes a tweet dict or string, or a list of them, as a record.
+    returns None for values a record can't represent exactly,
+    such as dicts with other fields; these should be stored as JSON.
+    """
+    if isinstance(value, list):
+        return _encode_bucket(value, key, compress)
+    header = RECORD_VERSION
+    out = bytearray()
+    if isinstance(value, dict):
+        tweet_id = value.get(ID_KEY)
+        text = value.get(TEXT_KEY)
+        if (not isinstance(text, str) or not _RECORD_KEYS.issuperset(value) or
+                value.get(HASH_KEY, key) != key or key is None):
+            return None
+        if not isinstance(tweet_id, int) or not 0 <= tweet_id < 1 << 64:
+            return None
+        header |= FLAG_TWEET_ID
+        out += _TWEET_ID.pack(tweet_id)
+    elif isinstance(value, str):
+        text = value
+    else:
+        return None
+
+    body = text.encode('utf-8')
+    if compress:
+        deflater = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=_ZDICT)
+        deflated = deflater.compress(body) + deflater.flush()
+        if len(deflated) < len(body):
+            header |= FLAG_DEFLATE
+            body = deflated
+    _write_varint(out, len(body))
+    out += body
+    return bytes((header,)) + bytes(out)
+
+
+def _encode_bucket(values, key, compress):
+    out = bytearray((RECORD_VERSION | FLAG_BUCKET,))
+    _write_varint(out, len(values))
+    for value in values:
+        if isinstance(value, list):
+            return None
+        record = encode_record(value, key, compress)
+        if record is None:
+            return None
+        _write_varint(out, len(record))
+        out += record
+    return bytes(out)
+
+
+def decode_record(data, key=None):
+    """
+    decodes a record, a legacy JSON value, or legacy plain text.
+    tweet records are returned as dicts with key as their anagram_hash,
+    and buckets as lists.
+    """
+    if not is_record(data):
+        return _decode_legacy(data)
+    header = data[0]
+    if header & FLAG_BUCKET:
+        return _decode_bucket(data, key)
+    pos = 1
+    tweet_id = None
+    try:
+        if header & FLAG_TWEET_ID:
+            tweet_id = _TWEET_ID.unpack_from(data, pos)[0]
+            pos += _TWEET_ID.size
+        length = data[pos]
+    except (struct.error, IndexError):
+        raise ValueError('truncated record')
+    if length & 0x80:
+        length, pos = _read_varint(data, pos)
+    else:
+        pos += 1
+    body = data[pos:pos + length]
+    if len(body) != length:
+        raise ValueError('truncated record')
+    if header & FLAG_DEFLATE:
+        try:
+            body = zlib.decompressobj(-15, zdict=_ZDICT).decompress(body)
+        except zlib.error:
+            raise ValueError('corrupt record')
+    text = body.decode('utf-8')
+    if tweet_id is None:
+        return text
+    return {HASH_KEY: key, ID_KEY: tweet_id, TEXT_KEY: text}
+
+
+def _decode_bucket(data, key):
+    count, pos = _read_varint(data, 1)
+    values = []
+    for _ in range(count):
+        length, pos = _read_varint(data, pos)
+        record = data[pos:pos + length]
+        if len(record) != length:
+            raise ValueError('truncated record')
+        values.append(decode_record(record, key))
+        pos += length
+    return values
+
+
+def _decode_legacy(data):
+    val = data.decode('utf-8')
+    # this is kinda gross
+    try:
+        val = json.loads(val)
+    except ValueError:
+        pass
+    return val
+
+
+def _write_varint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        try:
+            byte = data[pos]
+        except IndexError:
+            raise ValueError('truncated varint')
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
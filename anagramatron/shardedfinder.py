@@ -0,0 +1,277 @@
+# coding: utf-8
+from __future__ import print_function
+import os
+import sys
+import zlib
+import queue
+import multiprocessing
+
+from . import anagramfinder, anagramfunctions, common, storage
+from .anagramstats import StatTracker
+
+HASH_KEY = anagramfinder.HASH_KEY
+
+# batches waiting for each shard before handle_many blocks
+_SHARD_QUEUE_SIZE = 64
+# counters kept by each shard's AnagramFinder, summed in the parent
+SHARD_STAT_KEYS = ('cache_hits', 'possible_hits', 'cache_size', 'cache_trims',
+                   'cache_evictions', 'cache_bytes', 'pending_writes', 'bad_keys',
+                   'duplicates_dropped', 'probes_skipped', 'store_lookups', 'store_hits',
+                   'chunk_probes')
+
+_BATCH = 'batch'
+_MAINTENANCE = 'maintenance'
+_CACHE_ONLY = 'cache_only'
+_COMPACT = 'compact'
+_HITS = 'hits'
+_CLOSED = 'closed'
+_ERROR = 'error'
+
+
+def shard_for_key(key, shard_count):
+    """
+    returns the shard an anagram key belongs to.
+    this is stable between runs, so a shard always sees the same keys.
+    """
+    return zlib.crc32(key.encode('utf-8')) % shard_count
+
+
+def shard_paths(storage, shard, shard_count, languages=['en']):
+    """returns the (store path, cache path) for one shard in the data directory."""
+    suffix = '%s_shard%dof%d' % ('_'.join(languages), shard, shard_count)
+    component = anagramfinder.STORAGE_PATH_COMPONENTS.get(
+        storage, anagramfinder.DATA_PATH_COMPONENT)
+    return (os.path.join(common.ANAGRAM_DATA_DIR, '%s_%s.db' % (component, suffix)),
+            os.path.join(common.ANAGRAM_DATA_DIR, '%s_%s.cache' % (
+                anagramfinder.CACHE_PATH_COMPONENT, suffix)))
+
+
+def per_shard_limits(finder_kwargs, shard_count):
+    """
+    returns a copy of AnagramFinder arguments with the cache, warm start and
+    retention limits, which are given for all shards together, divided
+    between shard_count shards.
+    """
+    finder_kwargs = dict(finder_kwargs)
+    for name, default in (('cache_size', common.ANAGRAM_CACHE_SIZE),
+                          ('cache_bytes', common.ANAGRAM_CACHE_BYTES),
+                          ('warm_bytes', common.ANAGRAM_WARM_BYTES)):
+        finder_kwargs[name] = _split_limit(finder_kwargs.get(name, default), shard_count)
+    retention = finder_kwargs.get('retention')
+    if retention:
+        finder_kwargs['retention'] = storage.RetentionPolicy(
+            retention.max_age, _split_limit(retention.max_keys, shard_count),
+            _split_limit(retention.max_bytes, shard_count))
+    return finder_kwargs
+
+
+def _split_limit(limit, shard_count):
+    # None is no limit, and 0 is off; neither is divided
+    if not limit:
+        return limit
+    return max(1, limit // shard_count)
+
+
+def _shard_stats(finder):
+    return dict((k, finder.stats[k]) for k in SHARD_STAT_KEYS)
+
+
+def _run_shard(shard, inputs, results, finder_kwargs):
+    """
+    the body of a shard process. handles batches of (input, key) tuples from
+    inputs with its own AnagramFinder, and puts hits on results.
+    """
+    hits = []
+    try:
+        finder = anagramfinder.AnagramFinder(
+            hit_callback=lambda one, two: hits.append((one, two)), **finder_kwargs)
+    except Exception as err:
+        results.put((_ERROR, shard, repr(err)))
+        return
+
+    try:
+        while True:
+            message = inputs.get()
+            if message is None:
+                break
+            command, batch = message
+            if command == _MAINTENANCE:
+                finder.perform_maintenance()
+                continue
+            if command == _CACHE_ONLY:
+                finder.set_cache_only(batch)
+                continue
+            if command == _COMPACT:
+                finder.compact(batch)
+                continue
+            finder.handle_many(batch)
+            results.put((_HITS, shard, (hits, _shard_stats(finder))))
+            hits = []
+        finder.close()
+        results.put((_CLOSED, shard, _shard_stats(finder)))
+    except Exception as err:
+        results.put((_ERROR, shard, repr(err)))
+
+
+class ShardError(Exception):
+    """raised in the parent when a shard process fails."""
+    pass
+
+
+class ShardedAnagramFinder(object):
+
+    """
+    runs one AnagramFinder per shard, each in its own process.
+
+    inputs are partitioned by anagram key with shard_for_key, so every
+    candidate for a given key is handled by the same shard, in the order it
+    was received. each shard has its own cache and datastore.
+    hit_callback is called in this process, as hits are returned by shards.
+
+    :shards: the number of shard processes.
+    other arguments are as for AnagramFinder. store and cache paths are
+    chosen per shard by shard_paths, and cache_size, cache_bytes, warm_bytes
+    and the retention limits are totals, divided between shards by
+    per_shard_limits.
+    """
+
+    def __init__(self, shards=2, languages=['en'], storage=None,
+                 hit_callback=print, text_key="text", **kwargs):
+        if shards < 1:
+            raise ValueError('shard count must be at least 1, got %s' % shards)
+        self.shard_count = shards
+        self.hit_callback = hit_callback
+        self.text_key = text_key
+        self.stats = StatTracker()
+        self._shard_stats = [dict() for _ in range(shards)]
+        self._results = multiprocessing.Queue()
+        self._inputs = []
+        self._processes = []
+        self._closed = False
+        kwargs = per_shard_limits(kwargs, shards)
+        for shard in range(shards):
+            path, cachepath = shard_paths(storage, shard, shards, languages)
+            finder_kwargs = dict(kwargs, languages=languages, storage=storage,
+                                 path=path, cachepath=cachepath)
+            inputs = multiprocessing.Queue(_SHARD_QUEUE_SIZE)
+            process = multiprocessing.Process(
+                target=_run_shard, args=(shard, inputs, self._results, finder_kwargs))
+            process.daemon = True
+            process.start()
+            self._inputs.append(inputs)
+            self._processes.append(process)
+
+    def handle_input(self, inp, text_key=None, key=None):
+        self.handle_many([(inp, key)], text_key)
+
+    def handle_many(self, inputs, text_key=None):
+        """
+        sends an iterable of inputs to their shards, as for AnagramFinder.handle_many.
+        hits returned by shards since the last call are passed to hit_callback.
+        """
+        text_key = text_key or self.text_key
+        batches = [[] for _ in range(self.shard_count)]
+        for inp in inputs:
+            key = None
+            if isinstance(inp, tuple):
+                inp, key = inp
+            if key is None and isinstance(inp, dict):
+                key = inp.get(HASH_KEY)
+            if key is None:
+                key = anagramfunctions.improved_hash(
+                    anagramfinder.text_from_input(inp, text_key))
+            batches[shard_for_key(key, self.shard_count)].append((inp, key))
+
+        for shard, batch in enumerate(batches):
+            if batch:
+                self._send(shard, (_BATCH, batch))
+        self._handle_results()
+
+    def _send(self, shard, message):
+        """puts a message on a shard's queue, waiting if the shard is behind."""
+        while True:
+            try:
+                self._inputs[shard].put(message, timeout=1)
+                return
+            except queue.Full:
+                # hits are returned while we wait, so shards don't block on us
+                self._handle_results()
+                if not self._processes[shard].is_alive():
+                    raise ShardError('shard %d exited unexpectedly' % shard)
+
+    def _handle_results(self, block_until_closed=False):
+        """
+        handles messages from shards. if block_until_closed is True,
+        waits until every shard has closed.
+        """
+        closed = set()
+        exited = set()
+        while True:
+            try:
+                if block_until_closed:
+                    if len(closed) == self.shard_count:
+                        break
+                    message = self._results.get(timeout=1)
+                else:
+                    message = self._results.get_nowait()
+            except queue.Empty:
+                if not block_until_closed:
+                    break
+                # a shard's last message can arrive just after it exits,
+                # so only give up on it after a second empty wait.
+                for shard in exited - closed:
+                    raise ShardError('shard %d exited unexpectedly' % shard)
+                exited = set(shard for shard, process in enumerate(self._processes)
+                             if not process.is_alive())
+                continue
+
+            kind, shard, payload = message
+            if kind == _ERROR:
+                raise ShardError('shard %d failed: %s' % (shard, payload))
+            if kind == _CLOSED:
+                closed.add(shard)
+                self._update_stats(shard, payload)
+                continue
+            hits, stats = payload
+            self._update_stats(shard, stats)
+            for one, two in hits:
+                self.hit_callback(one, two)
+
+    def _update_stats(self, shard, stats):
+        self._shard_stats[shard] = stats
+        for key in SHARD_STAT_KEYS:
+            self.stats[key] = sum(s.get(key, 0) for s in self._shard_stats)
+
+    def set_cache_only(self, cache_only):
+        """as AnagramFinder.set_cache_only, for every shard."""
+        for shard in range(self.shard_count):
+            self._send(shard, (_CACHE_ONLY, cache_only))
+
+    def compact(self, count=None):
+        """as AnagramFinder.compact, for every shard."""
+        for shard in range(self.shard_count):
+            self._send(shard, (_COMPACT, count))
+
+    def perform_maintenance(self):
+        """asks every shard to archive the oldest part of its datastore."""
+        for shard in range(self.shard_count):
+            self._send(shard, (_MAINTENANCE, None))
+
+    def close(self):
+        """
+        stops the shard processes, after they have handled all queued input.
+        remaining hits are passed to hit_callback.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            for shard in range(self.shard_count):
+                self._send(shard, None)
+            self._handle_results(block_until_closed=True)
+        finally:
+            for process in self._processes:
+                process.join(10)
+                if process.is_alive():
+                    print('shard process %s did not exit' % process.pid, file=sys.stderr)
+                    process.terminate()
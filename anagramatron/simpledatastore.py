@@ -2,22 +2,52 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
-from operator import itemgetter
+from bisect import bisect_left, insort
+from collections import OrderedDict
+import mmap
+import os
 import pickle
 import logging
+import struct
+import sys
+
+from . import storage
 
 ITEM_KEY = 'tweet'
 COUNT_KEY = 'hit_count'
 
+# snapshots start with SNAPSHOT_MAGIC, a version byte and a uint32 entry
+# count, then each entry as:
+#   uint32 hit_count | uint16 key length | uint32 value length | key | value
+# values are encoded with storage.encode_value.
+# files without the magic are loaded as legacy pickles.
+SNAPSHOT_MAGIC = b'ANAGSNAP'
+SNAPSHOT_VERSION = 1
+_SNAPSHOT_HEADER = struct.Struct('<BI')
+_ENTRY_HEADER = struct.Struct('<IHI')
+
 
 class AnagramSimpleStore(object):
     """AnagramSimpleStore is a simple data store implemented
     using standard library data structures. It is intended for use as
-    a cache, or for smaller, static input sources."""
-    def __init__(self, path=None):
+    a cache, or for smaller, static input sources.
+
+    entries are kept in buckets by hit count, in the order they entered
+    the bucket, so the least used entries can be found without a scan.
+
+    :max_items: the number of entries above which the store is over capacity.
+    :max_bytes: the estimated size in bytes above which the store is over capacity.
+    """
+    def __init__(self, path=None, max_items=None, max_bytes=None):
         super(AnagramSimpleStore, self).__init__()
         self.path = path
-        self.datastore = self.load()
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.byte_size = 0
+        self.datastore = dict()
+        self._buckets = dict()
+        self._counts = []
+        self.load()
 
     def __len__(self):
         return len(self.datastore)
@@ -26,55 +56,184 @@ class AnagramSimpleStore(object):
         return self.datastore.get(item) is not None
 
     def __getitem__(self, key):
-        return self.datastore[key][ITEM_KEY]
+        entry = self.datastore[key]
+        value = entry[ITEM_KEY]
+        if isinstance(value, bytes):
+            # still encoded, as it was loaded from a snapshot
+            decoded = entry[ITEM_KEY] = storage.decode_value(value, key)
+            self.byte_size += _value_size(decoded) - _value_size(value)
+            return decoded
+        return value
 
     def __setitem__(self, key, value):
-        if key in self:
-            self.datastore[key][ITEM_KEY] = value
-            self.datastore[key][COUNT_KEY] += 1
+        entry = self.datastore.get(key)
+        if entry is not None:
+            self.byte_size += _entry_size(key, value) - _entry_size(key, entry[ITEM_KEY])
+            entry[ITEM_KEY] = value
+            self._unbucket(key, entry[COUNT_KEY])
+            entry[COUNT_KEY] += 1
+            self._bucket(key, entry[COUNT_KEY])
         else:
-            self.datastore[key] = {ITEM_KEY: value, COUNT_KEY: 0}
+            self._insert(key, value, 0)
 
     def __delitem__(self, instance):
-        del self.datastore[instance]
+        entry = self.datastore.pop(instance)
+        self._unbucket(instance, entry[COUNT_KEY])
+        self.byte_size -= _entry_size(instance, entry[ITEM_KEY])
+
+    def _insert(self, key, value, hit_count):
+        self.datastore[key] = {ITEM_KEY: value, COUNT_KEY: hit_count}
+        self._bucket(key, hit_count)
+        self.byte_size += _entry_size(key, value)
+
+    def _bucket(self, key, count):
+        bucket = self._buckets.get(count)
+        if bucket is None:
+            bucket = self._buckets[count] = OrderedDict()
+            insort(self._counts, count)
+        bucket[key] = None
+
+    def _unbucket(self, key, count):
+        bucket = self._buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[count]
+            del self._counts[bisect_left(self._counts, count)]
+
+    def over_capacity(self):
+        """returns True if the store holds more than max_items or max_bytes."""
+        if self.max_items is not None and len(self.datastore) > self.max_items:
+            return True
+        if self.max_bytes is not None and self.byte_size > self.max_bytes:
+            return True
+        return False
 
     def load(self):
         if not self.path:
-            return dict()
+            return self.datastore
         print('loading cache')
-        cache = dict()
         try:
-            loaded = pickle.load(open(self.path, 'rb'))
-            for t in loaded:
-                cache[t['anagram_hash']] = {'tweet': t, 'hit_count': 0}
-            print('loaded %i items to cache' % len(cache))
-            return cache
+            with open(self.path, 'rb') as f:
+                if f.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC:
+                    self._load_snapshot(f)
+                else:
+                    f.seek(0)
+                    self._load_pickle(f)
+            print('loaded %i items to cache' % len(self.datastore))
+        except ValueError as err:
+            logging.error('cache snapshot is damaged: %s' % err)
+            print('loaded %i items to cache before an error' % len(self.datastore))
         except IOError:
             logging.error('error loading cache :(')
-            return cache
+        return self.datastore
+
+    def _load_snapshot(self, f):
+        """
+        loads entries from a snapshot as it is read, through an mmap,
+        so the file is never held in memory as a whole.
+        values are kept encoded until they are first read.
+        """
+        if os.fstat(f.fileno()).st_size < len(SNAPSHOT_MAGIC) + _SNAPSHOT_HEADER.size:
+            raise ValueError('truncated header')
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            version, count = _SNAPSHOT_HEADER.unpack_from(data, len(SNAPSHOT_MAGIC))
+            if version != SNAPSHOT_VERSION:
+                raise ValueError('unknown snapshot version %d' % version)
+            pos = len(SNAPSHOT_MAGIC) + _SNAPSHOT_HEADER.size
+            size = len(data)
+            unpack_entry = _ENTRY_HEADER.unpack_from
+            for _ in range(count):
+                if pos + _ENTRY_HEADER.size > size:
+                    raise ValueError('truncated entry')
+                hit_count, key_length, value_length = unpack_entry(data, pos)
+                pos += _ENTRY_HEADER.size
+                end = pos + key_length + value_length
+                if end > size:
+                    raise ValueError('truncated entry')
+                key = data[pos:pos + key_length].decode('utf-8')
+                self._insert(key, data[pos + key_length:end], hit_count)
+                pos = end
+        finally:
+            data.close()
+
+    def _load_pickle(self, f):
+        loaded = pickle.load(f)
+        for t in loaded:
+            # keys holding several candidates are saved as lists
+            key = t[0]['anagram_hash'] if isinstance(t, list) else t['anagram_hash']
+            self._insert(key, t, 0)
 
     def save(self):
         """
-        pickles the data currently in the cache.
-        doesn't save hit_count. we don't want to keep briefly popular
-        items in cache indefinitely
+        writes the cache to a snapshot, with hit counts.
+        entries are written least used first, so that loading them in order
+        rebuilds the same least used order.
+        the snapshot is written to a temporary file and renamed over the old
+        one, so a crash while saving leaves the last snapshot intact.
         """
-        if self.path:
-            to_save = [self.datastore[t]['tweet'] for t in self.datastore]
-            try:
-                pickle.dump(to_save, open(self.path, 'wb'))
-                print('saved cache to disk with %i items' % len(to_save))
-            except:
-                logging.error('unable to save cache')
+        if not self.path:
+            return
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                out = bytearray(SNAPSHOT_MAGIC)
+                out += _SNAPSHOT_HEADER.pack(SNAPSHOT_VERSION, len(self.datastore))
+                for hits in self._counts:
+                    for key in self._buckets[hits]:
+                        encoded_key = key.encode('utf-8')
+                        value = self.datastore[key][ITEM_KEY]
+                        if not isinstance(value, bytes):
+                            value = storage.encode_value(value, key)
+                        out += _ENTRY_HEADER.pack(hits, len(encoded_key), len(value))
+                        out += encoded_key
+                        out += value
+                        if len(out) > 1 << 20:
+                            f.write(out)
+                            del out[:]
+                f.write(out)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+            print('saved cache to disk with %i items' % len(self.datastore))
+        except (IOError, OSError):
+            logging.error('unable to save cache')
 
     def least_used(self, count):
-        items = [(key, value[ITEM_KEY], value[COUNT_KEY])
-                 for key, value in self.datastore.items()]
-
-        items = sorted(items, key=itemgetter(2))
-        least_used_keys = [x for (x, y, z) in items[:count]]
+        """
+        returns up to count keys with the fewest hits.
+        ties go to the key that has gone longest without a hit.
+        """
+        least_used_keys = []
+        for hits in self._counts:
+            for key in self._buckets[hits]:
+                if len(least_used_keys) == count:
+                    return least_used_keys
+                least_used_keys.append(key)
         return least_used_keys
 
+    def pop_least_used(self, count):
+        """removes up to count of the least used entries and returns them as (key, value) pairs."""
+        popped = []
+        for key in self.least_used(count):
+            popped.append((key, self[key]))
+            del self[key]
+        return popped
+
+
+def _entry_size(key, value):
+    """a rough estimate of the memory used by a cache entry."""
+    return sys.getsizeof(key) + _value_size(value)
+
+
+def _value_size(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(map(sys.getsizeof, value.values()))
+    elif isinstance(value, list):
+        size += sum(_value_size(v) for v in value)
+    return size
+
 
 def main():
     pass
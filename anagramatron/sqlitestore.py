@@ -0,0 +1,187 @@
+from __future__ import print_function
+import os
+import sqlite3 as lite
+
+from . import common
+from .storage import StorageBackend, encode_value, decode_value
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tweets (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    seq INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tweets_seq ON tweets (seq);
+"""
+# sqlite limits the number of parameters in a single statement
+_MAX_PARAMS = 500
+
+
+class SQLiteStore(StorageBackend):
+    """
+    a single file datastore, using sqlite in WAL mode with a
+    WITHOUT ROWID table keyed on anagram hash.
+
+    writes are committed every commit_interval changes, and on close.
+    entries are numbered as they're added, so that archive()
+    can move the oldest chunk_size of them to an archive database.
+    """
+
+    def __init__(self, path, chunk_size=2000000, commit_interval=1000,
+                 compress=common.ANAGRAM_COMPRESS_RECORDS):
+        self._path = path
+        self._compress = compress
+        self._section_size = chunk_size
+        self._commit_interval = commit_interval
+        self._uncommitted = 0
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        # the AnagramFinder writer thread shares this connection; access is
+        # serialized by the finder's lock.
+        self._db = lite.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('PRAGMA mmap_size=%d' % (1 << 30))
+        self._db.executescript(_SCHEMA)
+        self._db.commit()
+        self._next_seq = self._db.execute(
+            'SELECT COALESCE(MAX(seq), 0) + 1 FROM tweets').fetchone()[0]
+
+    def __contains__(self, key):
+        return self._db.execute(
+            'SELECT 1 FROM tweets WHERE key = ?', (key,)).fetchone() is not None
+
+    def get(self, key, default=None):
+        row = self._db.execute(
+            'SELECT value FROM tweets WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return default
+        return decode_value(row[0], key)
+
+    def __setitem__(self, key, value):
+        self.put_many([(key, value)])
+
+    def __delitem__(self, key):
+        cursor = self._db.execute('DELETE FROM tweets WHERE key = ?', (key,))
+        if not cursor.rowcount:
+            raise KeyError(key)
+        self._changed(1)
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM tweets').fetchone()[0]
+
+    def get_many(self, keys):
+        keys = list(keys)
+        found = dict()
+        for i in range(0, len(keys), _MAX_PARAMS):
+            chunk = keys[i:i + _MAX_PARAMS]
+            query = 'SELECT key, value FROM tweets WHERE key IN (%s)' % (
+                ', '.join('?' for _ in chunk))
+            for key, value in self._db.execute(query, chunk):
+                found[key] = decode_value(value, key)
+        return found
+
+    def put_many(self, items):
+        rows = []
+        for key, value in items:
+            rows.append((key, encode_value(value, key, self._compress), self._next_seq))
+            self._next_seq += 1
+        # existing keys keep their place in the archive order
+        self._db.executemany(
+            'INSERT INTO tweets (key, value, seq) VALUES (?, ?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET value = excluded.value', rows)
+        self._changed(len(rows))
+
+    def items(self):
+        cursor = self._db.execute('SELECT key, value FROM tweets ORDER BY seq')
+        for key, value in cursor:
+            yield key, decode_value(value, key)
+
+    def recent_items(self):
+        """
+        iterates over (key, encoded value) pairs, newest first.
+        rows are read a page at a time, so writes can go on in between.
+        """
+        seq = self._next_seq
+        while True:
+            rows = self._db.execute(
+                'SELECT key, value, seq FROM tweets WHERE seq < ? ORDER BY seq DESC LIMIT ?',
+                (seq, _MAX_PARAMS)).fetchall()
+            if not rows:
+                return
+            for key, value, seq in rows:
+                yield key, value
+
+    def _changed(self, count):
+        self._uncommitted += count
+        if self._uncommitted >= self._commit_interval:
+            self.sync()
+
+    def sync(self):
+        self._db.commit()
+        self._uncommitted = 0
+
+    def section_count(self):
+        return max(1, -(-len(self) // self._section_size))
+
+    def archive(self):
+        """moves the oldest chunk_size entries to an archive database."""
+        self.sync()
+        destination = '%s.archive' % self._path
+        self._db.execute('ATTACH DATABASE ? AS archive', (destination,))
+        try:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS archive.tweets ('
+                'key TEXT PRIMARY KEY, value BLOB NOT NULL, seq INTEGER NOT NULL'
+                ') WITHOUT ROWID')
+            cutoff = self._db.execute(
+                'SELECT seq FROM tweets ORDER BY seq LIMIT 1 OFFSET ?',
+                (self._section_size,)).fetchone()
+            if cutoff is None:
+                # the whole store is smaller than one chunk
+                cutoff = (self._next_seq,)
+            self._db.execute(
+                'INSERT OR REPLACE INTO archive.tweets '
+                'SELECT key, value, seq FROM tweets WHERE seq < ?', cutoff)
+            self._db.execute('DELETE FROM tweets WHERE seq < ?', cutoff)
+            self._db.commit()
+        finally:
+            self._db.execute('DETACH DATABASE archive')
+        return destination
+
+    def close(self):
+        self.sync()
+        self._db.close()
+
+
+def main():
+    import argparse
+    import random
+    from . import multidbm, storage
+    parser = argparse.ArgumentParser(
+        description="copies an mdbm datastore into a sqlite datastore")
+    parser.add_argument('mdbm', type=str, help="source mdbm directory")
+    parser.add_argument('db', type=str, help="destination sqlite file")
+    parser.add_argument('--bench', type=int, default=0, metavar='N',
+                        help="compare lookup latency over N keys after copying")
+    args = parser.parse_args()
+
+    source = multidbm.MultiDBM(args.mdbm)
+    destination = SQLiteStore(args.db)
+    try:
+        storage.migrate(source, destination)
+        destination.sync()
+        if args.bench:
+            keys = [k for _, k in zip(range(args.bench), source.keys())]
+            keys += ['%s@' % k for k in keys]  # misses
+            random.shuffle(keys)
+            print('mdbm lookup:   %0.1fus' % (storage.lookup_latency(source, keys) * 1e6))
+            print('sqlite lookup: %0.1fus' % (storage.lookup_latency(destination, keys) * 1e6))
+    finally:
+        source.close()
+        destination.close()
+
+
+if __name__ == "__main__":
+    main()
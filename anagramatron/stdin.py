@@ -4,7 +4,8 @@
 '''A simple tool for profiling over stdin'''
 import sys
 import tempfile
-from . import anagramfinder
+from itertools import islice
+from . import anagramfinder, common
 
 
 class Stats(object):
@@ -18,14 +19,23 @@ class Stats(object):
 
 
 def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-b', '--batch-size', help="number of lines handled per batch",
+                        type=int, default=common.ANAGRAM_BATCH_SIZE)
+    args = parser.parse_args()
+
     stats = Stats()
     tempdir = tempfile.TemporaryDirectory()
     print("storing in temp dir %s" % tempdir, file=sys.stderr)
 
     finder = anagramfinder.AnagramFinder(storage='mdbm', hit_callback=stats, path=tempdir.name)
-    for line in sys.stdin:
-        stats.seen += 1
-        finder.handle_input(line)
+    while True:
+        batch = list(islice(sys.stdin, args.batch_size))
+        if not batch:
+            break
+        stats.seen += len(batch)
+        finder.handle_many(batch)
 
     for one, two in stats.hits:
         print("---------\n{}--↕︎--\n{}".format(one, two));
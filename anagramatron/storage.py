@@ -0,0 +1,207 @@
+from __future__ import print_function
+import json
+import sys
+import time
+
+from . import anagramfunctions, records
+
+
+class StorageBackend(object):
+    """
+    the interface AnagramFinder expects of a persistent datastore.
+
+    keys are anagram hashes (str). values are tweet dicts or strings, or
+    lists of them for keys holding several candidates, and are encoded with encode_value/decode_value.
+    backends take a compress argument, which deflates stored text.
+    """
+
+    def __contains__(self, key):
+        raise NotImplementedError
+
+    def __getitem__(self, key):
+        val = self.get(key)
+        if val is None:
+            raise KeyError(key)
+        return val
+
+    def __setitem__(self, key, value):
+        raise NotImplementedError
+
+    def __delitem__(self, key):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def __bool__(self):
+        # an empty store is still a store
+        return True
+
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def get_with_location(self, key, default=None):
+        """
+        returns (value, position) for key, where position is the index of the
+        section holding it, or (default, None) if key isn't found.
+        """
+        val = self.get(key)
+        if val is None:
+            return default, None
+        return val, 0
+
+    def get_many(self, keys):
+        """returns a dict of the values for those keys that are found."""
+        found = dict()
+        for key in keys:
+            val = self.get(key)
+            if val is not None:
+                found[key] = val
+        return found
+
+    def put_many(self, items):
+        """stores an iterable of (key, value) pairs."""
+        for key, value in items:
+            self[key] = value
+
+    def items(self):
+        """iterates over all (key, value) pairs in the store."""
+        raise NotImplementedError
+
+    def keys(self):
+        for key, _ in self.items():
+            yield key
+
+    def recent_items(self):
+        """
+        iterates over (key, encoded value) pairs, newest first.
+        values are left as stored; decode them with decode_value.
+        """
+        raise NotImplementedError
+
+    def archive(self):
+        """
+        moves the oldest entries out of the live store.
+        returns a description of where they went, or None.
+        """
+        return None
+
+    def section_count(self):
+        return 1
+
+    def enforce_retention(self, policy, lock=None):
+        """
+        archives the oldest entries until the store is within policy.
+        if lock is given, it is held while the store is changed.
+        returns a list describing where they went.
+        """
+        return []
+
+    def close(self):
+        raise NotImplementedError
+
+
+class RetentionPolicy(object):
+    """
+    how much a datastore keeps before its oldest entries are archived.
+    a limit of None is no limit.
+
+    :max_age: seconds since the newest entry in a chunk was written.
+    :max_keys: keys in the whole store.
+    :max_bytes: bytes on disk for the whole store.
+    """
+
+    def __init__(self, max_age=None, max_keys=None, max_bytes=None):
+        self.max_age = max_age
+        self.max_keys = max_keys
+        self.max_bytes = max_bytes
+
+    def __bool__(self):
+        return any(limit is not None for limit in (self.max_age, self.max_keys, self.max_bytes))
+
+    def __repr__(self):
+        return 'RetentionPolicy(max_age=%r, max_keys=%r, max_bytes=%r)' % (
+            self.max_age, self.max_keys, self.max_bytes)
+
+    def expired_count(self, chunks, now=None):
+        """
+        takes a list of chunks, oldest first, as dicts with 'keys', 'bytes'
+        and 'sealed' (the time the chunk stopped taking new keys, or None
+        if it still does). returns how many of the oldest chunks to archive.
+        a chunk that is still taking keys is never archived.
+        """
+        if now is None:
+            now = time.time()
+        total_keys = sum(c['keys'] for c in chunks)
+        total_bytes = sum(c['bytes'] for c in chunks)
+        count = 0
+        for chunk in chunks:
+            if chunk['sealed'] is None:
+                break
+            too_old = self.max_age is not None and now - chunk['sealed'] > self.max_age
+            too_many = self.max_keys is not None and total_keys > self.max_keys
+            too_big = self.max_bytes is not None and total_bytes > self.max_bytes
+            if not (too_old or too_many or too_big):
+                break
+            total_keys -= chunk['keys']
+            total_bytes -= chunk['bytes']
+            count += 1
+        return count
+
+
+def encode_value(value, key=None, compress=False):
+    """
+    returns the bytes stored for a tweet dict or string under key.
+    values that don't fit the compact record format are stored as JSON.
+    """
+    record = records.encode_record(value, key, compress)
+    if record is not None:
+        return record
+    if isinstance(value, dict):
+        value = anagramfunctions.encode_tweet(value)
+    elif isinstance(value, list):
+        value = json.dumps(value)
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return value
+
+
+def decode_value(val, key=None):
+    """decodes a stored value. records, JSON and plain text are all accepted."""
+    return records.decode_record(val, key)
+
+
+def migrate(source, destination, batch_size=10000, verbose=True):
+    """
+    copies every entry in source into destination.
+    returns the number of entries copied.
+    """
+    count = 0
+    batch = []
+    for item in source.items():
+        batch.append(item)
+        if len(batch) == batch_size:
+            destination.put_many(batch)
+            count += len(batch)
+            batch = []
+            if verbose:
+                sys.stdout.write('copied: %i\t\t\r' % count)
+                sys.stdout.flush()
+    destination.put_many(batch)
+    count += len(batch)
+    if verbose:
+        print('\ncopied %i entries' % count)
+    return count
+
+
+def lookup_latency(store, keys):
+    """
+    returns the mean time in seconds to look up each of keys in store.
+    keys should be a mix of keys that are and aren't present.
+    """
+    if not keys:
+        return 0.0
+    start = time.perf_counter()
+    for key in keys:
+        store.get(key)
+    return (time.perf_counter() - start) / len(keys)
@@ -3,18 +3,125 @@ from __future__ import print_function
 import logging
 import queue as Queue
 import multiprocessing
+import threading
 import time
 
 from collections import deque
 
 
-from . import anagramfunctions, twitterhandler
+from . import anagramfunctions
 from .anagramstats import StatTracker
-from zmqstream.consumer import zmq_iter
 
-from .common import (ANAGRAM_STREAM_BUFFER_SIZE)
+from .common import (ANAGRAM_STREAM_BUFFER_SIZE, ANAGRAM_BATCH_SIZE, ANAGRAM_FILTER_WORKERS)
 
-SECONDS_SINCE_LAUNCH_TO_IGNORE_BUFFER = 60 * 60 * 2
+# raw tweets filtered together in the stream process
+FILTER_BATCH_SIZE = 100
+# seconds a partial batch of raw tweets waits before it is filtered anyway
+FILTER_MAX_WAIT = 1.0
+# batches of raw tweets waiting for each filter worker before the receiver blocks
+RAW_QUEUE_SIZE = 100
+# tweets yielded from the buffer between checks of the queue and stats
+_ITER_CHUNK_SIZE = 100
+
+
+def _filter_fields(tweet):
+    """
+    returns a copy of a raw tweet with only the fields filter_tweet reads,
+    so less is pickled on the way to a filter worker.
+    """
+    entities = tweet.get('entities')
+    if entities is not None:
+        entities = {'user_mentions': entities.get('user_mentions'),
+                    'urls': entities.get('urls')}
+    return {'id_str': tweet.get('id_str'),
+            'lang': tweet.get('lang'),
+            'text': tweet.get('text'),
+            'entities': entities,
+            'retweeted_status': bool(tweet.get('retweeted_status'))}
+
+
+def _filter_batch(batch, queue, counters, worker):
+    """filters a batch of raw tweets and puts the survivors on queue, as one list."""
+    processed_tweets = anagramfunctions.filter_tweets(batch)
+    # each worker has its own pair of counters, so they need no lock
+    counters[worker * 2] += len(batch)
+    counters[worker * 2 + 1] += len(processed_tweets)
+    if processed_tweets:
+        try:
+            queue.put(processed_tweets, block=False)
+        except Queue.Full:
+            pass
+
+
+def _run_filter_worker(worker, raw_queue, queue, counters):
+    """
+    the body of a filter worker process. filters batches of raw tweets
+    from raw_queue until it gets None.
+    """
+    while True:
+        batch = raw_queue.get()
+        if batch is None:
+            return
+        _filter_batch(batch, queue, counters, worker)
+
+
+class _RawBatcher(object):
+    """
+    collects raw tweets in the stream process into batches of
+    FILTER_BATCH_SIZE, and filters them or hands them to the filter workers
+    in turn. a partial batch is handed on once it is max_wait seconds old,
+    by a thread, so tweets don't wait on a quiet stream.
+    """
+
+    def __init__(self, queue, counters, raw_queues, max_wait=FILTER_MAX_WAIT):
+        self.queue = queue
+        self.counters = counters
+        self.raw_queues = raw_queues
+        self.max_wait = max_wait
+        self._batch = []
+        self._started = None
+        self._worker = 0
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = None
+
+    def start(self):
+        self._flusher = threading.Thread(target=self._flush_stale)
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def add(self, tweet):
+        with self._lock:
+            if not self._batch:
+                self._started = time.time()
+            self._batch.append(_filter_fields(tweet) if self.raw_queues else tweet)
+            if len(self._batch) >= FILTER_BATCH_SIZE:
+                self._flush()
+
+    def close(self):
+        """stops the flushing thread, and hands on any partial batch."""
+        self._closed.set()
+        if self._flusher:
+            self._flusher.join()
+        with self._lock:
+            self._flush()
+
+    def _flush_stale(self):
+        while not self._closed.wait(self.max_wait / 4):
+            with self._lock:
+                if self._batch and time.time() - self._started >= self.max_wait:
+                    self._flush()
+
+    def _flush(self):
+        batch = self._batch
+        if not batch:
+            return
+        self._batch = []
+        if self.raw_queues:
+            self.raw_queues[self._worker].put(batch)
+            self._worker = (self._worker + 1) % len(self.raw_queues)
+        else:
+            _filter_batch(batch, self.queue, self.counters, 0)
 
 
 class StreamHandler(object):
@@ -22,6 +129,10 @@ class StreamHandler(object):
     """
     handles twitter stream connections. Buffers incoming tweets and
     acts as an iter.
+
+    :filter_workers: the number of processes filtering tweets. with more
+    than one, a receiver process reads the stream and hands batches of raw
+    tweets to the workers in turn.
     """
 
     def __init__(self,
@@ -29,7 +140,8 @@ class StreamHandler(object):
                  timeout=90,
                  languages=['en'],
                  host="127.0.0.1",
-                 port="8069"
+                 port="8069",
+                 filter_workers=ANAGRAM_FILTER_WORKERS
                  ):
         self.buffersize = buffersize
         self.timeout = timeout
@@ -37,66 +149,63 @@ class StreamHandler(object):
         self.host = host
         self.port = port
         print(host, port)
+        self.filter_workers = max(1, filter_workers)
         self.stream_process = None
+        self.filter_processes = []
         self.queue = multiprocessing.Queue()
         self._buffer = deque()
         self._should_return = False
         self._iter = self.__iter__()
-        self._tweets_seen = multiprocessing.Value('L', 0)
-        self._passed_filter = multiprocessing.Value('L', 0)
-        self._lock = multiprocessing.Lock()
+        # (seen, passed) for each filter worker. these only ever grow;
+        # we keep the last totals we saw, and add the difference to stats.
+        self._counters = multiprocessing.Array('L', self.filter_workers * 2, lock=False)
+        self._last_counts = [0] * (self.filter_workers * 2)
         self._start_time = time.time()
         self._last_message_check = self._start_time
         self.stats = StatTracker()
 
     def update_stats(self):
-        with self._lock:
-            if self._tweets_seen.value:
-                self.stats['tweets_seen'] += self._tweets_seen.value
-                self._tweets_seen.value = 0
-            if self._passed_filter.value:
-                self.stats['passed_filter'] += self._passed_filter.value
-                self._passed_filter.value = 0
+        counts = self._counters[:]
+        self.stats['tweets_seen'] += sum(counts[0::2]) - sum(self._last_counts[0::2])
+        self.stats['passed_filter'] += sum(counts[1::2]) - sum(self._last_counts[1::2])
+        self._last_counts = counts
+        self.stats['filter_workers'] = [{'seen': counts[i], 'passed': counts[i + 1]}
+                                        for i in range(0, len(counts), 2)]
         self.stats['buffer'] = self.bufferlength()
 
     def __iter__(self):
         """
         the connection to twitter is handled in another process
-        new tweets are added to self.queue as they arrive.
-        on each call to iter we move any tweets in the queue to a fifo buffer
+        new tweets are added to self.queue as they arrive, in lists.
+        we move any lists in the queue to a fifo buffer, then yield up to
+        _ITER_CHUNK_SIZE tweets from it before checking the queue again.
         this makes keeping track of the buffer size a lot cleaner.
         """
         while 1:
             if self._should_return:
                 print('breaking iteration')
-                raise StopIteration
+                return
             while 1:
                 # add all new items from the queue to the buffer
                 try:
-                    self._buffer.append(self.queue.get_nowait())
+                    self._buffer.extend(self.queue.get_nowait())
                 except Queue.Empty:
                     break
             try:
-                # after launch we don't have any keys in memory, so processing is slow.
-                # this checks if launch was recent, and resets the buffer if it
-                # was.
-                if len(self._buffer) > ANAGRAM_STREAM_BUFFER_SIZE * 0.9:
-                    if time.time() - self._start_time < SECONDS_SINCE_LAUNCH_TO_IGNORE_BUFFER:
-                        self._buffer = deque()
-                        logging.debug('recent launch, reset buffer')
-
+                # a growing buffer is handled by overload.OverloadController
                 self.update_stats()
                 # 5 minutes
                 if time.time() - self._last_message_check > (5 * 60):
                     self._last_message_check = time.time()
+                    from . import twitterhandler
                     twitterhandler.TwitterHandler().handle_directs()
 
                 if len(self._buffer):
-                    # if there's a buffer element return it
-                    yield self._buffer.popleft()
+                    # if there are buffered tweets return some of them
+                    for _ in range(min(len(self._buffer), _ITER_CHUNK_SIZE)):
+                        yield self._buffer.popleft()
                 else:
-                    yield self.queue.get(True, self.timeout)
-                    continue
+                    self._buffer.extend(self.queue.get(True, self.timeout))
             except Queue.Empty:
                 print('queue timeout')
         print('exiting iter loop')
@@ -104,6 +213,18 @@ class StreamHandler(object):
     def next(self):
         return self._iter.next()
 
+    def batches(self, batch_size=ANAGRAM_BATCH_SIZE):
+        """
+        iterates over lists of up to batch_size tweets.
+        a partial batch is returned rather than waiting on an empty buffer.
+        """
+        batch = []
+        for tweet in self:
+            batch.append(tweet)
+            if len(batch) >= batch_size or not self._buffer:
+                yield batch
+                batch = []
+
     def start(self):
         """
         creates a new thread and starts a streaming connection.
@@ -115,24 +236,44 @@ class StreamHandler(object):
         if self.stream_process is not None:
             print('terminating existing server connection')
             logging.debug('terminating existing server connection')
-            self.stream_process.terminate()
+            self._terminate()
             if self.stream_process.is_alive():
                 pass
             else:
                 print('thread terminated successfully')
                 logging.debug('thread terminated successfully')
 
+        raw_queues = []
+        self.filter_processes = []
+        if self.filter_workers > 1:
+            for worker in range(self.filter_workers):
+                raw_queue = multiprocessing.Queue(RAW_QUEUE_SIZE)
+                process = multiprocessing.Process(
+                    target=_run_filter_worker,
+                    args=(worker, raw_queue, self.queue, self._counters))
+                process.daemon = True
+                process.start()
+                raw_queues.append(raw_queue)
+                self.filter_processes.append(process)
+
         self.stream_process = multiprocessing.Process(
             target=self._run,
             args=(self.queue,
-                  self._tweets_seen,
-                  self._passed_filter,
-                  self._lock,
+                  self._counters,
+                  raw_queues,
                   self.languages))
         self.stream_process.daemon = True
         self.stream_process.start()
 
         print('created process %i' % self.stream_process.pid)
+        if self.filter_processes:
+            print('created filter workers %s' % ', '.join(
+                str(p.pid) for p in self.filter_processes))
+
+    def _terminate(self):
+        self.stream_process.terminate()
+        for process in self.filter_processes:
+            process.terminate()
 
     def close(self):
         """
@@ -140,7 +281,7 @@ class StreamHandler(object):
         """
         self._should_return = True
         if self.stream_process:
-            self.stream_process.terminate()
+            self._terminate()
         print("\nstream handler closed with buffer size %i" %
               (self.bufferlength()))
         logging.debug("stream handler closed with buffer size %i" %
@@ -149,30 +290,33 @@ class StreamHandler(object):
     def bufferlength(self):
         return len(self._buffer)
 
-    def _run(self, queue, seen, passed, lock, languages):
+    @property
+    def backlog(self):
+        """the deque of tweets received but not yet returned."""
+        return self._buffer
+
+    def _run(self, queue, counters, raw_queues, languages):
         """
         handle connection to streaming endpoint.
-        adds incoming tweets to queue.
+        adds incoming tweets to queue, or if there are filter workers,
+        hands batches of raw tweets to them in turn.
         runs in own process.
-        errors is a queue we use to transmit exceptions to parent process.
         """
+        from zmqstream.consumer import zmq_iter
 
         stream_iter = zmq_iter(host=self.host, port=self.port)
         logging.debug('stream begun')
-        for tweet in stream_iter:
-            if not isinstance(tweet, dict):
-                continue
-            if tweet.get('text'):
-                with lock:
-                    seen.value += 1
-                processed_tweet = anagramfunctions.filter_tweet(tweet)
-                if processed_tweet:
-                    with lock:
-                        passed.value += 1
-                    try:
-                        queue.put(processed_tweet, block=False)
-                    except Queue.Full:
-                        pass
+        batcher = _RawBatcher(queue, counters, raw_queues)
+        batcher.start()
+        try:
+            for tweet in stream_iter:
+                if not isinstance(tweet, dict):
+                    continue
+                if not tweet.get('text'):
+                    continue
+                batcher.add(tweet)
+        finally:
+            batcher.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,103 @@
+# coding: utf-8
+"""
+micro-benchmark for anagram key generation.
+
+compares improved_hash against the original regex implementation
+over a corpus of stored tweets, and checks that both produce identical keys.
+
+usage: python -m benchmarks.hash_keys [corpus ...]
+
+a corpus is either a pickled cache dump (a list of tweet dicts),
+an mdbm directory, or a text file with one tweet per line.
+with no arguments the default cache dump in ANAGRAM_DATA_DIR is used.
+"""
+from __future__ import print_function
+
+import os
+import pickle
+import sys
+import time
+
+from anagramatron import anagramfunctions, common
+
+
+def load_corpus(path):
+    """returns a list of tweet texts stored at path"""
+    if os.path.isdir(path):
+        return _load_mdbm_texts(path)
+    try:
+        with open(path, 'rb') as f:
+            tweets = pickle.load(f)
+        return [t.get('text') or t.get('tweet_text') for t in tweets]
+    except (pickle.UnpicklingError, EOFError, ValueError):
+        with open(path, 'r', encoding='utf-8') as f:
+            return [line.rstrip('\n') for line in f if line.strip()]
+
+
+def _load_mdbm_texts(path):
+    from anagramatron import multidbm
+    texts = []
+    store = multidbm.MultiDBM(path)
+    try:
+        for db in store._data:
+            k = db.firstkey()
+            while k is not None:
+                key = k.decode('utf-8')
+                if key != multidbm._PATHKEY:
+                    value = store[key]
+                    texts.append(value['text'] if isinstance(value, dict) else value)
+                k = db.nextkey(k)
+    finally:
+        store.close()
+    return texts
+
+
+def time_keys(hash_func, texts, repeat=3):
+    """returns the best keys/sec over repeat runs"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in texts:
+            hash_func(text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(texts) / (best or 1e-9)
+
+
+def run(texts, repeat=3):
+    mismatches = [t for t in texts
+                  if anagramfunctions.improved_hash(t) !=
+                  anagramfunctions._regex_improved_hash(t)]
+    if mismatches:
+        print('%d keys differ from the reference, e.g. %r' %
+              (len(mismatches), mismatches[0]), file=sys.stderr)
+        return 1
+
+    legacy = time_keys(anagramfunctions._regex_improved_hash, texts, repeat)
+    current = time_keys(anagramfunctions.improved_hash, texts, repeat)
+    print('tweets: %d' % len(texts))
+    print('regex improved_hash: %0.0f keys/sec' % legacy)
+    print('improved_hash:       %0.0f keys/sec' % current)
+    print('speedup:             %0.2fx' % (current / legacy))
+    return 0
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('corpus', nargs='*', help='cache dump, mdbm dir or text file')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    paths = args.corpus or [os.path.join(common.ANAGRAM_DATA_DIR, 'cachedump_en.cache')]
+    texts = []
+    for path in paths:
+        texts.extend(load_corpus(path))
+    if not texts:
+        print('no tweets found in %s' % ', '.join(paths), file=sys.stderr)
+        return 1
+    return run(texts, args.repeat)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
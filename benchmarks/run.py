@@ -0,0 +1,363 @@
+# coding: utf-8
+"""
+benchmarks for the ingest hot path.
+
+usage: python -m benchmarks.run [-n COUNT] [-o results.json] [--compare old.json] [name ...]
+
+results are written as JSON, so runs can be compared between releases.
+each result records the number of operations, the best time over --repeat
+runs, and operations per second.
+"""
+from __future__ import print_function
+
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+from anagramatron import anagramfunctions, simpledatastore
+from . import synthetic
+
+RESULTS_VERSION = 1
+
+
+def _timed(func, repeat):
+    """returns the best wall time of repeat calls to func."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _result(ops, seconds, **extra):
+    result = OrderedDict([('ops', ops), ('seconds', seconds),
+                          ('ops_per_sec', ops / (seconds or 1e-9))])
+    result.update(extra)
+    return result
+
+
+def bench_improved_hash(args):
+    texts = list(synthetic.generate_texts(args.count, seed=args.seed))
+    seconds = _timed(lambda: [anagramfunctions.improved_hash(t) for t in texts], args.repeat)
+    reference = _timed(lambda: [anagramfunctions._regex_improved_hash(t) for t in texts], 1)
+    return _result(len(texts), seconds, speedup_over_regex=reference / seconds)
+
+
+def bench_filter_tweet(args):
+    tweets = list(synthetic.generate_tweets(args.count, seed=args.seed))
+    passed = len([t for t in tweets if anagramfunctions.filter_tweet(t)])
+    seconds = _timed(lambda: [anagramfunctions.filter_tweet(t) for t in tweets], args.repeat)
+    return _result(len(tweets), seconds, passed=passed)
+
+
+def bench_filter_tweets(args):
+    tweets = list(synthetic.generate_tweets(args.count, seed=args.seed))
+    batches = [tweets[i:i + 100] for i in range(0, len(tweets), 100)]
+    tweet_filter = anagramfunctions.TweetFilter()
+    passed = sum(len(tweet_filter.filter_tweets(b)) for b in batches)
+    seconds = _timed(lambda: [tweet_filter.filter_tweets(b) for b in batches], args.repeat)
+    reference = _timed(lambda: [anagramfunctions.filter_tweet(t) for t in tweets], 1)
+    return _result(len(tweets), seconds, passed=passed, speedup_over_filter_tweet=reference / seconds)
+
+
+def bench_test_anagram(args):
+    import random
+    rng = random.Random(args.seed)
+    texts = list(synthetic.generate_texts(args.count // 4, seed=args.seed))
+    pairs = []
+    for text in texts:
+        pairs.append((text, synthetic._anagram_of(text, rng)))
+        words = text.split()
+        rng.shuffle(words)
+        pairs.append((text, ' '.join(words)))
+    passed = len([p for p in pairs if anagramfunctions.test_anagram(*p)])
+
+    def compare():
+        # time normalization too, not just the cached results of the last run
+        anagramfunctions.normalized_text.cache_clear()
+        return [anagramfunctions.test_anagram(*p) for p in pairs]
+    seconds = _timed(compare, args.repeat)
+    reference = _timed(lambda: [anagramfunctions._regex_test_anagram(*p) for p in pairs], 1)
+    return _result(len(pairs), seconds, passed=passed, speedup_over_regex=reference / seconds)
+
+
+def bench_simplestore_set(args):
+    texts = list(synthetic.generate_texts(args.count, seed=args.seed))
+    keys = [anagramfunctions.improved_hash(t) for t in texts]
+
+    def fill():
+        store = simpledatastore.AnagramSimpleStore()
+        for key, text in zip(keys, texts):
+            store[key] = text
+    return _result(len(keys), _timed(fill, args.repeat))
+
+
+def bench_simplestore_least_used(args):
+    store = simpledatastore.AnagramSimpleStore()
+    for i, text in enumerate(synthetic.generate_texts(args.count, seed=args.seed)):
+        store[anagramfunctions.improved_hash(text)] = text
+        if i % 3 == 0:
+            store[anagramfunctions.improved_hash(text)] = text
+    to_trim = max(1, len(store) // 20)
+    return _result(1, _timed(lambda: store.least_used(to_trim), args.repeat),
+                   store_size=len(store), trimmed=to_trim)
+
+
+def bench_cache_snapshot(args):
+    import pickle
+    tempdir = tempfile.mkdtemp()
+    path = os.path.join(tempdir, 'cache')
+    try:
+        store = simpledatastore.AnagramSimpleStore(path)
+        for i, text in enumerate(synthetic.generate_texts(args.count, seed=args.seed)):
+            key = anagramfunctions.improved_hash(text)
+            store[key] = {'anagram_hash': key, 'tweet_id': i, 'text': text}
+        save = _timed(store.save, args.repeat)
+        load = _timed(lambda: simpledatastore.AnagramSimpleStore(path), args.repeat)
+        snapshot_bytes = os.path.getsize(path)
+        with open(path, 'wb') as f:
+            pickle.dump([store[k] for k in store.datastore], f)
+        pickle_load = _timed(lambda: simpledatastore.AnagramSimpleStore(path), args.repeat)
+    finally:
+        shutil.rmtree(tempdir)
+    return OrderedDict([
+        ('entries', len(store)),
+        ('snapshot_bytes', snapshot_bytes),
+        ('save', _result(len(store), save)),
+        ('load', _result(len(store), load)),
+        ('pickle_load', _result(len(store), pickle_load)),
+    ])
+
+
+def _multidbm_with_chunks(path, texts, chunks):
+    from anagramatron import multidbm
+    store = multidbm.MultiDBM(path, chunk_size=max(1, len(texts) // chunks))
+    for i, text in enumerate(texts):
+        key = anagramfunctions.improved_hash(text)
+        store[key] = {'anagram_hash': key, 'tweet_id': i, 'text': text}
+    return store
+
+
+def bench_multidbm(args):
+    texts = list(synthetic.generate_texts(args.count, seed=args.seed))
+    present = [anagramfunctions.improved_hash(t) for t in texts[::10]]
+    missing = [anagramfunctions.improved_hash(t) for t in
+               synthetic.generate_texts(len(present), seed=args.seed + 1)]
+    missing = [k for k in missing if k not in set(present)]
+    tempdir = tempfile.mkdtemp()
+    try:
+        store = _multidbm_with_chunks(os.path.join(tempdir, 'mdbm'), texts, args.chunks)
+        try:
+            get_hits = _timed(lambda: [store.get(k) for k in present], args.repeat)
+            get_misses = _timed(lambda: [store.get(k) for k in missing], args.repeat)
+            contains = _timed(lambda: [k in store for k in present + missing], args.repeat)
+            chunk_count = store.section_count()
+        finally:
+            store.close()
+    finally:
+        shutil.rmtree(tempdir)
+    return OrderedDict([
+        ('chunks', chunk_count),
+        ('get_hit', _result(len(present), get_hits)),
+        ('get_miss', _result(len(missing), get_misses)),
+        ('contains', _result(len(present) + len(missing), contains)),
+    ])
+
+
+def _run_finder(args, storage, batch_size, duplicate_rate=0.0, **finder_kwargs):
+    from anagramatron import anagramfinder
+    tweets = [t for t in (anagramfunctions.filter_tweet(t) for t in
+                          synthetic.generate_tweets(args.count, anagram_rate=args.anagram_rate,
+                                                    duplicate_rate=duplicate_rate,
+                                                    seed=args.seed)) if t]
+    hits = []
+    tempdir = tempfile.mkdtemp()
+    try:
+        finder = anagramfinder.AnagramFinder(
+            storage=storage, path=os.path.join(tempdir, 'store'),
+            cache_size=max(10, len(tweets) // 10),
+            hit_callback=lambda one, two: hits.append(one), **finder_kwargs)
+        # start cold, rather than from the cache saved in the data directory
+        finder.cache = simpledatastore.AnagramSimpleStore(max_items=finder.cache_size)
+        start = time.perf_counter()
+        if batch_size:
+            for i in range(0, len(tweets), batch_size):
+                finder.handle_many(tweets[i:i + batch_size])
+        else:
+            for tweet in tweets:
+                finder.handle_input(tweet)
+        if storage:
+            finder.flush()
+        seconds = time.perf_counter() - start
+        finder.close()
+    finally:
+        shutil.rmtree(tempdir)
+    return _result(len(tweets), seconds, hits=len(hits),
+                   duplicates_dropped=finder.stats['duplicates_dropped'])
+
+
+def bench_finder(args):
+    results = OrderedDict()
+    results['handle_input_memory'] = _run_finder(args, None, 0)
+    results['handle_many_memory'] = _run_finder(args, None, args.batch_size)
+    results['handle_input_mdbm'] = _run_finder(args, 'mdbm', 0)
+    results['handle_many_mdbm'] = _run_finder(args, 'mdbm', args.batch_size)
+    return results
+
+
+def _produce(queue, tweets, batch_size):
+    if batch_size:
+        for i in range(0, len(tweets), batch_size):
+            queue.put(tweets[i:i + batch_size])
+    else:
+        for tweet in tweets:
+            queue.put(tweet)
+    queue.put(None)
+
+
+def _transport(tweets, batch_size):
+    """returns the time to pass tweets from another process over a Queue."""
+    import multiprocessing
+    queue = multiprocessing.Queue()
+    producer = multiprocessing.Process(target=_produce, args=(queue, tweets, batch_size))
+    start = time.perf_counter()
+    producer.start()
+    received = 0
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        received += len(item) if batch_size else 1
+    seconds = time.perf_counter() - start
+    producer.join()
+    assert received == len(tweets)
+    return seconds
+
+
+def bench_queue_transport(args):
+    """stream process to finder: one put per tweet, and one put per filter batch."""
+    tweets = anagramfunctions.filter_tweets(list(synthetic.generate_tweets(args.count,
+                                                                           seed=args.seed)))
+    results = OrderedDict()
+    results['per_tweet'] = _result(len(tweets), _timed(lambda: _transport(tweets, 0), args.repeat))
+    results['batched'] = _result(len(tweets), _timed(lambda: _transport(tweets, 40), args.repeat))
+    return results
+
+
+def bench_duplicate_flood(args):
+    """the finder on a stream where a third of tweets repeat a few trending tweets."""
+    results = OrderedDict()
+    results['fingerprinted'] = _run_finder(args, None, args.batch_size, duplicate_rate=0.3)
+    results['unfingerprinted'] = _run_finder(args, None, args.batch_size, duplicate_rate=0.3,
+                                             duplicate_keys=0)
+    return results
+
+
+BENCHMARKS = OrderedDict([
+    ('improved_hash', bench_improved_hash),
+    ('filter_tweet', bench_filter_tweet),
+    ('filter_tweets', bench_filter_tweets),
+    ('test_anagram', bench_test_anagram),
+    ('simplestore_set', bench_simplestore_set),
+    ('simplestore_least_used', bench_simplestore_least_used),
+    ('cache_snapshot', bench_cache_snapshot),
+    ('multidbm', bench_multidbm),
+    ('queue_transport', bench_queue_transport),
+    ('finder', bench_finder),
+    ('duplicate_flood', bench_duplicate_flood),
+])
+
+
+def run(args):
+    results = OrderedDict()
+    for name, bench in BENCHMARKS.items():
+        if args.names and name not in args.names:
+            continue
+        print('running %s' % name, file=sys.stderr)
+        try:
+            results[name] = bench(args)
+        except ImportError as err:
+            # e.g. no gdbm in this python
+            results[name] = {'skipped': str(err)}
+    return OrderedDict([
+        ('version', RESULTS_VERSION),
+        ('timestamp', time.time()),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('params', OrderedDict([('count', args.count), ('seed', args.seed),
+                                ('repeat', args.repeat), ('chunks', args.chunks),
+                                ('anagram_rate', args.anagram_rate),
+                                ('batch_size', args.batch_size)])),
+        ('results', results),
+    ])
+
+
+def _rates(results, prefix=''):
+    """flattens nested results into a dict of name: ops_per_sec."""
+    rates = dict()
+    for name, result in results.items():
+        if not isinstance(result, dict):
+            continue
+        if 'ops_per_sec' in result:
+            rates[prefix + name] = result['ops_per_sec']
+        else:
+            rates.update(_rates(result, '%s%s.' % (prefix, name)))
+    return rates
+
+
+def compare(old, new):
+    """prints the change in ops/sec for each benchmark in both result sets."""
+    old_rates = _rates(old['results'])
+    for name, rate in sorted(_rates(new['results']).items()):
+        if name in old_rates:
+            print('%-40s %12.0f ops/s  %+6.1f%%' % (
+                name, rate, (rate / old_rates[name] - 1) * 100), file=sys.stderr)
+        else:
+            print('%-40s %12.0f ops/s' % (name, rate), file=sys.stderr)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default: all)',
+                        metavar='name')
+    parser.add_argument('-n', '--count', type=int, default=20000,
+                        help='number of synthetic tweets')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunks', type=int, default=8, help='MultiDBM chunk count')
+    parser.add_argument('--anagram-rate', type=float, default=0.01)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('-o', '--output', help='write JSON results here instead of stdout')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    unknown = [n for n in args.names if n not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmarks: %s (choose from %s)' % (
+            ', '.join(unknown), ', '.join(BENCHMARKS)))
+
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    previous = {'results': {}}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    compare(previous, results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
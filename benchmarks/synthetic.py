@@ -0,0 +1,135 @@
+# coding: utf-8
+"""
+a deterministic generator of synthetic stream tweets.
+
+tweets look like the dicts the stream delivers, so they can be run through
+filter_tweet. a configurable share of them are planted anagrams of an
+earlier tweet: the same letters rearranged into different words, so they
+should pass test_anagram. some tweets are made to fail the filters
+(other languages, links, mentions, retweets, numbers) at a fixed rate,
+and some can be made near-exact repeats of a few trending tweets.
+"""
+from __future__ import print_function
+
+import random
+
+WORDS = (
+    "the be to of and a in that have it for not on with he as you do at this "
+    "but his by from they we say her she or an will my one all would there "
+    "their what so up out if about who get which go me when make can like "
+    "time no just him know take people into year your good some could them "
+    "see other than then now look only come its over think also back after "
+    "use two how our work first well way even new want because any these "
+    "give day most us love today night morning tired happy weekend coffee "
+    "school friday monday music movie dinner sleep phone game team party "
+    "really never always little great bored hate miss feel tonight tomorrow "
+    "life world friends family summer winter rain snow beautiful finally"
+).split()
+
+REJECT_REASONS = ('lang', 'url', 'mention', 'retweet', 'digits')
+
+
+def _entities(urls=(), mentions=()):
+    return {'hashtags': [], 'symbols': [], 'urls': list(urls), 'user_mentions': list(mentions)}
+
+
+def _tweet(tweet_id, text, lang='en', entities=None, retweeted=None):
+    tweet = {
+        'id': tweet_id,
+        'id_str': str(tweet_id),
+        'lang': lang,
+        'text': text,
+        'entities': entities or _entities(),
+    }
+    if retweeted:
+        tweet['retweeted_status'] = retweeted
+    return tweet
+
+
+def _sentence(rng):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(4, 12))]
+    text = ' '.join(words)
+    if rng.random() < 0.3:
+        text = text.capitalize()
+    return text + rng.choice(('', '', '.', '!', '?', ' lol', ' 😂'))
+
+
+def _anagram_of(text, rng):
+    """rearranges the letters of text into different, word-like chunks."""
+    letters = [c for c in text.lower() if 'a' <= c <= 'z']
+    rng.shuffle(letters)
+    words = []
+    while letters:
+        size = min(len(letters), rng.randint(2, 7))
+        words.append(''.join(letters[:size]))
+        letters = letters[size:]
+    return ' '.join(words)
+
+
+def _rejected(tweet_id, rng):
+    reason = rng.choice(REJECT_REASONS)
+    text = _sentence(rng)
+    if reason == 'lang':
+        return _tweet(tweet_id, text, lang=rng.choice(('es', 'ja', 'pt', 'und')))
+    if reason == 'url':
+        return _tweet(tweet_id, text + ' http://t.co/abc',
+                      entities=_entities(urls=[{'url': 'http://t.co/abc'}]))
+    if reason == 'mention':
+        return _tweet(tweet_id, '@someone ' + text,
+                      entities=_entities(mentions=[{'screen_name': 'someone'}]))
+    if reason == 'retweet':
+        return _tweet(tweet_id, 'RT ' + text, retweeted={'id': tweet_id - 1})
+    return _tweet(tweet_id, '%s %d' % (text, rng.randint(0, 99)))
+
+
+def _repeat_of(text, rng):
+    """a near-exact repeat of text, as from a retweet-by-copying or a bot."""
+    text = text.upper() if rng.random() < 0.2 else text
+    return text + rng.choice(('', '!', '!!', ' .'))
+
+
+def generate_tweets(count, anagram_rate=0.01, reject_rate=0.5, duplicate_rate=0.0,
+                    seed=0):
+    """
+    yields count synthetic tweet dicts.
+
+    :anagram_rate: the share of tweets that are anagrams of an earlier tweet.
+    :reject_rate: the share of tweets that should fail filter_tweet.
+    :duplicate_rate: the share of tweets that repeat one of a few 'trending'
+    tweets, with small changes.
+    :seed: the same seed always produces the same tweets.
+    """
+    rng = random.Random(seed)
+    recent = []
+    trending_rng = random.Random(seed + 1)
+    trending = [_sentence(trending_rng) for _ in range(20)]
+    for i in range(count):
+        tweet_id = 600000000000000000 + i
+        roll = rng.random()
+        if roll < reject_rate:
+            yield _rejected(tweet_id, rng)
+            continue
+        roll -= reject_rate
+        if recent and roll < anagram_rate:
+            yield _tweet(tweet_id, _anagram_of(rng.choice(recent), rng))
+            continue
+        if anagram_rate <= roll < anagram_rate + duplicate_rate:
+            yield _tweet(tweet_id, _repeat_of(trending_rng.choice(trending), trending_rng))
+            continue
+        text = _sentence(rng)
+        recent.append(text)
+        if len(recent) > 1000:
+            recent.pop(rng.randrange(len(recent)))
+        yield _tweet(tweet_id, text)
+
+
+def generate_texts(count, anagram_rate=0.01, seed=0, duplicate_rate=0.0):
+    """yields the text of count synthetic tweets, none of which should be filtered."""
+    for tweet in generate_tweets(count, anagram_rate, reject_rate=0.0,
+                                 duplicate_rate=duplicate_rate, seed=seed):
+        yield tweet['text']
+
+
+if __name__ == "__main__":
+    for text in generate_texts(20, anagram_rate=0.2):
+        print(text)
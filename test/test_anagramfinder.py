@@ -1,10 +1,12 @@
 
 import os
 import shutil
+import threading
 
-from anagramatron import anagramfinder, common
+from anagramatron import anagramfinder, anagramfunctions, common, multidbm, storage
 
 TEST_STORE_PATH =  os.path.join(common.ANAGRAM_DATA_DIR, 'test_store.mdbm')
+TEST_SQLITE_PATH = os.path.join(common.ANAGRAM_DATA_DIR, 'test_store.sqlite')
 
 def test_setup():
     _cleanup()
@@ -60,3 +62,216 @@ def test_simple_anagrams():
 def _cleanup():
     if os.path.exists(TEST_STORE_PATH):
         shutil.rmtree(TEST_STORE_PATH)
+
+def test_precomputed_keys():
+    hits = []
+    finder = anagramfinder.AnagramFinder(hit_callback=lambda one, two: hits.append((one, two)),
+                                         test_func=lambda one, two: True)
+    first = {'text': 'time destroys all things', 'anagram_hash': 'not a real key'}
+    second = {'text': 'Saturday morning in bed', 'anagram_hash': 'not a real key'}
+    finder.handle_many([first, second])
+    # the precomputed key is trusted, even though it's wrong
+    assert len(hits) == 1
+
+    hits = []
+    finder = anagramfinder.AnagramFinder(
+        hit_callback=lambda one, two: hits.append((one, two)),
+        test_func=lambda one, two: True, verify_keys=True)
+    finder.handle_many([first, second])
+    assert len(hits) == 0
+    assert anagramfunctions.improved_hash(first['text']) in finder.cache
+
+def test_handle_many_matches_handle_input():
+    test_input = ['So bored all the time😴', 'Berit od hates me lol',
+                  "Lord Jesus it's a fart", "It's just sad forreal",
+                  'time destroys all things', 'Saturday morning in bed 😊',
+                  'So bored all the time😴', 'Freight is so pathetic.',
+                  'straight piece of shit', 'Moist as heck in here']
+    one_at_a_time = []
+    finder = anagramfinder.AnagramFinder(hit_callback=lambda *args: one_at_a_time.append(args))
+    for inp in test_input:
+        finder.handle_input(inp)
+
+    batched = []
+    finder = anagramfinder.AnagramFinder(hit_callback=lambda *args: batched.append(args))
+    finder.handle_many(test_input)
+    assert batched == one_at_a_time
+    assert len(batched) == 3
+
+def test_background_writes():
+    _cleanup()
+    hits = []
+    finder = anagramfinder.AnagramFinder(path=TEST_STORE_PATH, storage='mdbm', cache_size=10,
+                                         hit_callback=lambda *args: hits.append(args),
+                                         test_func=lambda one, two: True)
+    finder.cache.path = None
+    words = ['%s%s%s' % (a, b, c) for a in 'abcdefg' for b in 'hijklmn' for c in 'opqrstu']
+    finder.handle_many(words)
+    assert finder.stats['cache_evictions'] > 0
+    # entries still being written are visible to lookups
+    finder.handle_many([w[::-1] for w in words])
+    assert len(hits) == len(words)
+    finder.close()
+    assert not finder._pending
+    _cleanup()
+
+
+def test_failed_archive_raises(monkeypatch):
+    _cleanup()
+    monkeypatch.setattr(anagramfinder, '_RETENTION_INTERVAL', 0)
+    monkeypatch.setitem(anagramfinder.STORAGE_BACKENDS, 'mdbm',
+                        lambda path: multidbm.MultiDBM(path, chunk_size=20))
+    rename = os.rename
+
+    def failing_rename(source, destination):
+        if os.sep + 'archive' + os.sep in destination:
+            raise OSError('archive is read only')
+        rename(source, destination)
+
+    monkeypatch.setattr(multidbm.os, 'rename', failing_rename)
+    finder = anagramfinder.AnagramFinder(path=TEST_STORE_PATH, storage='mdbm', cache_size=10,
+                                         retention=storage.RetentionPolicy(max_keys=30))
+    finder.cache.path = None
+    errors = []
+
+    def handle():
+        try:
+            for first in 'abcdefghij':
+                finder.handle_many(['%s%s%s%s' % (first, b, c, d) for b in 'klmnopq'
+                                    for c in 'rstuvwx' for d in 'yz'])
+                finder.flush()
+            finder.close()
+        except OSError as err:
+            errors.append(err)
+
+    thread = threading.Thread(target=handle)
+    thread.daemon = True
+    thread.start()
+    thread.join(30)
+    assert not thread.is_alive(), 'finder hung after a failed archive'
+    assert errors
+    # the chunk that couldn't be moved is still in the store, and its metadata
+    names = set(finder.datastore._names)
+    on_disk = set(n for n in os.listdir(TEST_STORE_PATH) if n.startswith('mdbm'))
+    assert on_disk - names
+    assert on_disk <= set(finder.datastore._metadata['chunks'])
+    finder.datastore.close()
+    _cleanup()
+
+def test_finder_with_sqlite():
+    _cleanup_sqlite()
+    hits = []
+    finder = anagramfinder.AnagramFinder(path=TEST_SQLITE_PATH, storage='sqlite', cache_size=2,
+                                         hit_callback=lambda *args: hits.append(args))
+    finder.cache.path = None
+    finder.handle_many(['So bored all the time', "Lord Jesus it's a fart",
+                        'Freight is so pathetic.', 'Moist as heck in here'])
+    finder.flush()
+    assert len(finder.datastore) == 2
+    finder.handle_many(['Berit od hates me lol', "It's just sad forreal",
+                        'straight piece of shit'])
+    assert len(hits) == 3
+    finder.close()
+    _cleanup_sqlite()
+
+
+def _cleanup_sqlite():
+    for suffix in ('', '-wal', '-shm', '.archive'):
+        if os.path.exists(TEST_SQLITE_PATH + suffix):
+            os.remove(TEST_SQLITE_PATH + suffix)
+
+
+def _bucket_test(one, two):
+    return set((one, two)) in ({'notes', 'stone'}, {'onset', 'tones'})
+
+
+def test_candidate_buckets():
+    words = ['stone', 'tones', 'notes', 'onset']
+    hits = []
+    finder = anagramfinder.AnagramFinder(hit_callback=lambda *args: hits.append(args),
+                                         test_func=_bucket_test)
+    finder.handle_many(words)
+    # each word replaces the last, which it fails against
+    assert hits == []
+
+    finder = anagramfinder.AnagramFinder(hit_callback=lambda *args: hits.append(args),
+                                         test_func=_bucket_test, bucket_size=3)
+    finder.handle_many(words)
+    assert hits == [('notes', 'stone'), ('onset', 'tones')]
+    assert anagramfunctions.improved_hash('stone') not in finder.cache
+
+
+def test_stored_candidate_buckets():
+    _cleanup_sqlite()
+    hits = []
+    finder = anagramfinder.AnagramFinder(path=TEST_SQLITE_PATH, storage='sqlite',
+                                         hit_callback=lambda *args: hits.append(args),
+                                         test_func=_bucket_test, bucket_size=3)
+    finder.cache.path = None
+    finder.handle_many(['stone', 'tones'])
+    finder._trim_cache(10)
+    finder.flush()
+    key = anagramfunctions.improved_hash('stone')
+    assert finder.datastore.get(key) == ['stone', 'tones']
+    finder.handle_input('notes')
+    finder.handle_input('onset')
+    assert hits == [('notes', 'stone'), ('onset', 'tones')]
+    finder.close()
+    _cleanup_sqlite()
+
+
+def test_duplicates_dropped():
+    hits = []
+    tests = []
+
+    def test_func(one, two):
+        tests.append((one, two))
+        return anagramfunctions.test_anagram(one, two)
+
+    finder = anagramfinder.AnagramFinder(hit_callback=lambda *args: hits.append(args),
+                                         test_func=test_func)
+    finder.handle_many(['So bored all the time', 'so bored, all the time!!',
+                        'ALL THE TIME SO BORED', 'Berit od hates me lol',
+                        'So bored all the time'])
+    assert tests == [('Berit od hates me lol', 'So bored all the time')]
+    key = anagramfunctions.improved_hash('So bored all the time')
+    assert finder.stats['duplicates_dropped'] == 2
+    assert finder.duplicates.most_duplicated() == [(key, 2)]
+    # once the first tweet is used in a hit, a repeat of it is a new candidate
+    assert finder.cache[key] == 'So bored all the time'
+    assert len(hits) == 1
+
+
+def test_warm_start():
+    _cleanup_sqlite()
+    finder = anagramfinder.AnagramFinder(path=TEST_SQLITE_PATH, storage='sqlite')
+    finder.cache.path = None
+    finder.handle_many(['So bored all the time', "Lord Jesus it's a fart",
+                        'Freight is so pathetic.'])
+    finder._trim_cache(10)
+    finder.close()
+
+    hits = []
+    finder = anagramfinder.AnagramFinder(path=TEST_SQLITE_PATH, storage='sqlite',
+                                         hit_callback=lambda *args: hits.append(args),
+                                         warm_bytes=1 << 20)
+    finder.cache.path = None
+    finder._warm_process.join()
+    assert len(finder._warm) == 3
+    assert finder._warm_dirty is None
+    finder.handle_many(['Berit od hates me lol', "It's just sad forreal"])
+    assert len(hits) == 2
+    assert finder.stats['warm_hits'] == 2
+    # keys written again are no longer served from the warm entries
+    finder.handle_input('so bored, all the time')
+    finder._trim_cache(10)
+    assert len(finder._warm) == 2
+    finder.close()
+
+    finder = anagramfinder.AnagramFinder(path=TEST_SQLITE_PATH, storage='sqlite',
+                                         warm_bytes=200)
+    finder.cache.path = None
+    finder._warm_process.join()
+    assert 0 < len(finder._warm) < 3
+    finder.close()
+    _cleanup_sqlite()
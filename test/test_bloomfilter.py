@@ -0,0 +1,23 @@
+from anagramatron import bloomfilter
+
+
+def test_no_false_negatives():
+    bloom = bloomfilter.BloomFilter(1000)
+    keys = ['key%d' % i for i in range(1000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+    assert all(bloom.might_contain(bloomfilter.key_digest(key)) for key in keys)
+    false_positives = len([i for i in range(1000) if 'other%d' % i in bloom])
+    assert false_positives < 50
+
+
+def test_serialization():
+    bloom = bloomfilter.BloomFilter(100)
+    bloom.add('hello')
+    bloom.add(b'bytes')
+    loaded = bloomfilter.BloomFilter.from_bytes(bloom.to_bytes())
+    assert 'hello' in loaded
+    assert 'bytes' in loaded
+    assert loaded.bit_count == bloom.bit_count
+    assert loaded.hash_count == bloom.hash_count
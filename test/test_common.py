@@ -73,3 +73,53 @@ def test_filter_tweet():
     rt = result['text']
     assert rt == test_tweet['text']
 
+
+def test_improved_hash_matches_reference():
+    texts = [test_tweet['text'],
+             'So bored all the time😴',
+             'Im in #Danger Darn you BTS!',
+             'Beyoncé & Jäger, twenty-two_times?',
+             'zzz',
+             'e' * 60,
+             '',
+             '!!! 😂😂']
+    for text in texts:
+        assert anagramfunctions.improved_hash(text) == anagramfunctions._regex_improved_hash(text)
+    assert anagramfunctions.improved_hash('tea') == anagramfunctions.improved_hash('EAT!')
+    assert len(anagramfunctions.improved_hash('quiz')) % 2 == 0
+
+
+def test_test_anagram_matches_reference():
+    pairs = [('So bored all the time', 'Berit od hates me lol'),
+             ("Lord Jesus it's a fart", "It's just sad forreal"),
+             ('time destroys all things', 'things destroy all time'),
+             ('straight piece of shit', 'Freight is so pathetic.'),
+             ('cant wait for the weekend', 'cantwait for theweekend'),
+             ('twenty-two_times? ok', 'ok twenty two times'),
+             ('a(b)c [d] e+f? g.h*', 'h g f e d c b a'),
+             ('Beyoncé & Jäger', 'ja eger bey once')]
+    for one, two in pairs:
+        expected = anagramfunctions._regex_test_anagram(one, two)
+        assert anagramfunctions.test_anagram(one, two) == expected
+        assert anagramfunctions.test_anagram(
+            anagramfunctions.normalized_text(one), two) == expected
+        for spaces in (False, True):
+            assert (anagramfunctions.stripped_string(one, spaces) ==
+                    anagramfunctions._regex_stripped_string(one, spaces))
+
+
+def test_filter_tweets_matches_filter_tweet():
+    tweets = [test_tweet,
+              dict(test_tweet, lang='es'),
+              dict(test_tweet, text=test_tweet['text'] + ' 42'),
+              dict(test_tweet, retweeted_status={'id': 1}),
+              dict(test_tweet, entities=dict(test_tweet['entities'], urls=[{'url': 'x'}])),
+              dict(test_tweet, text='too short to use'),
+              dict(test_tweet, text=test_tweet['text'] + ' &amp; more &lt;&lt;'),
+              dict(test_tweet, text='Beyoncé is in the café with Jäger tonight'),
+              dict(test_tweet, text='😂😂😂😂😂😂😂 ' + test_tweet['text'] + ' 😂😂😂😂😂😂😂')]
+    expected = [anagramfunctions.filter_tweet(t) for t in tweets]
+    tweet_filter = anagramfunctions.TweetFilter(reorder_interval=2)
+    for _ in range(3):
+        assert tweet_filter.filter_tweets(tweets) == [t for t in expected if t]
+    assert len([t for t in expected if t]) == 3
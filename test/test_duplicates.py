@@ -0,0 +1,29 @@
+from anagramatron import anagramfunctions, duplicates
+
+
+def test_fingerprints():
+    fingerprint = anagramfunctions.text_fingerprint
+    assert fingerprint('So bored all the time') == fingerprint('so BORED, all the time!!')
+    assert fingerprint('So bored all the time') == fingerprint('all the time so bored')
+    assert fingerprint('So bored all the time') != fingerprint('So bored all the tim e')
+
+
+def test_duplicate_filter_bounds():
+    dups = duplicates.DuplicateFilter(max_keys=2, per_key=2)
+    dups.add('a', 1)
+    dups.add('a', 2)
+    dups.add('a', 3)
+    assert not dups.is_duplicate('a', 1)
+    assert dups.is_duplicate('a', 2)
+    assert dups.is_duplicate('a', 3)
+    dups.discard('a', 3)
+    assert not dups.is_duplicate('a', 3)
+
+    dups.add('b', 1)
+    dups.add('c', 1)
+    # 'a' was used least recently
+    assert len(dups) == 2
+    assert not dups.is_duplicate('a', 2)
+    assert 'a' not in dups.counts
+    assert dups.is_duplicate('c', 1)
+    assert dups.most_duplicated() == [('c', 1)]
@@ -1,5 +1,15 @@
 
+import json
 import os
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urllib2 import urlopen
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.request import urlopen
 
 from anagramatron import common, hitmanager
 
@@ -23,8 +33,10 @@ def test_schema():
 def test_add_hit():
     _cleanup()
     hm = hitmanager.HitDBManager(TEST_LOCATION, _testing=True)
-    first = {'text': 'aabbccddeeffgghh', 'tweet_hash': 'asfdlkj', 'tweet_id': 1}
-    second = {'text': 'bbaacceeddgghhff', 'tweet_hash': 'asfdlkj', 'tweet_id': 2}
+    first = {'text': 'aabbccddeeffgghh', 'tweet_hash': 'asfdlkj', 'tweet_id': 1,
+             'anagram_hash': 'aabbccddeeffgghh'}
+    second = {'text': 'bbaacceeddgghhff', 'tweet_hash': 'asfdlkj', 'tweet_id': 2,
+              'anagram_hash': 'aabbccddeeffgghh'}
     hm.new_hit(first, second)
 
     hits = hm.all_hits()
@@ -41,8 +53,10 @@ def test_queue():
 def test_update_status():
     _cleanup()
     hm = hitmanager.HitDBManager(TEST_LOCATION, _testing=True)
-    first = {'text': 'aabbccddeeffgghh', 'tweet_hash': 'asfdlkj', 'tweet_id': 1}
-    second = {'text': 'bbaacceeddgghhff', 'tweet_hash': 'asfdlkj', 'tweet_id': 2}
+    first = {'text': 'aabbccddeeffgghh', 'tweet_hash': 'asfdlkj', 'tweet_id': 1,
+             'anagram_hash': 'aabbccddeeffgghh'}
+    second = {'text': 'bbaacceeddgghhff', 'tweet_hash': 'asfdlkj', 'tweet_id': 2,
+              'anagram_hash': 'aabbccddeeffgghh'}
     hm.new_hit(first, second)
     hits = hm.all_hits(with_status='review')
     assert len(hits) == 1
@@ -70,3 +84,69 @@ def test_posting():
 def _cleanup():
     if os.path.exists(TEST_LOCATION):
         os.remove(TEST_LOCATION)
+
+
+class _StubTwitter(BaseHTTPRequestHandler):
+    """serves statuses/show: tweet 3 fails once, tweet 4 is deleted."""
+    requests = []
+
+    def do_GET(self):
+        tweet_id = int(self.path.split('/')[-1].split('.')[0])
+        self.requests.append(tweet_id)
+        if tweet_id == 4 or (tweet_id == 3 and self.requests.count(3) == 1):
+            self.send_error(404 if tweet_id == 4 else 500)
+            return
+        body = json.dumps({'text': 'tweet %d &amp; more' % tweet_id, 'created_at': 'today',
+                           'user': {'name': 'user', 'screen_name': 'user%d' % tweet_id}})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+def test_enrichment():
+    _cleanup()
+    server = HTTPServer(('127.0.0.1', 0), _StubTwitter)
+    threading.Thread(target=server.serve_forever).start()
+    url = 'http://127.0.0.1:%d/statuses/show/%%s.json' % server.server_address[1]
+
+    def fetch(tweet_id):
+        return json.loads(urlopen(url % tweet_id).read().decode('utf-8'))
+
+    hm = hitmanager.HitDBManager(TEST_LOCATION, _testing=True)
+    for hash_, first, second in (('aaa', 1, 2), ('bbb', 3, 1), ('ccc', 4, 2)):
+        hm.new_hit({'tweet_id': first, 'anagram_hash': hash_}, {'tweet_id': second})
+        time.sleep(0.01)
+    hits = hm.all_hits()
+    assert len(hits) == 3
+    assert not any('fetched' in h['tweet_one'] for h in hits)
+
+    try:
+        hm.start_enrichment(2, fetch, backoff=0, poll_interval=0.05)
+        cursor = hm.hitsdb.cursor()
+        for _ in range(200):
+            cursor.execute("SELECT COUNT(*) FROM enrichment WHERE state = ?",
+                           (hitmanager.ENRICHMENT_PENDING,))
+            if not cursor.fetchone()[0]:
+                break
+            time.sleep(0.05)
+        hm.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    hm = hitmanager.HitDBManager(TEST_LOCATION, _testing=True)
+    hits = sorted(hm.all_hits(), key=lambda h: h['hash'])
+    assert [h['hash'] for h in hits] == ['aaa', 'bbb']
+    assert hits[0]['tweet_one']['fetched']['text'] == 'tweet 1 & more'
+    assert hits[1]['tweet_one']['fetched']['user']['screen_name'] == 'user3'
+    assert hits[1]['tweet_two']['fetched']['text'] == 'tweet 1 & more'
+    cursor = hm.hitsdb.cursor()
+    cursor.execute("SELECT state, attempts FROM enrichment ORDER BY hit_id")
+    assert cursor.fetchall() == [(hitmanager.ENRICHMENT_DONE, 1),
+                                 (hitmanager.ENRICHMENT_DONE, 2),
+                                 (hitmanager.ENRICHMENT_MISSING, 1)]
+    _cleanup()
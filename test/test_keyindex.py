@@ -0,0 +1,79 @@
+import os
+import random
+import shutil
+
+from anagramatron import common, keyindex, multidbm
+from anagramatron.bloomfilter import key_digest
+
+TEST_STORE_PATH = os.path.join(common.ANAGRAM_DATA_DIR, 'test_keyindex.mdbm')
+
+
+def test_add_and_discard():
+    index = keyindex.KeyIndex([5, 1, 3])
+    assert 1 in index and 3 in index and 5 in index
+    assert 2 not in index
+    for digest in range(10, 10 + keyindex._MERGE_SIZE + 10):
+        index.add(digest)
+    assert len(index) == keyindex._MERGE_SIZE + 13
+    assert len(index._recent) == 10
+    assert all(d in index for d in (1, 3, 5, 10, 11 + keyindex._MERGE_SIZE))
+    index.discard(3)
+    index.discard(11 + keyindex._MERGE_SIZE)
+    assert 3 not in index
+    assert 11 + keyindex._MERGE_SIZE not in index
+
+    loaded = keyindex.KeyIndex.from_bytes(index.to_bytes())
+    assert len(loaded) == len(index)
+    assert 2 ** 64 - 1 not in loaded
+    assert 10 in loaded
+
+
+def test_merge_matches_set(monkeypatch):
+    monkeypatch.setattr(keyindex, '_MERGE_SIZE', 16)
+    rand = random.Random(7)
+    expected = set(rand.randrange(1000) for _ in range(200))
+    index = keyindex.KeyIndex(expected)
+    for _ in range(5000):
+        digest = rand.randrange(1000)
+        if rand.random() < 0.5:
+            index.add(digest)
+            expected.add(digest)
+        else:
+            index.discard(digest)
+            expected.discard(digest)
+        assert (digest in index) == (digest in expected)
+        assert len(index) == len(expected)
+    index._merge()
+    assert list(index._sorted) == sorted(expected)
+
+
+def test_multidbm_index():
+    shutil.rmtree(TEST_STORE_PATH, ignore_errors=True)
+    store = multidbm.MultiDBM(TEST_STORE_PATH, chunk_size=4)
+    keys = ['key%d' % i for i in range(10)]
+    for key in keys:
+        store[key] = key
+    assert store.section_count() == 3
+    assert all(index is not None for index in store._indexes)
+    # each key is found in exactly one chunk
+    assert all(len(list(store._chunks_for_key(key))) == 1 for key in keys)
+    assert list(store._chunks_for_key('missing')) == []
+    del store['key1']
+    assert 'key1' not in store
+    assert key_digest('key1') not in store._indexes[0]
+    store.close()
+
+    # a chunk with a missing index is read for every lookup, until it's rebuilt
+    os.remove(store._index_path(store._names[0]))
+    store = multidbm.MultiDBM(TEST_STORE_PATH, chunk_size=4)
+    assert store._indexes[0] is None
+    assert store.get('key0') == 'key0'
+    assert store.get('key9') == 'key9'
+    assert 'key1' not in store
+    store.close()
+    multidbm.build_filters(TEST_STORE_PATH, chunk_size=4)
+    store = multidbm.MultiDBM(TEST_STORE_PATH, chunk_size=4)
+    assert all(index is not None for index in store._indexes)
+    assert all(len(list(store._chunks_for_key(key))) == 1 for key in keys if key != 'key1')
+    store.close()
+    shutil.rmtree(TEST_STORE_PATH)
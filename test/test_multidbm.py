@@ -0,0 +1,306 @@
+import os
+import shutil
+import threading
+
+from anagramatron import common, multidbm
+from anagramatron.storage import RetentionPolicy
+
+TEST_STORE_PATH = os.path.join(common.ANAGRAM_DATA_DIR, 'test_retention.mdbm')
+
+
+def _chunk(keys, sealed, size=100):
+    return {'keys': keys, 'bytes': size, 'sealed': sealed}
+
+
+def test_retention_policy():
+    chunks = [_chunk(10, 100), _chunk(10, 200), _chunk(10, 300), _chunk(5, None)]
+    assert not RetentionPolicy()
+    assert RetentionPolicy().expired_count(chunks, now=1000) == 0
+    assert RetentionPolicy(max_age=750).expired_count(chunks, now=1000) == 2
+    assert RetentionPolicy(max_keys=20).expired_count(chunks, now=1000) == 2
+    assert RetentionPolicy(max_bytes=250).expired_count(chunks, now=1000) == 2
+    # the chunk still taking keys is never archived
+    assert RetentionPolicy(max_keys=0).expired_count(chunks, now=1000) == 3
+
+
+def test_chunk_counts_and_retention():
+    shutil.rmtree(TEST_STORE_PATH, ignore_errors=True)
+    store = multidbm.MultiDBM(TEST_STORE_PATH, chunk_size=4)
+    for i in range(10):
+        store['key%d' % i] = 'value'
+    store['key0'] = 'updated'
+    del store['key5']
+    assert len(store) == 9
+    assert [c['keys'] for c in store.chunk_stats()] == [4, 3, 2]
+    assert [c['sealed'] is None for c in store.chunk_stats()] == [False, False, True]
+    store.close()
+
+    store = multidbm.MultiDBM(TEST_STORE_PATH, chunk_size=4)
+    assert len(store) == 9
+    oldest = store.chunk_stats()[0]['name']
+    lock = threading.Lock()
+    archive_chunk = store._archive_chunk
+
+    def archive_unlocked(db, filename):
+        # files are moved without holding up lookups
+        assert not lock.locked()
+        return archive_chunk(db, filename)
+
+    store._archive_chunk = archive_unlocked
+    archived = store.enforce_retention(RetentionPolicy(max_keys=6), lock=lock)
+    assert len(archived) == 1
+    assert archived[0].endswith(os.path.join('archive', oldest))
+    assert os.path.exists(archived[0])
+    assert len(store) == 5
+    assert store.section_count() == 2
+    assert store.get('key0') is None
+    assert store.get('key9') == 'value'
+    store.close()
+    shutil.rmtree(TEST_STORE_PATH)
+
+
+def test_probe_order_and_locations():
+    shutil.rmtree(TEST_STORE_PATH, ignore_errors=True)
+    store = multidbm.MultiDBM(TEST_STORE_PATH, chunk_size=4, key_index=False)
+    for i in range(10):
+        store['key%d' % i] = 'value%d' % i
+    # newest first, until there are hits
+    assert list(store._positions_for_key('key9'))[0] == 2
+    assert store.get_with_location('key1') == ('value1', 0)
+    assert store.get_with_location('key9') == ('value9', 2)
+    assert store.get_with_location('missing') == (None, None)
+    for _ in range(3):
+        store.get('key2')
+    store._update_probe_order()
+    assert store._probe_order == [0, 2, 1]
+    names = store._names
+    assert store.stats['chunk_hit_rates'][names[0]] > store.stats['chunk_hit_rates'][names[1]]
+
+    assert store._locations['key2'] == names[0]
+    del store['key2']
+    assert 'key2' not in store._locations
+    assert store.get('key2') is None
+    assert len(store) == 9
+    store.close()
+    shutil.rmtree(TEST_STORE_PATH)
+
+
+class _ChangingLock(object):
+    """changes the store just before compaction takes the lock to swap chunks."""
+
+    def __init__(self, store):
+        self.store = store
+        self.entered = 0
+
+    def __enter__(self):
+        self.entered += 1
+        # once for setup, then twice for each of three chunks
+        if self.entered == 8:
+            self.store['key0'] = 'changed'
+            del self.store['key2']
+
+    def __exit__(self, *args):
+        pass
+
+
+def test_compact():
+    shutil.rmtree(TEST_STORE_PATH, ignore_errors=True)
+    store = multidbm.MultiDBM(TEST_STORE_PATH, chunk_size=4)
+    for i in range(14):
+        store['key%d' % i] = 'value%d' % i
+    del store['key1']
+    newest_merged = store._names[2]
+    assert store.section_count() == 4
+
+    # changes made to merged chunks while compacting are copied before the swap
+    result = store.compact(3, lock=_ChangingLock(store))
+    assert result['chunks'] == 3
+    assert result['keys_before'] == 11
+    assert result['keys_after'] == 10
+    assert store.section_count() == 2
+    assert store._names[0] == newest_merged
+    assert len(store) == 12
+    assert store.get('key0') == 'changed'
+    assert store.get('key1') is None
+    assert store.get('key2') is None
+    assert all(store.get('key%d' % i) == 'value%d' % i for i in range(3, 14))
+    assert all(len(list(store._chunks_for_key('key%d' % i))) == 1 for i in range(3, 14))
+    store.close()
+
+    store = multidbm.MultiDBM(TEST_STORE_PATH, chunk_size=4)
+    assert store.section_count() == 2
+    assert len(store) == 12
+    assert store.get('key0') == 'changed'
+    for i in range(20, 30):
+        store['key%d' % i] = 'value%d' % i
+    result = multidbm.compact_with_report(store)
+    assert result['keys_after'] == result['keys_before']
+    assert result['latency_before'] > 0 and result['latency_after'] > 0
+    assert store.section_count() == 2
+    assert multidbm.compact_with_report(store) is None
+    assert multidbm.compact_with_report(store) is None
+    store.close()
+    shutil.rmtree(TEST_STORE_PATH)
+
+
+class _ChurningLock(object):
+    """deletes and updates keys in the chunks being compacted between every slice."""
+
+    def __init__(self, store, deletes, updates):
+        self.store = store
+        self.deletes = list(deletes)
+        self.updates = list(updates)
+
+    def __enter__(self):
+        if self.store._compacting:
+            if self.deletes:
+                del self.store[self.deletes.pop(0)]
+            if self.updates:
+                self.store[self.updates.pop(0)] = 'updated'
+
+    def __exit__(self, *args):
+        pass
+
+
+def test_compact_with_churn(monkeypatch):
+    monkeypatch.setattr(multidbm, '_COMPACT_SLICE_SIZE', 1)
+    shutil.rmtree(TEST_STORE_PATH, ignore_errors=True)
+    store = multidbm.MultiDBM(TEST_STORE_PATH, chunk_size=8)
+    keys = ['key%02d' % i for i in range(30)]
+    for key in keys:
+        store[key] = key
+    deleted = keys[0:24:3]
+    updated = keys[1:24:3]
+    lock = _ChurningLock(store, deleted, updated)
+    result = store.compact(lock=lock)
+    assert not lock.deletes and not lock.updates
+    assert result['keys_after'] == 24 - len(deleted)
+    assert store._filters[0].bit_count >= multidbm.BloomFilter(24, 0.01).bit_count
+
+    def check(store):
+        assert len(store) == 30 - len(deleted)
+        for key in keys:
+            expected = None if key in deleted else 'updated' if key in updated else key
+            assert store.get(key) == expected
+
+    check(store)
+    store.close()
+    check(multidbm.MultiDBM(TEST_STORE_PATH, chunk_size=8))
+    shutil.rmtree(TEST_STORE_PATH)
+
+
+def test_failed_compaction_loses_nothing(monkeypatch):
+    shutil.rmtree(TEST_STORE_PATH, ignore_errors=True)
+    store = multidbm.MultiDBM(TEST_STORE_PATH, chunk_size=4)
+    for i in range(14):
+        store['key%d' % i] = 'value%d' % i
+    last = store.section_count() - 1
+    sealed = [i for i in range(14) if store._data[last].get('key%d' % i) is None]
+
+    gdbm_open = multidbm.gdbm.open
+
+    def crash(path, flags):
+        # as if we crashed just after the merged chunk was renamed into
+        # place and the chunks it replaces were removed
+        if not path.endswith(multidbm._COMPACT_TEMP_FILE):
+            raise OSError('crashed')
+        return gdbm_open(path, flags)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(multidbm.gdbm, 'open', crash)
+        try:
+            store.compact()
+        except OSError:
+            pass
+        else:
+            assert False, 'compaction should have failed'
+    # a new store, without the old one's close, sees the files as they were left
+    store = multidbm.MultiDBM(TEST_STORE_PATH, chunk_size=4)
+    assert len(sealed) == 12
+    assert all(store.get('key%d' % i) == 'value%d' % i for i in sealed)
+    store.close()
+    shutil.rmtree(TEST_STORE_PATH)
+
+def test_verify_and_repair(tmpdir):
+    shutil.rmtree(TEST_STORE_PATH, ignore_errors=True)
+    store = multidbm.MultiDBM(TEST_STORE_PATH, chunk_size=4)
+    for i in range(10):
+        store['key%d' % i] = 'value%d' % i
+    damaged = store._names[1]
+    store.close()
+    db = multidbm.gdbm.open(os.path.join(TEST_STORE_PATH, damaged), 'w')
+    db['key5'] = b'\x10\x05ab'
+    db.close()
+
+    report_path = str(tmpdir.join('report.json'))
+    report = multidbm.verify_database(TEST_STORE_PATH, workers=2, report_path=report_path)
+    assert os.path.exists(report_path)
+    assert report['damaged'] == [damaged]
+    assert report['keys'] == 10
+    assert [c['keys'] for c in report['chunks']] == [4, 4, 2]
+    assert report['chunks'][1]['decode_errors'] == 1
+    assert report['chunks'][1]['bad_keys'] == ['key5']
+
+    report = multidbm.verify_database(TEST_STORE_PATH, workers=2, repair=True,
+                                      report_path=report_path)
+    assert report['chunks'][1]['salvaged'] == 3
+    assert os.path.exists(os.path.join(TEST_STORE_PATH, 'archive', '%s.damaged' % damaged))
+    assert multidbm.verify_database(TEST_STORE_PATH, report_path=report_path)['damaged'] == []
+
+    store = multidbm.MultiDBM(TEST_STORE_PATH, chunk_size=4)
+    assert store.get('key5') is None
+    assert store.get('key4') == 'value4'
+    assert len(store) == 9
+    store.close()
+    shutil.rmtree(TEST_STORE_PATH)
+
+
+def test_verify_compacted_chunk():
+    shutil.rmtree(TEST_STORE_PATH, ignore_errors=True)
+    store = multidbm.MultiDBM(TEST_STORE_PATH, chunk_size=4)
+    for i in range(30):
+        store['key%d' % i] = 'value%d' % i
+    store.compact()
+    store.close()
+
+    # the merged chunk holds far more than chunk_size keys
+    report = multidbm.verify_database(TEST_STORE_PATH, workers=1, repair=True, chunk_size=4,
+                                      report_path=os.path.join(TEST_STORE_PATH, 'report.json'))
+    assert report['damaged'] == []
+    assert report['keys'] == 30
+    assert not any(c['truncated'] for c in report['chunks'])
+    store = multidbm.MultiDBM(TEST_STORE_PATH, chunk_size=4)
+    assert len(store) == 30
+    assert all(store.get('key%d' % i) == 'value%d' % i for i in range(30))
+    path = os.path.join(TEST_STORE_PATH, store._names[0])
+    store.close()
+
+    # a walk that's cut short isn't damage
+    report = multidbm.verify_chunk(path, max_keys=5, salvage_path=path + '.salvaged')
+    assert report['truncated']
+    assert report['ok']
+    assert report['salvaged'] is None
+    shutil.rmtree(TEST_STORE_PATH)
+
+
+def test_verify_unopenable_chunk(tmpdir):
+    shutil.rmtree(TEST_STORE_PATH, ignore_errors=True)
+    store = multidbm.MultiDBM(TEST_STORE_PATH, chunk_size=4)
+    for i in range(10):
+        store['key%d' % i] = 'value%d' % i
+    store.close()
+    with open(os.path.join(TEST_STORE_PATH, 'mdbmgarbage.db'), 'wb') as f:
+        f.write(b'not a dbm file' * 100)
+
+    report_path = str(tmpdir.join('report.json'))
+    for repair in (False, True):
+        report = multidbm.verify_database(TEST_STORE_PATH, workers=2, repair=repair,
+                                          report_path=report_path)
+        assert os.path.exists(report_path)
+        assert report['damaged'] == ['mdbmgarbage.db']
+        garbage = [c for c in report['chunks'] if c['name'] == 'mdbmgarbage.db'][0]
+        assert garbage['error'] and garbage['salvaged'] is None
+        assert report['keys'] == 10
+        assert len(report['chunks']) == 4
+    shutil.rmtree(TEST_STORE_PATH)
+
@@ -0,0 +1,51 @@
+from collections import deque
+
+from anagramatron import anagramfinder, anagramfunctions, overload
+
+
+def _tweets(texts):
+    return [{'text': t, 'anagram_hash': anagramfunctions.improved_hash(t)} for t in texts]
+
+
+def test_hysteresis():
+    controller = overload.OverloadController(['sample'], high_water=100, low_water=50)
+    batch = _tweets(['So bored all the time'])
+    assert controller.admit(batch, deque(range(100))) == batch
+    assert not controller.overloaded
+    controller.admit(batch, deque(range(101)))
+    assert controller.overloaded
+    controller.admit(batch, deque(range(60)))
+    assert controller.overloaded
+    assert controller.admit(batch, deque(range(49))) == batch
+    assert not controller.overloaded
+    assert controller.stats['overload_episodes'] >= 1
+
+
+def test_sample_keeps_anagrams_together():
+    controller = overload.OverloadController(['sample'], high_water=10, low_water=5)
+    texts = ['word%s' % ''.join(chr(97 + int(c)) for c in str(i)) for i in range(1000)]
+    batch = _tweets(texts) + _tweets([t[::-1] for t in texts])
+    kept = controller.admit(batch, deque(range(50)))
+    assert 0 < len(kept) < len(batch)
+    keys = [t['anagram_hash'] for t in kept]
+    assert all(keys.count(k) % 2 == 0 for k in keys)
+
+
+def test_prioritize_and_drop_oldest():
+    controller = overload.OverloadController(['prioritize', 'drop_oldest'],
+                                             high_water=10, low_water=5)
+    batch = _tweets(['aaaa bbbb', 'the quick brown fox', 'abab', 'jumps over the lazy dog'])
+    backlog = deque(range(20))
+    kept = controller.admit(batch, backlog)
+    assert [t['text'] for t in kept] == ['the quick brown fox', 'jumps over the lazy dog']
+    assert len(backlog) == 5
+
+
+def test_cache_only():
+    finder = anagramfinder.AnagramFinder()
+    controller = overload.OverloadController(['cache_only'], high_water=10, low_water=5,
+                                             finder=finder)
+    controller.admit([], deque(range(11)))
+    assert finder.cache_only
+    controller.admit([], deque(range(4)))
+    assert not finder.cache_only
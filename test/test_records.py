@@ -0,0 +1,73 @@
+import json
+
+from anagramatron import records
+
+TWEET = {'anagram_hash': 'EDCBA@', 'tweet_id': 662725239776800768,
+         'text': "I can't believe it's already Friday, this week went by so fast lol"}
+
+
+def test_round_trip():
+    key = TWEET['anagram_hash']
+    for compress in (False, True):
+        data = records.encode_record(TWEET, key, compress)
+        assert records.is_record(data)
+        assert records.decode_record(data, key) == TWEET
+        text = records.encode_record('just some text', key, compress)
+        assert records.decode_record(text, key) == 'just some text'
+    long_tweet = dict(TWEET, text='a' * 1000)
+    assert records.decode_record(records.encode_record(long_tweet, key), key) == long_tweet
+
+
+def test_buckets():
+    key = TWEET['anagram_hash']
+    bucket = [TWEET, dict(TWEET, tweet_id=1, text='another'), 'plain text']
+    for compress in (False, True):
+        data = records.encode_record(bucket, key, compress)
+        assert records.is_record(data)
+        assert records.decode_record(data, key) == bucket
+    assert records.encode_record([TWEET, dict(TWEET, fetched={})], key) is None
+    data = records.encode_record(bucket, key)
+    for end in (2, 10, len(data) - 1):
+        try:
+            records.decode_record(data[:end], key)
+        except ValueError:
+            continue
+        assert False, 'decoded truncated bucket'
+
+
+def test_smaller_than_json():
+    data = records.encode_record(TWEET, TWEET['anagram_hash'])
+    assert len(data) * 1.5 < len(json.dumps(TWEET))
+
+
+def test_unrepresentable_values():
+    key = TWEET['anagram_hash']
+    assert records.encode_record(dict(TWEET, fetched={}), key) is None
+    assert records.encode_record(TWEET, 'some other key') is None
+    assert records.encode_record({'text': 'no id'}, key) is None
+
+
+def test_legacy_values():
+    assert records.decode_record(json.dumps(TWEET).encode('utf-8')) == TWEET
+    assert records.decode_record('plain text'.encode('utf-8')) == 'plain text'
+
+
+def test_truncated_record():
+    data = records.encode_record(TWEET, TWEET['anagram_hash'])
+    for end in (1, 5, 12, len(data) - 1):
+        try:
+            records.decode_record(data[:end])
+        except ValueError:
+            continue
+        assert False, 'decoded truncated record'
+
+
+def test_corrupt_compressed_record():
+    data = records.encode_record(TWEET, TWEET['anagram_hash'], compress=True)
+    # header, tweet id and a one byte length, then a body that isn't deflate
+    data = data[:10] + b'\xff' * (len(data) - 10)
+    try:
+        records.decode_record(data, TWEET['anagram_hash'])
+    except ValueError:
+        return
+    assert False, 'decoded corrupt record'
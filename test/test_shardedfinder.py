@@ -0,0 +1,85 @@
+from anagramatron import anagramfinder, anagramfunctions, common, shardedfinder, storage
+
+TEST_INPUT = ['So bored all the time',
+              'Berit od hates me lol',
+              "Lord Jesus it's a fart",
+              "It's just sad forreal",
+              'Maybe trying to hard .',
+              'Angry birthday to me',
+              "This flow ain't right",
+              'how is that flirting.',
+              'My little sister hands go !',
+              'time destroys all things',
+              'Cheetah girls two is on !',
+              'I Got One Class With Her.',
+              'Freight is so pathetic.',
+              'straight piece of shit']
+
+
+def test_shard_for_key():
+    keys = [anagramfunctions.improved_hash(t) for t in TEST_INPUT]
+    for key in keys:
+        shard = shardedfinder.shard_for_key(key, 4)
+        assert 0 <= shard < 4
+        assert shard == shardedfinder.shard_for_key(key, 4)
+    assert len(set(shardedfinder.shard_for_key(k, 4) for k in keys)) > 1
+
+
+def test_sharded_hits_match_single_finder():
+    single_hits = []
+    finder = anagramfinder.AnagramFinder(
+        hit_callback=lambda one, two: single_hits.append((one, two)))
+    finder.handle_many(TEST_INPUT)
+
+    sharded_hits = []
+    sharded = shardedfinder.ShardedAnagramFinder(
+        3, hit_callback=lambda one, two: sharded_hits.append((one, two)))
+    try:
+        sharded.handle_many(TEST_INPUT[:7])
+        for text in TEST_INPUT[7:]:
+            sharded.handle_input(text)
+    finally:
+        sharded.close()
+
+    assert len(single_hits) == 7
+    assert sorted(sharded_hits) == sorted(single_hits)
+
+
+def test_per_shard_limits():
+    retention = storage.RetentionPolicy(max_age=60, max_keys=1000, max_bytes=None)
+    limits = shardedfinder.per_shard_limits(
+        dict(cache_bytes=None, warm_bytes=0, retention=retention, bucket_size=3), 4)
+    assert limits['cache_size'] == common.ANAGRAM_CACHE_SIZE // 4
+    assert limits['cache_bytes'] is None
+    assert limits['warm_bytes'] == 0
+    assert limits['bucket_size'] == 3
+    assert (limits['retention'].max_age, limits['retention'].max_keys,
+            limits['retention'].max_bytes) == (60, 250, None)
+    assert shardedfinder.per_shard_limits(dict(cache_size=3), 4)['cache_size'] == 1
+
+
+def test_legacy_and_textless_inputs():
+    inputs = [{'tweet_text': 'So bored all the time'}, {'tweet_text': 'time destroys all things'},
+              {'tweet_text': 'Berit od hates me lol'}]
+    single_hits = []
+    finder = anagramfinder.AnagramFinder(
+        hit_callback=lambda one, two: single_hits.append((one, two)))
+    finder.handle_many(inputs)
+
+    sharded_hits = []
+    sharded = shardedfinder.ShardedAnagramFinder(
+        2, hit_callback=lambda one, two: sharded_hits.append((one, two)))
+    try:
+        sharded.handle_many(inputs)
+        for finder_under_test in (finder, sharded):
+            try:
+                finder_under_test.handle_input({'id': 1})
+            except TypeError:
+                continue
+            assert False, 'handled an input without text'
+    finally:
+        sharded.close()
+
+    assert len(single_hits) == 1
+    assert sharded_hits == single_hits
+
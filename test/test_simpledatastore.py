@@ -0,0 +1,77 @@
+import pickle
+
+from anagramatron import simpledatastore
+
+
+def test_least_used():
+    store = simpledatastore.AnagramSimpleStore()
+    for key in 'abcde':
+        store[key] = key
+    store['a'] = 'a'
+    store['a'] = 'a'
+    store['c'] = 'c'
+    assert store.least_used(3) == ['b', 'd', 'e']
+    assert store.least_used(10) == ['b', 'd', 'e', 'c', 'a']
+
+    popped = store.pop_least_used(2)
+    assert popped == [('b', 'b'), ('d', 'd')]
+    assert len(store) == 3
+    assert 'b' not in store
+    del store['e']
+    assert store.least_used(10) == ['c', 'a']
+
+
+def test_capacity():
+    store = simpledatastore.AnagramSimpleStore(max_items=2)
+    store['a'] = 'a'
+    store['b'] = 'b'
+    assert not store.over_capacity()
+    store['c'] = 'c'
+    assert store.over_capacity()
+
+    store = simpledatastore.AnagramSimpleStore(max_bytes=1000)
+    store['a'] = 'short'
+    assert not store.over_capacity()
+    store['a'] = 'long' * 500
+    assert store.over_capacity()
+    del store['a']
+    assert store.byte_size == 0
+
+
+def test_snapshot(tmpdir):
+    path = str(tmpdir.join('cache'))
+    store = simpledatastore.AnagramSimpleStore(path)
+    store['a'] = {'anagram_hash': 'a', 'tweet_id': 1, 'text': 'one'}
+    store['b'] = [{'anagram_hash': 'b', 'tweet_id': 2, 'text': 'two'},
+                  {'anagram_hash': 'b', 'tweet_id': 3, 'text': 'three'}]
+    store['c'] = {'anagram_hash': 'c', 'tweet_id': 4, 'text': 'four', 'extra': True}
+    store['a'] = store['a']
+    store.save()
+    assert not tmpdir.join('cache.tmp').exists()
+
+    loaded = simpledatastore.AnagramSimpleStore(path)
+    assert len(loaded) == 3
+    # values stay encoded until they are read
+    assert isinstance(loaded.datastore['b']['tweet'], bytes)
+    for key in 'abc':
+        assert loaded[key] == store[key]
+    assert loaded.datastore['a']['hit_count'] == 1
+    assert loaded.least_used(3) == store.least_used(3)
+
+
+def test_snapshot_damaged_and_legacy(tmpdir):
+    path = str(tmpdir.join('cache'))
+    store = simpledatastore.AnagramSimpleStore(path)
+    for key in 'abc':
+        store[key] = {'anagram_hash': key, 'tweet_id': 1, 'text': key * 10}
+    store.save()
+    data = tmpdir.join('cache').read_binary()
+    tmpdir.join('cache').write_binary(data[:-5])
+    assert len(simpledatastore.AnagramSimpleStore(path)) == 2
+
+    tweets = [{'anagram_hash': 'a', 'text': 'a'}, [{'anagram_hash': 'b', 'text': 'b'}]]
+    with open(path, 'wb') as f:
+        pickle.dump(tweets, f)
+    loaded = simpledatastore.AnagramSimpleStore(path)
+    assert loaded['a'] == tweets[0]
+    assert loaded['b'] == tweets[1]
@@ -0,0 +1,50 @@
+import os
+
+from anagramatron import common, sqlitestore
+
+TEST_LOCATION = os.path.join(common.ANAGRAM_DATA_DIR, 'test_store.sqlite')
+
+
+def test_basic_operations():
+    _cleanup()
+    store = sqlitestore.SQLiteStore(TEST_LOCATION)
+    tweet = {'text': 'hello there', 'tweet_id': 1, 'anagram_hash': 'EE'}
+    store['EE'] = tweet
+    store['AB'] = 'just a string'
+    assert 'EE' in store
+    assert 'CD' not in store
+    assert store['EE'] == tweet
+    assert store.get('AB') == 'just a string'
+    assert store.get('CD') is None
+    assert store.get_many(['EE', 'CD']) == {'EE': tweet}
+
+    store.put_many([('CD', 'one'), ('EE', 'two')])
+    assert len(store) == 3
+    assert [k for k, v in store.items()] == ['EE', 'AB', 'CD']
+    del store['AB']
+    assert 'AB' not in store
+    store.close()
+
+    store = sqlitestore.SQLiteStore(TEST_LOCATION)
+    assert dict(store.items()) == {'EE': 'two', 'CD': 'one'}
+    store.close()
+    _cleanup()
+
+
+def test_archive():
+    _cleanup()
+    store = sqlitestore.SQLiteStore(TEST_LOCATION, chunk_size=10)
+    store.put_many(('key%d' % i, 'value%d' % i) for i in range(25))
+    assert store.section_count() == 3
+    store.archive()
+    assert len(store) == 15
+    assert 'key9' not in store
+    assert 'key10' in store
+    store.close()
+    _cleanup()
+
+
+def _cleanup():
+    for suffix in ('', '-wal', '-shm', '.archive'):
+        if os.path.exists(TEST_LOCATION + suffix):
+            os.remove(TEST_LOCATION + suffix)
@@ -0,0 +1,119 @@
+import queue
+from itertools import islice
+
+from anagramatron import anagramfunctions, stream
+
+RAW_TWEET = {'id_str': '662725239776800768',
+             'id': 662725239776800768,
+             'lang': 'en',
+             'text': 'missing you x case is this long enough amazingface tell bzvty',
+             'entities': {'hashtags': [], 'symbols': [], 'urls': [], 'user_mentions': []},
+             'user': {'name': 'benani', 'screen_name': 'BreoniXO'},
+             'retweeted_status': None,
+             'created_at': 'Fri Nov 06 20:16:24 +0000 2015'}
+
+
+def _raw_tweets(count):
+    """raw tweets that mostly pass the filters, with a few that don't."""
+    tweets = []
+    for i in range(count):
+        tweet = dict(RAW_TWEET, id_str=str(i), id=i,
+                     text='%s %s' % (RAW_TWEET['text'], 'abcdefghij'[i % 10] * (i % 7)))
+        if i % 9 == 0:
+            tweet['lang'] = 'es'
+        if i % 11 == 0:
+            tweet['retweeted_status'] = {'id': 1}
+        if i % 13 == 0:
+            tweet['entities'] = dict(RAW_TWEET['entities'], user_mentions=[{'id': 2}])
+        tweets.append(tweet)
+    return tweets
+
+
+def test_filter_fields_match_filter_tweet():
+    tweets = _raw_tweets(40) + [
+        dict(RAW_TWEET, entities=dict(RAW_TWEET['entities'], urls=[{'url': 'x'}])),
+        dict(RAW_TWEET, text=RAW_TWEET['text'] + ' 42'),
+        dict(RAW_TWEET, text=RAW_TWEET['text'] + ' &amp; more &lt;&lt;'),
+        dict(RAW_TWEET, text='Beyoncé is in the café with Jäger tonight')]
+    trimmed = [stream._filter_fields(t) for t in tweets]
+    assert 'user' not in trimmed[0]
+    assert ([anagramfunctions.filter_tweet(t) for t in trimmed] ==
+            [anagramfunctions.filter_tweet(t) for t in tweets])
+    expected = [r for r in (anagramfunctions.filter_tweet(t) for t in tweets) if r]
+    assert anagramfunctions.TweetFilter().filter_tweets(trimmed) == expected
+
+
+def test_filter_worker():
+    tweets = [stream._filter_fields(t) for t in _raw_tweets(250)]
+    raw_queue, out = queue.Queue(), queue.Queue()
+    for batch in (tweets[:100], tweets[100:200], tweets[200:]):
+        raw_queue.put(batch)
+    raw_queue.put(None)
+    counters = [0] * 4
+    stream._run_filter_worker(1, raw_queue, out, counters)
+
+    results = []
+    while not out.empty():
+        results.append(out.get_nowait())
+    assert len(results) == 3
+    expected = [r for r in (anagramfunctions.filter_tweet(t) for t in tweets) if r]
+    assert [t for batch in results for t in batch] == expected
+    assert counters == [0, 0, 250, len(expected)]
+
+
+def test_raw_batcher_hands_batches_to_workers_in_turn():
+    tweets = _raw_tweets(250)
+    raw_queues = [queue.Queue(), queue.Queue()]
+    batcher = stream._RawBatcher(None, [0] * 4, raw_queues, max_wait=60)
+    batcher.start()
+    for tweet in tweets:
+        batcher.add(tweet)
+    assert raw_queues[0].qsize() == raw_queues[1].qsize() == 1
+    batcher.close()
+
+    batches = [raw_queues[0].get_nowait(), raw_queues[1].get_nowait(), raw_queues[0].get_nowait()]
+    assert [len(b) for b in batches] == [100, 100, 50]
+    assert [t['id_str'] for b in batches for t in b] == [t['id_str'] for t in tweets]
+    assert batches[0][0] == stream._filter_fields(tweets[0])
+
+
+def test_raw_batcher_flushes_partial_batches():
+    tweets = _raw_tweets(10)
+    out = queue.Queue()
+    counters = [0] * 2
+    batcher = stream._RawBatcher(out, counters, [], max_wait=0.05)
+    batcher.start()
+    for tweet in tweets:
+        batcher.add(tweet)
+    passed = out.get(timeout=5)
+    batcher.close()
+    assert passed == [r for r in (anagramfunctions.filter_tweet(t) for t in tweets) if r]
+    assert counters == [10, len(passed)]
+
+
+def _handler(lists):
+    handler = stream.StreamHandler(timeout=0.01)
+    handler.queue = queue.Queue()
+    for tweets in lists:
+        handler.queue.put(tweets)
+    return handler
+
+
+def test_iter_takes_lists_and_yields_in_chunks():
+    tweets = list(range(160))
+    handler = _handler([tweets[:150], tweets[150:]])
+    tweet_iter = iter(handler)
+    assert list(islice(tweet_iter, 100)) == tweets[:100]
+    assert handler.stats['buffer'] == 160
+    assert handler.bufferlength() == 60
+    handler.queue.put([160, 161])
+    assert list(islice(tweet_iter, 62)) == tweets[100:] + [160, 161]
+    handler._should_return = True
+    assert list(tweet_iter) == []
+
+
+def test_batches():
+    handler = _handler([list(range(150)), list(range(150, 160))])
+    batches = list(islice(handler.batches(50), 4))
+    assert [len(b) for b in batches] == [50, 50, 50, 10]
+    assert [t for b in batches for t in b] == list(range(160))